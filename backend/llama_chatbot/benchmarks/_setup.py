@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django(database=True):
+    """
+    Configure Django for a standalone benchmark run.
+
+    Uses the project settings with a process-local cache and a throwaway
+    test database, so benchmarks never touch db.sqlite3 or memcached.
+    """
+    sys.path.insert(0, str(BASE_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llama_chatbot.settings")
+    os.environ.setdefault(
+        "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+    )
+    os.environ.setdefault("CACHE_LOCATION", "benchmarks")
+    os.makedirs(BASE_DIR / "logs", exist_ok=True)
+
+    import django
+
+    django.setup()
+    if not database:
+        return
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    # A file-backed database lets the worker threads write concurrently.
+    connection.settings_dict["TEST"]["NAME"] = os.path.join(
+        tempfile.mkdtemp(prefix="llama-bench-"), "bench.sqlite3"
+    )
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
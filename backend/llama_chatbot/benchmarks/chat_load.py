@@ -0,0 +1,249 @@
+"""
+End-to-end load test of the chat API against a fake Ollama.
+
+Registers ``--users`` users, logs each in through /accounts/login/, creates a
+thread per user and has every user send ``--messages`` messages in a row,
+``--concurrency`` users at a time, through the full Django request path
+(middleware, views, ORM, streaming). The model is chat.fake_ollama's server,
+so timings are reproducible on any machine.
+
+Reports p50/p95/p99 time to first byte, total latency, tokens/s per request
+and DB queries per request, plus throughput and the process's peak RSS.
+Use ``--output`` to save the results as JSON and compare runs.
+
+Usage:
+    python -m benchmarks.chat_load --users 32 --concurrency 16 --messages 4
+"""
+
+import argparse
+import json
+import logging
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+
+from benchmarks._setup import setup_django
+
+PASSWORD = "bench-password"
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = round(pct / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": statistics.fmean(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_user(index, args):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+
+    client = Client()
+    response = client.post(
+        reverse("login"),
+        data=json.dumps({"username": f"bench{index}", "password": PASSWORD}),
+        content_type="application/json",
+        secure=True,
+    )
+    assert response.status_code == 200, response.content
+    response = client.post(reverse("start_new_thread"), secure=True)
+    thread_id = response.json()["thread_id"]
+
+    endpoint = (
+        "chat_with_model_stream" if args.endpoint == "stream" else "chat_with_model"
+    )
+    samples = []
+    for turn in range(args.messages):
+        sample = {"ok": False}
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = client.post(
+                reverse(endpoint, args=[thread_id]),
+                # Distinct per user, so no two share a model call
+                data=json.dumps(
+                    {
+                        "message": f"Question {turn} from user {index}",
+                        "history": "server",
+                    }
+                ),
+                content_type="application/json",
+                secure=True,
+            )
+            tokens = 0
+            first_byte = None
+            if response.streaming:
+                body = []
+                for chunk in response.streaming_content:
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+                    body.append(chunk)
+                response.close()
+                # Chunks hold batches of tokens; each fake model token is a word
+                tokens = len(b"".join(body).split())
+            else:
+                first_byte = time.perf_counter() - start
+                # chat_with_model answers errors with an empty reply
+                if response.status_code == 200 and response.json()["response"]:
+                    tokens = args.tokens
+            total = time.perf_counter() - start
+        sample.update(
+            ok=response.status_code == 200 and tokens > 0,
+            status=response.status_code,
+            ttfb=first_byte if first_byte is not None else total,
+            latency=total,
+            tokens=tokens,
+            queries=len(queries),
+        )
+        generating = total - sample["ttfb"]
+        if args.endpoint == "stream" and tokens > 1 and generating > 0:
+            sample["tokens_per_second"] = (tokens - 1) / generating
+        elif tokens and total > 0:
+            sample["tokens_per_second"] = tokens / total
+        samples.append(sample)
+    connection.close()
+    return samples
+
+
+def run(args):
+    from django.contrib.auth import get_user_model
+    from django.test import override_settings
+
+    from chat import admission, backends
+    from chat.fake_ollama import FakeOllamaServer
+
+    User = get_user_model()
+    for index in range(args.users):
+        User.objects.create_user(
+            username=f"bench{index}",
+            email=f"bench{index}@example.com",
+            password=PASSWORD,
+        )
+
+    with ExitStack() as stack:
+        # Measure the request path, not the per-user rate limits
+        stack.enter_context(override_settings(RATELIMIT_ENABLE=False))
+        if args.max_concurrency:
+            stack.enter_context(
+                mock.patch.object(
+                    admission,
+                    "gate",
+                    admission.AdmissionGate(
+                        args.max_concurrency, 1, args.users * args.messages, 0
+                    ),
+                )
+            )
+        server = stack.enter_context(
+            FakeOllamaServer(
+                ttft=args.ttft,
+                tokens_per_second=args.tokens_per_second,
+                tokens=args.tokens,
+                error_rate=args.error_rate,
+                seed=0,
+            )
+        )
+        stack.enter_context(
+            mock.patch.object(
+                backends, "pool", backends.BackendPool([server.host], health_interval=0)
+            )
+        )
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda i: run_user(i, args), range(args.users)))
+        wall = time.perf_counter() - start
+
+    samples = [sample for user_samples in results for sample in user_samples]
+    ok = [sample for sample in samples if sample["ok"]]
+    return {
+        "config": vars(args),
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "wall_seconds": wall,
+        "requests_per_second": len(samples) / wall,
+        "tokens_per_second_total": sum(s["tokens"] for s in ok) / wall,
+        "ttfb_seconds": summarize([s["ttfb"] for s in ok]),
+        "latency_seconds": summarize([s["latency"] for s in ok]),
+        "tokens_per_second": summarize(
+            [s["tokens_per_second"] for s in ok if "tokens_per_second" in s]
+        ),
+        "db_queries": summarize([s["queries"] for s in samples]),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=4, help="Messages per user")
+    parser.add_argument("--endpoint", choices=["stream", "chat"], default="stream")
+    parser.add_argument("--ttft", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="Override OLLAMA_MAX_CONCURRENCY for the run",
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    setup_django()
+    # The chat views log every request; keep the report readable
+    logging.disable(logging.INFO)
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(
+        f"{results['requests']} requests to {args.endpoint} from {args.users} users, "
+        f"{args.concurrency} at a time: {results['requests_per_second']:.1f} req/s, "
+        f"{results['errors']} errors, peak RSS {results['peak_rss_mb']:.0f} MB"
+    )
+    for name, unit, scale in (
+        ("ttfb_seconds", "ms", 1000),
+        ("latency_seconds", "ms", 1000),
+        ("tokens_per_second", "tok/s", 1),
+        ("db_queries", "queries", 1),
+    ):
+        stats = results[name]
+        if stats["p50"] is None:
+            continue
+        print(
+            f"{name:>18}: p50 {stats['p50'] * scale:8.1f}  "
+            f"p95 {stats['p95'] * scale:8.1f}  p99 {stats['p99'] * scale:8.1f} {unit}"
+        )
+
+
+if __name__ == "__main__":
+    main()
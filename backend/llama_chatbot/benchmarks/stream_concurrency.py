@@ -0,0 +1,176 @@
+"""
+Concurrent token streams per worker: sync vs async streaming path.
+
+Drives ollama_utils.stream_response (what chat_with_model_stream serves) and
+ollama_utils.astream_response (what chat_with_model_stream_async serves)
+against an in-process model stand-in that emits a token every
+``--token-delay`` seconds. The sync path gets a pool of ``--threads`` worker
+threads, like one gunicorn worker; the async path runs on a single event loop.
+
+Usage:
+    python -m benchmarks.stream_concurrency --streams 200 --tokens 50
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from benchmarks._setup import setup_django
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+class SlowClient:
+    def __init__(self, tokens, token_delay):
+        self.tokens = tokens
+        self.token_delay = token_delay
+
+    def chat(self, model, messages, stream=False, **options):
+        for i in range(self.tokens):
+            time.sleep(self.token_delay)
+            yield {"message": {"content": f"tok{i} "}}
+
+
+class SlowAsyncClient(SlowClient):
+    async def chat(self, model, messages, stream=False, **options):
+        async def generate():
+            for i in range(self.tokens):
+                await asyncio.sleep(self.token_delay)
+                yield {"message": {"content": f"tok{i} "}}
+
+        return generate()
+
+
+class InFlight:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+
+def open_gate(args):
+    # Measure the streaming paths themselves, not the admission limits
+    from chat import admission
+
+    return mock.patch.object(
+        admission,
+        "gate",
+        admission.AdmissionGate(args.streams, args.streams, args.streams, 0),
+    )
+
+
+def own_calls():
+    # Every stream sends the same prompt; without this they would all share
+    # one model call
+    from chat import singleflight
+
+    return mock.patch.object(singleflight, "SINGLE_FLIGHT", False)
+
+
+def run_sync(thread, args):
+    from chat import generations, ollama_utils
+
+    in_flight = InFlight()
+    client = SlowClient(args.tokens, args.token_delay)
+
+    def one_stream():
+        with in_flight:
+            generator = ollama_utils.stream_response(
+                None, "llama3.1", MESSAGES, thread, generations.start(thread.id)
+            )
+            for _ in generator:
+                pass
+
+    with open_gate(args), own_calls(), mock.patch.object(
+        ollama_utils, "initialize_client", return_value=client
+    ):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            for future in [pool.submit(one_stream) for _ in range(args.streams)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+    return {"peak_concurrent_streams": in_flight.peak, "wall_seconds": elapsed}
+
+
+def run_async(thread, args):
+    from chat import generations, ollama_utils
+
+    in_flight = InFlight()
+    client = SlowAsyncClient(args.tokens, args.token_delay)
+
+    async def one_stream():
+        with in_flight:
+            generator = ollama_utils.astream_response(
+                "llama3.1", MESSAGES, thread, generations.start(thread.id)
+            )
+            async for _ in generator:
+                pass
+
+    async def main():
+        await asyncio.gather(*(one_stream() for _ in range(args.streams)))
+
+    with open_gate(args), own_calls(), mock.patch.object(
+        ollama_utils, "initialize_async_client", return_value=client
+    ):
+        start = time.perf_counter()
+        asyncio.run(main())
+        elapsed = time.perf_counter() - start
+
+    return {"peak_concurrent_streams": in_flight.peak, "wall_seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth import get_user_model
+    from chat.models import ChatThread
+
+    user = get_user_model().objects.create_user(
+        username="bench", email="bench@example.com", password="bench"
+    )
+    thread = ChatThread.objects.create(user=user)
+
+    results = {"sync": run_sync(thread, args), "async": run_async(thread, args)}
+    for result in results.values():
+        result["streams_per_second"] = args.streams / result["wall_seconds"]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    ideal = args.tokens * args.token_delay
+    print(
+        f"{args.streams} streams x {args.tokens} tokens, "
+        f"{ideal:.2f}s per stream, {args.threads} sync worker threads"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:>5}: peak {result['peak_concurrent_streams']:4d} concurrent streams, "
+            f"{result['wall_seconds']:.2f}s wall, "
+            f"{result['streams_per_second']:.1f} streams/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Microbenchmark: truncate_context vs the token-aware build_messages.
+
+Builds synthetic histories of many short "user:"/"bot:" lines, well past the
+old 125000 character limit, and times the old character-based truncation
+followed by parsing (what the views used to do) against build_messages,
+which parses once and truncates by model tokens.
+
+Usage:
+    python -m benchmarks.truncate_context --lines 2000 5000 10000
+"""
+
+import argparse
+import json
+import time
+
+from benchmarks._setup import setup_django
+
+
+def synthetic_history(lines, line_length):
+    rows = []
+    for i in range(lines):
+        sender = "user" if i % 2 == 0 else "bot"
+        text = f"message {i} " + "x" * line_length
+        rows.append(f"{sender}: {text[:line_length]}")
+    return "\n".join(rows)
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--lines", type=int, nargs="+", default=[2000, 5000, 10000])
+    parser.add_argument("--line-length", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    setup_django(database=False)
+    from chat import ollama_utils
+
+    results = []
+    for lines in args.lines:
+        context = synthetic_history(lines, args.line_length)
+
+        def old():
+            ollama_utils.break_context_into_messages(
+                ollama_utils.truncate_context(context)
+            )
+
+        def new():
+            ollama_utils.build_messages(context, "llama3.1")
+
+        results.append(
+            {
+                "lines": lines,
+                "chars": len(context),
+                "truncate_context_seconds": best_of(old, args.repeat),
+                "build_messages_seconds": best_of(new, args.repeat),
+            }
+        )
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    for result in results:
+        speedup = result["truncate_context_seconds"] / result["build_messages_seconds"]
+        print(
+            f"{result['lines']:>7} lines / {result['chars']:>9} chars: "
+            f"truncate_context {result['truncate_context_seconds'] * 1000:9.1f} ms, "
+            f"build_messages {result['build_messages_seconds'] * 1000:7.1f} ms "
+            f"({speedup:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,15 @@ class ChatMessageInline(admin.TabularInline):
 
 
 class ChatThreadAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "title", "created_at", "updated_at")
+    list_display = (
+        "id",
+        "user",
+        "title",
+        "message_count",
+        "last_message_at",
+        "created_at",
+        "updated_at",
+    )
     search_fields = ("user__username", "title")
     inlines = [ChatMessageInline]
 
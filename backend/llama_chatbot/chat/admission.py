@@ -0,0 +1,206 @@
+import asyncio
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Model calls allowed to run at once in this worker process, in total and
+# per user, and how many more may wait in line before requests get a 503
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4"))
+OLLAMA_MAX_CONCURRENCY_PER_USER = int(os.getenv("OLLAMA_MAX_CONCURRENCY_PER_USER", "1"))
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "64"))
+# Retry-After hint, in seconds, sent with 503 responses
+OLLAMA_RETRY_AFTER = int(os.getenv("OLLAMA_RETRY_AFTER", "5"))
+
+
+class Overloaded(Exception):
+    """
+    Raised when the queue in front of Ollama is full.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Too many requests are waiting for the model")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ("user_id", "enqueued_at", "admitted", "wake")
+
+    def __init__(self, user_id, wake):
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.wake = wake
+
+
+class AdmissionGate:
+    """
+    Concurrency cap with a FIFO queue in front of the model calls.
+
+    At most ``max_active`` calls run at once and at most ``max_per_user`` for
+    any one user. Waiting requests are admitted in arrival order, skipping
+    those whose user is already at the per-user cap, so one user's burst
+    cannot starve everyone else. Usable from threads and from coroutines.
+    """
+
+    def __init__(self, max_active, max_per_user, max_queue, retry_after):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._active = 0
+        self._active_by_user = Counter()
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+    def check(self, user_id):
+        """
+        Fail fast if the queue is full, before any work is done for a request.
+
+        Returns:
+            int: The request's expected queue position, 0 if it would run
+            right away.
+
+        Raises:
+            Overloaded: If the queue is full.
+        """
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self._rejected += 1
+                raise Overloaded(self.retry_after)
+            if not self._queue and self._can_admit(user_id):
+                return 0
+            return len(self._queue) + 1
+
+    def acquire(self, user_id):
+        """
+        Block until a model call slot is free for the user.
+
+        Returns:
+            float: Seconds spent waiting in the queue.
+        """
+        event = threading.Event()
+        ticket = self._enqueue(user_id, event.set)
+        try:
+            event.wait()
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        return self._waited(ticket)
+
+    async def aacquire(self, user_id):
+        """
+        Async counterpart of acquire.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = self._enqueue(user_id, wake)
+        try:
+            await future
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        return self._waited(ticket)
+
+    def release(self, user_id):
+        with self._lock:
+            self._active -= 1
+            self._active_by_user[user_id] -= 1
+            if self._active_by_user[user_id] <= 0:
+                del self._active_by_user[user_id]
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, user_id):
+        self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    @asynccontextmanager
+    async def aadmit(self, user_id):
+        await self.aacquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def stats(self):
+        """
+        Return a snapshot of queue depth, running calls and wait times.
+        """
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": len(self._queue),
+                "max_active": self.max_active,
+                "max_per_user": self.max_per_user,
+                "max_queue": self.max_queue,
+                "admitted_total": self._admitted,
+                "rejected_total": self._rejected,
+                "wait_seconds_total": self._wait_seconds_total,
+                "wait_seconds_max": self._wait_seconds_max,
+            }
+
+    def _can_admit(self, user_id):
+        return (
+            self._active < self.max_active
+            and self._active_by_user[user_id] < self.max_per_user
+        )
+
+    def _enqueue(self, user_id, wake):
+        ticket = _Ticket(user_id, wake)
+        with self._lock:
+            self._queue.append(ticket)
+            self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        # Caller holds the lock. Admit waiting tickets in FIFO order.
+        if not self._queue or self._active >= self.max_active:
+            return
+        waiting = deque()
+        while self._queue:
+            ticket = self._queue.popleft()
+            if self._can_admit(ticket.user_id):
+                self._active += 1
+                self._active_by_user[ticket.user_id] += 1
+                self._admitted += 1
+                ticket.admitted = True
+                ticket.wake()
+            else:
+                waiting.append(ticket)
+        self._queue = waiting
+
+    def _abandon(self, ticket):
+        # The waiter gave up; give back its slot if it was admitted meanwhile
+        with self._lock:
+            if not ticket.admitted:
+                self._queue.remove(ticket)
+                return
+        self.release(ticket.user_id)
+
+    def _waited(self, ticket):
+        waited = time.monotonic() - ticket.enqueued_at
+        with self._lock:
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+        return waited
+
+
+gate = AdmissionGate(
+    OLLAMA_MAX_CONCURRENCY,
+    OLLAMA_MAX_CONCURRENCY_PER_USER,
+    OLLAMA_MAX_QUEUE,
+    OLLAMA_RETRY_AFTER,
+)
@@ -0,0 +1,210 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+# Comma-separated Ollama hosts to spread load over. Falls back to OLLAMA_HOST.
+OLLAMA_HOSTS = [
+    host.strip()
+    for host in (os.getenv("OLLAMA_HOSTS") or os.getenv("OLLAMA_HOST") or "").split(",")
+    if host.strip()
+] or [None]
+
+# Seconds between health checks, 0 to disable them
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("OLLAMA_HEALTH_TIMEOUT", "2"))
+# Consecutive failures before a backend is ejected from rotation
+OLLAMA_UNHEALTHY_AFTER = int(os.getenv("OLLAMA_UNHEALTHY_AFTER", "2"))
+# Extra outstanding requests a thread's preferred backend may carry over the
+# least loaded one before the thread is routed elsewhere
+OLLAMA_STICKY_SLACK = int(os.getenv("OLLAMA_STICKY_SLACK", "2"))
+
+# Weight of the newest sample in the tokens/s moving average
+THROUGHPUT_SMOOTHING = 0.2
+
+# Errors meaning the host could not be reached. The ollama client raises the
+# builtin ConnectionError when it cannot connect.
+CONNECTION_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, ConnectionError)
+
+
+class Backend:
+    """
+    One Ollama host and what the pool knows about it.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.tokens_per_second = None
+
+    @property
+    def label(self):
+        return self.host or "default"
+
+    def weight(self):
+        # Hosts that generate faster take proportionally more requests
+        return self.tokens_per_second or 1.0
+
+
+class BackendPool:
+    """
+    Routes model calls over several Ollama hosts.
+
+    A conversation sticks to the host picked for it by rendezvous hashing,
+    where its KV cache is likely still warm, unless that host is unhealthy
+    or carries OLLAMA_STICKY_SLACK more requests than the least loaded one.
+    Otherwise the host with the fewest outstanding requests per unit of
+    measured throughput wins. Hosts failing OLLAMA_UNHEALTHY_AFTER health
+    checks or requests in a row are ejected until a check succeeds again.
+    """
+
+    def __init__(
+        self,
+        hosts,
+        health_interval=OLLAMA_HEALTH_INTERVAL,
+        health_timeout=OLLAMA_HEALTH_TIMEOUT,
+        unhealthy_after=OLLAMA_UNHEALTHY_AFTER,
+        sticky_slack=OLLAMA_STICKY_SLACK,
+    ):
+        self.backends = [Backend(host) for host in hosts]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.unhealthy_after = unhealthy_after
+        self.sticky_slack = sticky_slack
+        self._lock = threading.Lock()
+        self._health_thread = None
+
+    def choose(self, thread_id=None):
+        with self._lock:
+            return self._choose(thread_id)
+
+    def acquire(self, thread_id=None):
+        """
+        Pick a backend for a model call and count it as outstanding until
+        it is released.
+        """
+        self._ensure_health_checks()
+        with self._lock:
+            backend = self._choose(thread_id)
+            backend.outstanding += 1
+        return backend
+
+    def release(self, backend, error=None):
+        """
+        Release a backend from acquire. A connection error counts as a
+        failed health check.
+        """
+        with self._lock:
+            backend.outstanding -= 1
+        if isinstance(error, CONNECTION_ERRORS):
+            self.mark_failure(backend)
+
+    @contextmanager
+    def lease(self, thread_id=None):
+        backend = self.acquire(thread_id)
+        try:
+            yield backend
+        except Exception as e:
+            self.release(backend, e)
+            raise
+        else:
+            self.release(backend)
+
+    def record_throughput(self, backend, tokens, seconds):
+        if tokens <= 0 or seconds <= 0:
+            return
+        rate = tokens / seconds
+        with self._lock:
+            if backend.tokens_per_second is None:
+                backend.tokens_per_second = rate
+            else:
+                backend.tokens_per_second += THROUGHPUT_SMOOTHING * (
+                    rate - backend.tokens_per_second
+                )
+
+    def mark_failure(self, backend):
+        with self._lock:
+            backend.failures += 1
+            if backend.failures >= self.unhealthy_after:
+                backend.healthy = False
+
+    def mark_success(self, backend):
+        with self._lock:
+            backend.failures = 0
+            backend.healthy = True
+
+    def check_health(self):
+        """
+        Probe every backend once and update its health.
+        """
+        for backend in self.backends:
+            try:
+                response = httpx.get(
+                    _api_url(backend.host, "/api/version"),
+                    timeout=self.health_timeout,
+                )
+                response.raise_for_status()
+            except httpx.HTTPError:
+                self.mark_failure(backend)
+            else:
+                self.mark_success(backend)
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "host": backend.label,
+                    "healthy": backend.healthy,
+                    "outstanding": backend.outstanding,
+                    "tokens_per_second": backend.tokens_per_second,
+                }
+                for backend in self.backends
+            ]
+
+    def _choose(self, thread_id):
+        # Caller holds the lock. With every host down, try them all anyway.
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        least = min(candidates, key=lambda b: (b.outstanding + 1) / b.weight())
+        if thread_id is None:
+            return least
+        preferred = max(candidates, key=lambda b: _affinity(thread_id, b.host))
+        if preferred.outstanding <= least.outstanding + self.sticky_slack:
+            return preferred
+        return least
+
+    def _ensure_health_checks(self):
+        if self.health_interval <= 0 or len(self.backends) < 2:
+            return
+        if self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(
+                    target=self._health_loop, name="ollama-health", daemon=True
+                )
+                self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+
+def _affinity(thread_id, host):
+    digest = hashlib.md5(f"{thread_id}:{host}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def _api_url(host, path):
+    host = host or "http://127.0.0.1:11434"
+    if "://" not in host:
+        host = f"http://{host}"
+    return host.rstrip("/") + path
+
+
+pool = BackendPool(OLLAMA_HOSTS)
@@ -0,0 +1,84 @@
+import logging
+import os
+import queue
+import threading
+
+from django.db import close_old_connections
+
+logger = logging.getLogger("chat")
+
+# Jobs waiting per worker process; more are skipped, and the requests that
+# queue them typically do so again on their next turn
+BACKGROUND_QUEUE_SIZE = int(os.getenv("CHAT_BACKGROUND_QUEUE_SIZE", "100"))
+
+
+class Worker:
+    """
+    A daemon thread running queued jobs one at a time, e.g. model calls
+    that must stay off the request path. Only one job per key is queued or
+    running at once.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self._queue = queue.Queue(size)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+
+    def submit(self, key, job, *args):
+        """
+        Queue ``job(*args)`` unless a job for ``key`` is already pending.
+
+        Returns:
+            bool: Whether the job was queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, job, args))
+            except queue.Full:
+                logger.warning(f"Background queue full, skipping {key}")
+                return False
+            self._pending.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+            return True
+
+    def pending(self):
+        with self._lock:
+            return set(self._pending)
+
+    def _run(self):
+        while True:
+            key, job, args = self._queue.get()
+            try:
+                job(*args)
+            except Exception as e:
+                logger.warning(f"Background job {key} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                close_old_connections()
+
+    def clear(self):
+        with self._lock:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._pending.clear()
+
+
+# Shared by every background stage, so they call Ollama one at a time
+worker = Worker("chat-background", BACKGROUND_QUEUE_SIZE)
+
+
+def submit(key, job, *args):
+    return worker.submit(key, job, *args)
+
+
+def clear():
+    worker.clear()
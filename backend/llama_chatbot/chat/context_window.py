@@ -0,0 +1,153 @@
+import math
+import os
+
+# Token budget for the prompt sent to Ollama. The default roughly matches the
+# old 125000 character limit of truncate_context.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("OLLAMA_CONTEXT_TOKENS", "32000"))
+
+# When a conversation outgrows the budget, the oldest turns are dropped in
+# steps of this fraction of the budget rather than one turn per request.
+# The kept history then starts at the same message for many turns, so the
+# prompt prefix Ollama has cached stays valid. 0 drops only what is needed.
+CONTEXT_DROP_FRACTION = float(os.getenv("OLLAMA_CONTEXT_DROP_FRACTION", "0.25"))
+
+# Average characters per token for the model families we serve. Used when no
+# real tokenizer is registered for a model.
+CHARS_PER_TOKEN = {
+    "llama3": 4.0,
+    "llama2": 3.5,
+    "mistral": 3.5,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.5
+
+# Chat template tokens (role header, end-of-turn) added to every message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Real tokenizers keyed by model name prefix, as callables returning a count
+TOKENIZERS = {}
+
+
+def register_tokenizer(model_prefix, count_fn):
+    """
+    Use a real tokenizer for models whose name starts with ``model_prefix``.
+
+    Args:
+        model_prefix (str): Model name prefix, e.g. "llama3.1".
+        count_fn (callable): Takes a string and returns its token count.
+    """
+    TOKENIZERS[model_prefix] = count_fn
+
+
+def _lookup(table, model_name, default):
+    # Longest matching prefix wins, so "llama3.1" can override "llama3"
+    best = None
+    for prefix in table:
+        if model_name and model_name.startswith(prefix):
+            if best is None or len(prefix) > len(best):
+                best = prefix
+    return table[best] if best is not None else default
+
+
+def count_tokens(text, model_name=None):
+    """
+    Count the tokens of a string for the target model.
+
+    Args:
+        text (str): The text to measure.
+        model_name (str): The Ollama model name, e.g. "llama3.1".
+
+    Returns:
+        int: The real token count if a tokenizer is registered for the model,
+        otherwise an estimate from its characters-per-token ratio.
+    """
+    tokenizer = _lookup(TOKENIZERS, model_name, None)
+    if tokenizer is not None:
+        return tokenizer(text)
+    ratio = _lookup(CHARS_PER_TOKEN, model_name, DEFAULT_CHARS_PER_TOKEN)
+    return math.ceil(len(text) / ratio)
+
+
+def count_message_tokens(message, model_name=None):
+    return count_tokens(message["content"], model_name) + MESSAGE_TOKEN_OVERHEAD
+
+
+def _drop_point(token_counts, start, excess, step):
+    # Index of the first message kept once at least ``excess`` tokens,
+    # rounded up to a multiple of ``step``, are dropped from ``start`` on.
+    # History only grows at the end, so the index moves once per step.
+    if step > 0:
+        excess = math.ceil(excess / step) * step
+    dropped = 0
+    i = start
+    while i < len(token_counts) and dropped < excess:
+        dropped += token_counts[i]
+        i += 1
+    return i
+
+
+def truncate_messages(
+    messages, model_name=None, max_tokens=None, token_counts=None, drop_fraction=None
+):
+    """
+    Drop the oldest messages until the conversation fits the token budget.
+
+    Messages are dropped in steps of ``drop_fraction`` of the budget, so
+    consecutive requests on a growing conversation send the same prefix and
+    Ollama can reuse what it computed for it. A leading system message and
+    the latest user turn are always kept, even if they alone exceed the
+    budget.
+
+    Args:
+        messages (list): Message dicts with 'role' and 'content', oldest first.
+        model_name (str): The Ollama model name used to count tokens.
+        max_tokens (int): The token budget, CONTEXT_TOKEN_BUDGET by default.
+        token_counts (list): Optional precomputed per-message token counts.
+        drop_fraction (float): CONTEXT_DROP_FRACTION by default.
+
+    Returns:
+        list: The kept messages, oldest first.
+    """
+    if max_tokens is None:
+        max_tokens = CONTEXT_TOKEN_BUDGET
+    if drop_fraction is None:
+        drop_fraction = CONTEXT_DROP_FRACTION
+    if token_counts is None:
+        token_counts = [count_message_tokens(m, model_name) for m in messages]
+
+    start = 0
+    kept = []
+    used = 0
+    if messages and messages[0]["role"] == "system":
+        start = 1
+        used = token_counts[0]
+
+    excess = sum(token_counts) - max_tokens
+    if excess <= 0:
+        return list(messages)
+
+    # Index of the latest user turn, which must survive truncation
+    last_user = None
+    for i in range(len(messages) - 1, start - 1, -1):
+        if messages[i]["role"] == "user":
+            last_user = i
+            break
+
+    needed = _drop_point(token_counts, start, excess, 0)
+    if needed < len(messages) and (last_user is None or needed <= last_user):
+        first = _drop_point(token_counts, start, excess, max_tokens * drop_fraction)
+        # Never past the latest user turn, nor past what is needed if none
+        first = min(first, len(messages) - 1 if last_user is None else last_user)
+        return messages[:start] + messages[first:]
+
+    # Even the newest turns overflow: keep what fits around the latest user turn
+    for i in range(len(messages) - 1, start - 1, -1):
+        if i != last_user and used + token_counts[i] > max_tokens:
+            if last_user is not None and last_user < i:
+                # Budget ran out on turns newer than the latest user turn
+                kept.append(messages[last_user])
+            break
+        used += token_counts[i]
+        kept.append(messages[i])
+
+    kept.reverse()
+    return messages[:start] + kept
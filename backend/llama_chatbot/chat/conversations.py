@@ -0,0 +1,403 @@
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from . import write_behind
+from .context_window import count_message_tokens
+from .models import ChatMessage, ChatThread
+
+logger = logging.getLogger("chat")
+
+# Memory budget of the in-process window cache, least recently used out first
+WINDOW_CACHE_BYTES = int(os.getenv("CHAT_WINDOW_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Optional shared tier: the Django cache alias to publish windows to, so
+# several worker processes can reuse each other's windows. Off when unset.
+WINDOW_CACHE_ALIAS = os.getenv("CHAT_WINDOW_CACHE_ALIAS") or None
+WINDOW_CACHE_TIMEOUT = int(os.getenv("CHAT_WINDOW_CACHE_TIMEOUT", "3600"))
+
+# Model whose token counts are cached with each window
+DEFAULT_MODEL = "llama3.1"
+
+# Ollama chat roles for the ChatMessage sender values
+ROLE_BY_SENDER = {"user": "user", "bot": "assistant"}
+
+# Rough per-message bookkeeping cost on top of the content, in bytes
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+def to_model_message(sender, content):
+    return {"role": ROLE_BY_SENDER.get(sender, sender), "content": content}
+
+
+class Window:
+    """
+    A thread's parsed conversation with per-message token counts.
+
+    ``version`` is the id of the newest ChatMessage it contains, which lets
+    the shared tier tell a stale copy from a current one. ``saved`` is the
+    number of stored messages it contains, checked against the thread's
+    message_count when there is no shared tier.
+    """
+
+    __slots__ = ("messages", "token_counts", "version", "saved", "model_name", "size")
+
+    def __init__(self, messages, token_counts, version, model_name, saved):
+        self.messages = messages
+        self.token_counts = token_counts
+        self.version = version
+        self.saved = saved
+        self.model_name = model_name
+        self.size = sum(_message_size(m) for m in messages)
+
+    def append(self, message, version):
+        self.messages.append(message)
+        self.token_counts.append(count_message_tokens(message, self.model_name))
+        if version is not None:
+            self.version = version
+            self.saved += 1
+        self.size += _message_size(message)
+
+    def snapshot(self):
+        return list(self.messages), list(self.token_counts)
+
+    def to_dict(self):
+        return {
+            "messages": self.messages,
+            "token_counts": self.token_counts,
+            "version": self.version,
+            "model_name": self.model_name,
+            "saved": self.saved,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            list(data["messages"]),
+            list(data["token_counts"]),
+            data["version"],
+            data["model_name"],
+            data["saved"],
+        )
+
+
+def _message_size(message):
+    return sys.getsizeof(message["content"]) + MESSAGE_OVERHEAD_BYTES
+
+
+class WindowCache:
+    """
+    In-process LRU of thread windows, bounded by an approximate byte budget.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, thread_id):
+        with self._lock:
+            window = self._windows.get(thread_id)
+            if window is not None:
+                self._windows.move_to_end(thread_id)
+            return window
+
+    def set(self, thread_id, window):
+        with self._lock:
+            old = self._windows.pop(thread_id, None)
+            if old is not None:
+                self.size -= old.size
+            if window.size > self.max_bytes:
+                return
+            self._windows[thread_id] = window
+            self.size += window.size
+            self._evict()
+
+    def append(self, thread_id, message, version):
+        with self._lock:
+            window = self._windows.get(thread_id)
+            if window is None:
+                return None
+            if version is not None and version <= window.version:
+                # Saved before a message the window already has, or already
+                # in it from a rebuild during a checkpointed reply; rebuild
+                self._windows.pop(thread_id)
+                self.size -= window.size
+                return None
+            before = window.size
+            window.append(message, version)
+            self.size += window.size - before
+            self._evict()
+            return window
+
+    def pop(self, thread_id):
+        with self._lock:
+            window = self._windows.pop(thread_id, None)
+            if window is not None:
+                self.size -= window.size
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._windows:
+            _, window = self._windows.popitem(last=False)
+            self.size -= window.size
+
+
+_local = WindowCache(WINDOW_CACHE_BYTES)
+
+
+def _shared_cache():
+    return caches[WINDOW_CACHE_ALIAS] if WINDOW_CACHE_ALIAS else None
+
+
+def _window_key(thread_id):
+    return f"chat:window:{thread_id}"
+
+
+def _version_key(thread_id):
+    return f"chat:window-version:{thread_id}"
+
+
+def _publish(thread_id, window):
+    shared = _shared_cache()
+    if shared is None:
+        return
+    try:
+        shared.set_many(
+            {
+                _window_key(thread_id): window.to_dict(),
+                _version_key(thread_id): window.version,
+            },
+            WINDOW_CACHE_TIMEOUT,
+        )
+    except Exception as e:
+        # Oversized windows or an unreachable cache only cost a DB read later
+        logger.warning(f"Could not publish window for thread {thread_id}: {e}")
+        _unpublish(thread_id)
+
+
+async def _apublish(thread_id, window):
+    shared = _shared_cache()
+    if shared is None:
+        return
+    try:
+        await shared.aset_many(
+            {
+                _window_key(thread_id): window.to_dict(),
+                _version_key(thread_id): window.version,
+            },
+            WINDOW_CACHE_TIMEOUT,
+        )
+    except Exception as e:
+        logger.warning(f"Could not publish window for thread {thread_id}: {e}")
+        await _aunpublish(thread_id)
+
+
+def _unpublish(thread_id):
+    shared = _shared_cache()
+    if shared is None:
+        return
+    try:
+        shared.delete_many([_window_key(thread_id), _version_key(thread_id)])
+    except Exception as e:
+        logger.warning(f"Could not invalidate window for thread {thread_id}: {e}")
+
+
+async def _aunpublish(thread_id):
+    shared = _shared_cache()
+    if shared is None:
+        return
+    try:
+        await shared.adelete_many([_window_key(thread_id), _version_key(thread_id)])
+    except Exception as e:
+        logger.warning(f"Could not invalidate window for thread {thread_id}: {e}")
+
+
+def _message_count(thread_id):
+    return ChatThread.objects.filter(pk=thread_id).values_list(
+        "message_count", flat=True
+    )
+
+
+def _needs_count(thread_id):
+    return _shared_cache() is None and _local.get(thread_id) is not None
+
+
+def _cached_window(thread_id, stored=None):
+    local = _local.get(thread_id)
+    shared = _shared_cache()
+    if shared is None:
+        # Other workers save messages to the thread too. Its stored message
+        # count, one primary key lookup, tells if this copy missed any.
+        if local is not None and local.saved != stored:
+            _local.pop(thread_id)
+            return None
+        return local
+
+    # The version key is tiny, so checking it keeps the local copy honest
+    # when another process has appended to the thread.
+    version = shared.get(_version_key(thread_id))
+    if version is None:
+        return None
+    if local is not None and local.version == version:
+        return local
+    return _shared_window(thread_id, version, shared.get(_window_key(thread_id)))
+
+
+async def _acached_window(thread_id, stored=None):
+    local = _local.get(thread_id)
+    shared = _shared_cache()
+    if shared is None:
+        return _cached_window(thread_id, stored)
+    version = await shared.aget(_version_key(thread_id))
+    if version is None:
+        return None
+    if local is not None and local.version == version:
+        return local
+    data = await shared.aget(_window_key(thread_id))
+    return _shared_window(thread_id, version, data)
+
+
+def _shared_window(thread_id, version, data):
+    if data is None or data["version"] != version:
+        return None
+    window = Window.from_dict(data)
+    _local.set(thread_id, window)
+    return window
+
+
+def _thread_messages(thread_id):
+    return (
+        ChatMessage.objects.filter(thread_id=thread_id)
+        .order_by("created_at", "id")
+        .values_list("id", "sender", "content", "created_at")
+    )
+
+
+def _with_pending(rows, pending):
+    # Queued messages that were not saved yet when the rows were read
+    saved = {(sender, created_at) for _, sender, _, created_at in rows}
+    rows = list(rows)
+    for record in pending:
+        created_at = write_behind.created_at(record)
+        if (record["sender"], created_at) not in saved:
+            rows.append((0, record["sender"], record["content"], created_at))
+    return sorted(rows, key=lambda row: row[3])
+
+
+def _build_window(thread_id, rows, pending=()):
+    messages = []
+    version = 0
+    saved = len(rows)
+    if pending:
+        rows = _with_pending(rows, pending)
+    for message_id, sender, content, _ in rows:
+        messages.append(to_model_message(sender, content))
+        version = max(version, message_id)
+    token_counts = [count_message_tokens(m, DEFAULT_MODEL) for m in messages]
+    window = Window(messages, token_counts, version, DEFAULT_MODEL, saved)
+    _local.set(thread_id, window)
+    return window
+
+
+def _window_counts(window, model_name):
+    messages, token_counts = window.snapshot()
+    if model_name and model_name != window.model_name:
+        token_counts = [count_message_tokens(m, model_name) for m in messages]
+    return messages, token_counts
+
+
+def get_window(thread_id, model_name=None):
+    """
+    Return a thread's conversation and per-message token counts.
+
+    Served from the in-process cache, then the shared Django cache tier if
+    configured, and built from the stored ChatMessage rows otherwise. Hot
+    threads skip both the message read and re-tokenization; without the
+    shared tier they cost one lookup of the thread's message count.
+
+    Args:
+        thread_id (int): The ChatThread id.
+        model_name (str): The model to count tokens for.
+
+    Returns:
+        tuple: (messages, token_counts), oldest first. Both are copies.
+    """
+    stored = None
+    if _needs_count(thread_id):
+        stored = _message_count(thread_id).first()
+    window = _cached_window(thread_id, stored)
+    if window is None:
+        pending = write_behind.pending(thread_id)
+        rows = list(_thread_messages(thread_id))
+        window = _build_window(thread_id, rows, pending)
+        _publish(thread_id, window)
+    return _window_counts(window, model_name)
+
+
+async def aget_window(thread_id, model_name=None):
+    """
+    Async counterpart of get_window.
+    """
+    stored = None
+    if _needs_count(thread_id):
+        stored = await _message_count(thread_id).afirst()
+    window = await _acached_window(thread_id, stored)
+    if window is None:
+        pending = write_behind.pending(thread_id)
+        rows = [row async for row in _thread_messages(thread_id)]
+        window = _build_window(thread_id, rows, pending)
+        await _apublish(thread_id, window)
+    return _window_counts(window, model_name)
+
+
+def get_history(thread_id):
+    return get_window(thread_id)[0]
+
+
+def append_message(thread_id, message_id, sender, content):
+    """
+    Append a newly saved message to the thread's cached window, if cached.
+
+    Threads that are not cached locally are dropped from the shared tier;
+    their next get_window call reads the new row from the database. So are
+    messages queued by write_behind, which have no id to version them by.
+    """
+    window = _local.append(thread_id, to_model_message(sender, content), message_id)
+    if window is None or message_id is None:
+        _unpublish(thread_id)
+    else:
+        _publish(thread_id, window)
+
+
+async def aappend_message(thread_id, message_id, sender, content):
+    """
+    Async counterpart of append_message.
+    """
+    window = _local.append(thread_id, to_model_message(sender, content), message_id)
+    if window is None or message_id is None:
+        await _aunpublish(thread_id)
+    else:
+        await _apublish(thread_id, window)
+
+
+def invalidate(*thread_ids):
+    """
+    Drop threads from both cache tiers, e.g. after they were deleted.
+    """
+    for thread_id in thread_ids:
+        _local.pop(thread_id)
+        _unpublish(thread_id)
+
+
+def clear():
+    _local.clear()
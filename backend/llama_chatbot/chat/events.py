@@ -0,0 +1,85 @@
+import json
+
+# Content type of streams sent as Server-Sent Events
+SSE_CONTENT_TYPE = "text/event-stream"
+
+
+def wants_sse(request):
+    return SSE_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+def queue(position):
+    """
+    The request's place in the model queue, 0 once it is running.
+    """
+    return {"type": "queue", "position": position}
+
+
+def token(content):
+    return {"type": "token", "content": content}
+
+
+def done(outcome, usage, message, tokens=0, cached=False):
+    """
+    The end of a generation.
+
+    Args:
+        outcome (str): "completed" or "cancelled".
+        usage (dict): Ollama's final chunk, if the stream got that far.
+        message (ChatMessage): The saved reply, if any.
+        tokens (int): Tokens streamed, used when Ollama sent no counts.
+        cached (bool): The reply came from the response cache.
+    """
+    usage = usage or {}
+    eval_count = usage.get("eval_count") or tokens
+    eval_duration = (usage.get("eval_duration") or 0) / 1e9
+    return {
+        "type": "done",
+        "outcome": outcome,
+        "message_id": message.id if message is not None else None,
+        "cached": cached,
+        "usage": {
+            "prompt_tokens": usage.get("prompt_eval_count"),
+            "completion_tokens": eval_count,
+            "total_duration": (usage.get("total_duration") or 0) / 1e9 or None,
+            "tokens_per_second": (
+                eval_count / eval_duration if eval_duration else None
+            ),
+        },
+    }
+
+
+def error(message):
+    return {"type": "error", "error": message}
+
+
+def sse(event):
+    """
+    Encode an event as one Server-Sent Events frame named after its type.
+    """
+    data = json.dumps(event, separators=(",", ":"))
+    return f"event: {event['type']}\ndata: {data}\n\n".encode()
+
+
+def encode_sse(stream):
+    """
+    Encode a stream of events as Server-Sent Events.
+
+    Closing the returned generator closes ``stream``.
+    """
+    try:
+        for event in stream:
+            yield sse(event)
+    finally:
+        stream.close()
+
+
+async def aencode_sse(stream):
+    """
+    Async counterpart of encode_sse.
+    """
+    try:
+        async for event in stream:
+            yield sse(event)
+    finally:
+        await stream.aclose()
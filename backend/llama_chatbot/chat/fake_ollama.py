@@ -0,0 +1,232 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "The quick brown fox jumps over the lazy dog while the model keeps "
+    "talking about nothing in particular"
+).split()
+
+
+class FakeOllamaServer:
+    """
+    Stand-in for an Ollama server, for tests and load tests without a GPU.
+
+    Answers /api/chat, streaming or not, with deterministic filler text, and
+    /api/version and /api/tags for health checks. Every reply takes ``ttft``
+    seconds to its first token and then produces ``tokens_per_second``
+    tokens (0 for no delay) until ``tokens`` have been sent, or the request's
+    ``options.num_predict`` if smaller. A share ``error_rate`` of chat
+    requests fails with an HTTP 500 and a share ``stream_error_rate`` of
+    streams fails halfway through with an error line, as Ollama does.
+
+    Usable as a context manager:
+
+        with FakeOllamaServer(ttft=0.1, tokens_per_second=50) as server:
+            client = ollama.Client(host=server.host)
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        ttft=0.0,
+        tokens_per_second=0.0,
+        tokens=32,
+        error_rate=0.0,
+        stream_error_rate=0.0,
+        seed=None,
+    ):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.requests = 0
+        self.active = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        address, port = self.server.server_address[:2]
+        self.host = f"http://{address}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reply(self, length):
+        """
+        Return the tokens of a reply of the given length.
+        """
+        return [
+            (" " if i else "") + WORDS[i % len(WORDS)] for i in range(max(length, 0))
+        ]
+
+    def _roll(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+
+def _handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/api/version":
+                self.send_json(200, {"version": "0.0.0-fake"})
+            elif self.path == "/api/tags":
+                self.send_json(200, {"models": []})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self.send_json(400, {"error": "invalid JSON"})
+                return
+            if self.path != "/api/chat":
+                self.send_json(404, {"error": "not found"})
+                return
+
+            with fake._lock:
+                fake.requests += 1
+                fake.active += 1
+            try:
+                self.chat(body)
+            finally:
+                with fake._lock:
+                    fake.active -= 1
+
+        def chat(self, body):
+            started = time.monotonic()
+            if fake._roll(fake.error_rate):
+                self.send_json(500, {"error": "injected failure"})
+                return
+
+            model = body.get("model", "")
+            options = body.get("options") or {}
+            length = min(fake.tokens, options.get("num_predict") or fake.tokens)
+            tokens = fake.reply(length)
+            prompt_eval_count = sum(
+                len(str(message.get("content", "")).split())
+                for message in body.get("messages") or []
+            )
+            delay = 1 / fake.tokens_per_second if fake.tokens_per_second else 0
+
+            time.sleep(fake.ttft)
+            eval_started = time.monotonic()
+
+            if not body.get("stream", True):
+                time.sleep(delay * len(tokens))
+                self.send_json(
+                    200,
+                    done_chunk(
+                        model,
+                        "".join(tokens),
+                        started,
+                        eval_started,
+                        prompt_eval_count,
+                        len(tokens),
+                    ),
+                )
+                return
+
+            fail_at = len(tokens) // 2 if fake._roll(fake.stream_error_rate) else None
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i, token in enumerate(tokens):
+                    if i == fail_at:
+                        self.write_chunk({"error": "injected stream failure"})
+                        break
+                    if i:
+                        time.sleep(delay)
+                    self.write_chunk(
+                        {
+                            "model": model,
+                            "created_at": now(),
+                            "message": {"role": "assistant", "content": token},
+                            "done": False,
+                        }
+                    )
+                else:
+                    self.write_chunk(
+                        done_chunk(
+                            model,
+                            "",
+                            started,
+                            eval_started,
+                            prompt_eval_count,
+                            len(tokens),
+                        )
+                    )
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away mid-stream, as Ollama sees on cancel
+                self.close_connection = True
+
+        def write_chunk(self, data):
+            line = json.dumps(data).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        def send_json(self, status, data):
+            payload = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def done_chunk(model, content, started, eval_started, prompt_eval_count, eval_count):
+    finished = time.monotonic()
+    return {
+        "model": model,
+        "created_at": now(),
+        "message": {"role": "assistant", "content": content},
+        "done": True,
+        "done_reason": "stop",
+        "total_duration": int((finished - started) * 1e9),
+        "load_duration": 0,
+        "prompt_eval_count": prompt_eval_count,
+        "prompt_eval_duration": int((eval_started - started) * 1e9),
+        "eval_count": eval_count,
+        "eval_duration": int((finished - eval_started) * 1e9),
+    }
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+# How often a running stream checks the shared cache for a cancel request
+# made in another worker process, in seconds
+CANCEL_POLL_INTERVAL = float(os.getenv("CHAT_CANCEL_POLL_INTERVAL", "0.5"))
+CANCEL_FLAG_TIMEOUT = 300
+
+_lock = threading.Lock()
+_active = {}
+
+
+def _flag_key(thread_id):
+    return f"chat:cancel:{thread_id}"
+
+
+class Generation:
+    """
+    Cancellation handle of one streaming generation, identified by ``id``.
+
+    Works like a threading.Event that is also set by cancel() calls made in
+    other processes, which it notices by polling the shared cache at most
+    every CANCEL_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, thread_id):
+        self.id = str(uuid.uuid4())
+        self.thread_id = thread_id
+        self._event = threading.Event()
+        self._next_poll = time.monotonic() + CANCEL_POLL_INTERVAL
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        if not self._event.is_set() and self._poll_due():
+            if cache.get(_flag_key(self.thread_id)):
+                self._event.set()
+        return self._event.is_set()
+
+    async def ais_set(self):
+        """
+        Async counterpart of is_set, which polls without blocking the event
+        loop.
+        """
+        if not self._event.is_set() and self._poll_due():
+            if await cache.aget(_flag_key(self.thread_id)):
+                self._event.set()
+        return self._event.is_set()
+
+    def _poll_due(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + CANCEL_POLL_INTERVAL
+        return True
+
+
+def _register(thread_id):
+    generation = Generation(thread_id)
+    with _lock:
+        _active.setdefault(thread_id, set()).add(generation)
+    return generation
+
+
+def start(thread_id):
+    """
+    Register a new generation for a thread and clear any stale cancel request.
+    """
+    cache.delete(_flag_key(thread_id))
+    return _register(thread_id)
+
+
+async def astart(thread_id):
+    """
+    Async counterpart of start.
+    """
+    await cache.adelete(_flag_key(thread_id))
+    return _register(thread_id)
+
+
+def finish(generation):
+    with _lock:
+        generations = _active.get(generation.thread_id)
+        if generations is not None:
+            generations.discard(generation)
+            if not generations:
+                del _active[generation.thread_id]
+
+
+def cancel(thread_id):
+    """
+    Stop the thread's running generations, in this process or any other.
+
+    Returns:
+        bool: True if a generation was running in this process.
+    """
+    cache.set(_flag_key(thread_id), True, CANCEL_FLAG_TIMEOUT)
+    with _lock:
+        generations = list(_active.get(thread_id, ()))
+    for generation in generations:
+        generation.set()
+    return bool(generations)
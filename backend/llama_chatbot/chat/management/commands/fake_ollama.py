@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+
+from chat.fake_ollama import FakeOllamaServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a fake Ollama server answering /api/chat with filler text at a "
+        "configurable speed, for load and latency tests without a GPU."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bind", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=11434)
+        parser.add_argument(
+            "--ttft", type=float, default=0.2, help="Seconds to the first token."
+        )
+        parser.add_argument(
+            "--tokens-per-second",
+            type=float,
+            default=30.0,
+            help="Generation speed after the first token, 0 for no delay.",
+        )
+        parser.add_argument(
+            "--tokens", type=int, default=200, help="Tokens in each reply."
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Share of chat requests answered with HTTP 500.",
+        )
+        parser.add_argument(
+            "--stream-error-rate",
+            type=float,
+            default=0.0,
+            help="Share of streams failing halfway with an error line.",
+        )
+        parser.add_argument("--seed", type=int, help="Seed for error injection.")
+
+    def handle(self, *args, **options):
+        server = FakeOllamaServer(
+            host=options["bind"],
+            port=options["port"],
+            ttft=options["ttft"],
+            tokens_per_second=options["tokens_per_second"],
+            tokens=options["tokens"],
+            error_rate=options["error_rate"],
+            stream_error_rate=options["stream_error_rate"],
+            seed=options["seed"],
+        )
+        self.stdout.write(f"Fake Ollama listening on {server.host}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
@@ -0,0 +1,245 @@
+import logging
+import os
+import threading
+
+from . import background, backends, context_window, ollama_clients
+from .context_window import count_tokens
+from .conversations import to_model_message
+from .models import ChatMessage, MessageEmbedding
+
+try:
+    import numpy as np
+except ImportError:  # Retrieval memory needs it
+    np = None
+
+logger = logging.getLogger("chat")
+
+# Ollama embedding model, e.g. "nomic-embed-text", used to recall older
+# messages of a long thread that are relevant to the new turn. Off when unset.
+MEMORY_MODEL = os.getenv("CHAT_MEMORY_MODEL") or None
+# Most older messages recalled per turn, and the least cosine similarity
+# to the new turn they need
+MEMORY_TOP_K = int(os.getenv("CHAT_MEMORY_TOP_K", "4"))
+MEMORY_MIN_SCORE = float(os.getenv("CHAT_MEMORY_MIN_SCORE", "0.5"))
+# Tokens of the prompt budget kept free for recalled messages
+MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "1000"))
+
+# Messages embedded per Ollama call when indexing
+INDEX_BATCH = 32
+
+MEMORY_HEADING = "Earlier messages from this conversation that may be relevant:\n\n"
+
+_lock = threading.Lock()
+_indexed = {}  # thread_id -> leading messages already indexed
+
+
+def enabled():
+    return MEMORY_MODEL is not None and np is not None
+
+
+def prompt_budget():
+    """
+    The token budget left for the conversation, with room kept for
+    recalled messages if retrieval memory is on.
+    """
+    budget = context_window.CONTEXT_TOKEN_BUDGET
+    return budget - MEMORY_TOKENS if enabled() else budget
+
+
+def encode(vector):
+    """
+    Return an embedding as the bytes of a unit-length float16 array.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm:
+        vector = vector / norm
+    return vector.astype(np.float16).tobytes()
+
+
+def top_k(matrix, query, k, min_score):
+    """
+    Rank the rows of a float16 embedding matrix by cosine similarity.
+
+    Returns:
+        list: Indexes of at most k rows scoring at least min_score, best
+        first.
+    """
+    if not len(matrix) or k <= 0:
+        return []
+    query = np.asarray(query, dtype=np.float32)
+    norm = float(np.linalg.norm(query))
+    if not norm or query.shape[0] != matrix.shape[1]:
+        return []
+    scores = matrix.astype(np.float32) @ (query / norm)
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best])]
+    return [int(i) for i in best if scores[i] >= min_score]
+
+
+def schedule(thread_id, upto):
+    """
+    Queue the embedding of a thread's first ``upto`` messages, which no
+    longer fit its prompt, for background.worker.
+    """
+    if not enabled():
+        return
+    with _lock:
+        if _indexed.get(thread_id, 0) >= upto:
+            return
+    background.submit(("memory", thread_id), index, thread_id, upto)
+
+
+def index(thread_id, upto):
+    """
+    Embed those of a thread's first ``upto`` messages not embedded yet.
+
+    Returns:
+        int: The number of messages embedded.
+    """
+    ids = list(
+        ChatMessage.objects.filter(thread_id=thread_id)
+        .order_by("created_at", "id")
+        .values_list("id", flat=True)[:upto]
+    )
+    done = set(
+        MessageEmbedding.objects.filter(
+            message_id__in=ids, model=MEMORY_MODEL
+        ).values_list("message_id", flat=True)
+    )
+    todo = list(
+        ChatMessage.objects.filter(id__in=set(ids) - done)
+        .order_by("created_at", "id")
+        .values_list("id", "content")
+    )
+    for start in range(0, len(todo), INDEX_BATCH):
+        batch = todo[start : start + INDEX_BATCH]
+        with backends.pool.lease(thread_id) as backend:
+            client = ollama_clients.get_client(backend.host)
+            response = client.embed(
+                model=MEMORY_MODEL, input=[content for _, content in batch]
+            )
+        MessageEmbedding.objects.bulk_create(
+            [
+                MessageEmbedding(
+                    message_id=message_id,
+                    thread_id=thread_id,
+                    model=MEMORY_MODEL,
+                    vector=encode(vector),
+                )
+                for (message_id, _), vector in zip(batch, response["embeddings"])
+            ],
+            ignore_conflicts=True,
+        )
+    with _lock:
+        if len(_indexed) > 10000:
+            _indexed.clear()
+        _indexed[thread_id] = upto
+    return len(todo)
+
+
+def _embeddings(thread_id):
+    return MessageEmbedding.objects.filter(
+        thread_id=thread_id, model=MEMORY_MODEL
+    ).values_list("message_id", "vector")
+
+
+def _ranked(rows, query):
+    ids = [message_id for message_id, _ in rows]
+    matrix = np.frombuffer(b"".join(bytes(v) for _, v in rows), dtype=np.float16)
+    matrix = matrix.reshape(len(rows), -1)
+    return [ids[i] for i in top_k(matrix, query, MEMORY_TOP_K, MEMORY_MIN_SCORE)]
+
+
+def _recalled(ids):
+    return ChatMessage.objects.filter(id__in=ids).values_list("id", "sender", "content")
+
+
+def _latest_user_turn(messages):
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]["role"] == "user":
+            return i
+    return None
+
+
+def _with_memories(messages, ids, rows, model_name):
+    # Best first until the budget is spent, then in conversation order
+    by_id = {message_id: (sender, content) for message_id, sender, content in rows}
+    kept = []
+    used = count_tokens(MEMORY_HEADING, model_name)
+    for message_id in ids:
+        if message_id not in by_id:
+            continue
+        sender, content = by_id[message_id]
+        line = "{role}: {content}".format(**to_model_message(sender, content))
+        tokens = count_tokens(line, model_name) + 1
+        if used + tokens > MEMORY_TOKENS:
+            continue
+        used += tokens
+        kept.append((message_id, line))
+    if not kept:
+        return messages
+    kept.sort()
+    recalled = {
+        "role": "system",
+        "content": MEMORY_HEADING + "\n\n".join(line for _, line in kept),
+    }
+    # Just before the new turn, so the prompt's start stays the same
+    i = _latest_user_turn(messages)
+    return messages[:i] + [recalled] + messages[i:]
+
+
+def recall(thread_id, messages, model_name, embed):
+    """
+    Add the thread's older messages most relevant to the latest user turn
+    to a prompt, as one system message before that turn.
+
+    Only messages indexed after falling out of the prompt are searched, so
+    none of them is already in it.
+
+    Args:
+        thread_id (int): The ChatThread id.
+        messages (list): The truncated prompt.
+        model_name (str): The model the prompt is for, to count tokens.
+        embed (callable): Returns the embedding of a string.
+
+    Returns:
+        list: The prompt, unchanged if nothing relevant was found.
+    """
+    i = _latest_user_turn(messages)
+    if not enabled() or i is None:
+        return messages
+    try:
+        rows = list(_embeddings(thread_id))
+        ids = _ranked(rows, embed(messages[i]["content"])) if rows else []
+        if not ids:
+            return messages
+        return _with_memories(messages, ids, list(_recalled(ids)), model_name)
+    except Exception as e:
+        logger.warning(f"Could not recall messages for thread {thread_id}: {e}")
+        return messages
+
+
+async def arecall(thread_id, messages, model_name, aembed):
+    """
+    Async counterpart of recall, with an async ``aembed``.
+    """
+    i = _latest_user_turn(messages)
+    if not enabled() or i is None:
+        return messages
+    try:
+        rows = [row async for row in _embeddings(thread_id)]
+        ids = _ranked(rows, await aembed(messages[i]["content"])) if rows else []
+        if not ids:
+            return messages
+        rows = [row async for row in _recalled(ids)]
+        return _with_memories(messages, ids, rows, model_name)
+    except Exception as e:
+        logger.warning(f"Could not recall messages for thread {thread_id}: {e}")
+        return messages
+
+
+def clear():
+    with _lock:
+        _indexed.clear()
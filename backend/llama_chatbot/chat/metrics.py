@@ -0,0 +1,335 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from . import admission, backends
+
+# Bearer token Prometheus sends to scrape /metrics. Without it, only staff
+# users can read the metrics.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+LABELS = ("model", "host")
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(names, values):
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of label names.
+
+    Values are kept per process; every worker reports its own.
+    """
+
+    def __init__(self, name, documentation, buckets, labelnames=LABELS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # One count per bucket, then +Inf, then the sum
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labelvalues, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames + ("le",), labelvalues + (bound,)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    """
+    Prometheus counter with a fixed set of label names.
+    """
+
+    def __init__(self, name, documentation, labelnames=LABELS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._series = {}
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._series[labelvalues] = self._series.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            series = dict(self._series)
+        for labelvalues, value in sorted(series.items()):
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def gauges(fn):
+    """
+    Register a function returning (name, documentation, [(labels, value)])
+    tuples, called on every scrape.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+QUEUE_WAIT = Histogram(
+    "chat_queue_wait_seconds",
+    "Time a stream waited in the admission queue for a model call slot.",
+    SECONDS_BUCKETS,
+)
+CONNECT = Histogram(
+    "chat_upstream_connect_seconds",
+    "Time from sending the chat request to Ollama to its response headers.",
+    SECONDS_BUCKETS,
+)
+FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the start of a stream, queue wait included, to its first token.",
+    SECONDS_BUCKETS,
+)
+INTER_TOKEN = Histogram(
+    "chat_inter_token_seconds",
+    "Gap between consecutive streamed tokens.",
+    GAP_BUCKETS,
+)
+TOKENS = Histogram(
+    "chat_generated_tokens",
+    "Tokens generated per stream, from Ollama's eval_count when reported.",
+    TOKEN_BUCKETS,
+)
+TOKEN_RATE = Histogram(
+    "chat_tokens_per_second",
+    "Generation speed per stream, from Ollama's eval_count and eval_duration "
+    "when reported.",
+    RATE_BUCKETS,
+)
+PROMPT_EVAL = Histogram(
+    "chat_prompt_eval_seconds",
+    "Prompt processing time reported by Ollama.",
+    SECONDS_BUCKETS,
+)
+DB_SAVE = Histogram(
+    "chat_db_save_seconds",
+    "Time to save a streamed bot reply.",
+    SECONDS_BUCKETS,
+)
+STREAMS = Counter(
+    "chat_streams_total",
+    "Finished streams by outcome: completed, cancelled, disconnected or error.",
+    LABELS + ("outcome",),
+)
+
+
+@gauges
+def _admission_gauges():
+    stats = admission.gate.stats()
+    return [
+        (
+            "chat_admission_active",
+            "Model calls running in this worker process.",
+            [({}, stats["active"])],
+        ),
+        (
+            "chat_admission_queued",
+            "Requests waiting for a model call slot in this worker process.",
+            [({}, stats["queued"])],
+        ),
+    ]
+
+
+@gauges
+def _backend_gauges():
+    stats = backends.pool.stats()
+    return [
+        (
+            "chat_backend_outstanding",
+            "Model calls in flight per Ollama host.",
+            [({"host": b["host"]}, b["outstanding"]) for b in stats],
+        ),
+        (
+            "chat_backend_healthy",
+            "1 if the Ollama host passes its health checks.",
+            [({"host": b["host"]}, int(b["healthy"])) for b in stats],
+        ),
+    ]
+
+
+_current = contextvars.ContextVar("chat_stream_timer", default=None)
+
+
+class StreamTimer:
+    """
+    Collects the timings of one streamed model call and records them once
+    it finishes.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.host = "none"
+        self.started = time.monotonic()
+        self.requested = None
+        self.connected = None
+        self.first_token = None
+        self.last_token = None
+        self.tokens = 0
+        self.usage = None
+
+    @property
+    def labels(self):
+        return (self.model, self.host)
+
+    def admitted(self, waited, host):
+        self.host = host
+        QUEUE_WAIT.observe(waited, *self.labels)
+
+    def request(self):
+        # Lets the HTTP client's response hook find this timer
+        self.requested = time.monotonic()
+        _current.set(self)
+
+    def token(self, part):
+        now = time.monotonic()
+        if part.get("done"):
+            self.usage = part
+            return
+        if self.first_token is None:
+            self.first_token = now
+            FIRST_TOKEN.observe(now - self.started, *self.labels)
+        else:
+            INTER_TOKEN.observe(now - self.last_token, *self.labels)
+        self.last_token = now
+        self.tokens += 1
+
+    def saving(self):
+        return saving(*self.labels)
+
+    def finish(self, outcome):
+        if _current.get() is self:
+            _current.set(None)
+        labels = self.labels
+        STREAMS.inc(*labels, outcome)
+        if self.connected is not None:
+            CONNECT.observe(self.connected - self.requested, *labels)
+
+        usage = self.usage or {}
+        rate = None
+        if usage.get("eval_count") and usage.get("eval_duration"):
+            tokens = usage["eval_count"]
+            rate = tokens / (usage["eval_duration"] / 1e9)
+        else:
+            tokens = self.tokens
+            if tokens > 1 and self.last_token > self.first_token:
+                rate = (tokens - 1) / (self.last_token - self.first_token)
+        if tokens:
+            TOKENS.observe(tokens, *labels)
+        if rate is not None:
+            TOKEN_RATE.observe(rate, *labels)
+        if usage.get("prompt_eval_duration"):
+            PROMPT_EVAL.observe(usage["prompt_eval_duration"] / 1e9, *labels)
+
+
+@contextmanager
+def saving(model, host):
+    """
+    Time saving a streamed bot reply.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        DB_SAVE.observe(time.monotonic() - started, model, host)
+
+
+def on_response(response):
+    """
+    httpx response hook marking when the current stream's Ollama request got
+    its response headers.
+    """
+    timer = _current.get()
+    if timer is not None and timer.connected is None:
+        timer.connected = time.monotonic()
+
+
+async def aon_response(response):
+    on_response(response)
+
+
+def render():
+    """
+    Return every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                names, values = tuple(labels), tuple(labels.values())
+                lines.append(
+                    f"{name}{_format_labels(names, values)} {_format_value(value)}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    for metric in _registry:
+        metric.clear()
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    ChatThread = apps.get_model("chat", "ChatThread")
+    ChatMessage = apps.get_model("chat", "ChatMessage")
+    for thread in ChatThread.objects.iterator():
+        messages = ChatMessage.objects.filter(thread=thread)
+        last = messages.order_by("-created_at", "-id").first()
+        if last is None:
+            continue
+        ChatThread.objects.filter(pk=thread.pk).update(
+            message_count=messages.count(),
+            last_message_at=last.created_at,
+            last_message_preview=last.content[:100],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatthread",
+            name="last_message_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chatthread",
+            name="last_message_preview",
+            field=models.CharField(blank=True, default="", max_length=100),
+        ),
+        migrations.AddField(
+            model_name="chatthread",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(
+                fields=["thread", "created_at", "id"],
+                name="chat_message_thread_created",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="chatthread",
+            index=models.Index(
+                fields=["user", "updated_at"], name="chat_thread_user_updated"
+            ),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
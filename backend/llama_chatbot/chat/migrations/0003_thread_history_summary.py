@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0002_thread_summary_and_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatthread",
+            name="history_summary",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="chatthread",
+            name="summarized_messages",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
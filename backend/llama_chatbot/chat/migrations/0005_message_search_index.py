@@ -0,0 +1,66 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    # External content table: the text stays in chat_chatmessage only
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+    "content, content='chat_chatmessage', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); "
+    "END",
+    "CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "END",
+    "CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content "
+    "ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); "
+    "END",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+POSTGRES_FORWARD = [
+    "ALTER TABLE chat_chatmessage ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+    "CREATE INDEX chat_message_search ON chat_chatmessage USING GIN (search_vector)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS chat_message_search",
+    "ALTER TABLE chat_chatmessage DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+
+    return apply
+
+
+class Migration(migrations.Migration):
+    """
+    Full-text index of message content for chat.search. Other databases get
+    no index and are searched by scanning.
+    """
+
+    dependencies = [
+        ("chat", "0004_message_embedding"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            run({"sqlite": SQLITE_REVERSE, "postgresql": POSTGRES_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,86 @@
+from importlib import import_module
+
+from django.db import migrations
+
+previous = import_module("chat.migrations.0005_message_search_index")
+
+# Each message is indexed with an "owner<user id>" token, and searches
+# match it together with their terms, so the index only yields the
+# searching user's messages instead of every user's.
+
+OWNER = "(SELECT 'owner' || user_id FROM chat_chatthread WHERE id = {}.thread_id)"
+
+SQLITE_FORWARD = previous.SQLITE_REVERSE + [
+    # The external content is a view, which adds the owner to each message
+    "CREATE VIEW chat_message_fts_source AS "
+    "SELECT m.id, m.content, 'owner' || t.user_id AS owner "
+    "FROM chat_chatmessage m JOIN chat_chatthread t ON t.id = m.thread_id",
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+    "content, owner, content='chat_message_fts_source', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content, owner) "
+    f"VALUES (new.id, new.content, {OWNER.format('new')}); "
+    "END",
+    "CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content, owner) "
+    f"VALUES ('delete', old.id, old.content, {OWNER.format('old')}); "
+    "END",
+    "CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content "
+    "ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content, owner) "
+    f"VALUES ('delete', old.id, old.content, {OWNER.format('old')}); "
+    "INSERT INTO chat_message_fts(rowid, content, owner) "
+    f"VALUES (new.id, new.content, {OWNER.format('new')}); "
+    "END",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = previous.SQLITE_REVERSE + [
+    "DROP VIEW IF EXISTS chat_message_fts_source",
+    *previous.SQLITE_FORWARD,
+]
+
+POSTGRES_FORWARD = previous.POSTGRES_REVERSE + [
+    # A generated column cannot read the thread, so a trigger fills it in.
+    # Content is weight A and the owner weight D, so searches for the owner
+    # token never match message text.
+    "ALTER TABLE chat_chatmessage ADD COLUMN search_vector tsvector",
+    "CREATE FUNCTION chat_message_search_vector() RETURNS trigger AS $$ "
+    "BEGIN "
+    "NEW.search_vector := setweight(to_tsvector('english', NEW.content), 'A') "
+    "|| coalesce(setweight(to_tsvector('simple', "
+    f"{OWNER.format('NEW')}), 'D'), ''); "
+    "RETURN NEW; "
+    "END $$ LANGUAGE plpgsql",
+    "CREATE TRIGGER chat_message_search_vector "
+    "BEFORE INSERT OR UPDATE OF content, thread_id ON chat_chatmessage "
+    "FOR EACH ROW EXECUTE FUNCTION chat_message_search_vector()",
+    "UPDATE chat_chatmessage SET content = content",
+    "CREATE INDEX chat_message_search ON chat_chatmessage USING GIN (search_vector)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS chat_message_search",
+    "DROP TRIGGER IF EXISTS chat_message_search_vector ON chat_chatmessage",
+    "DROP FUNCTION IF EXISTS chat_message_search_vector()",
+    "ALTER TABLE chat_chatmessage DROP COLUMN IF EXISTS search_vector",
+    *previous.POSTGRES_FORWARD,
+]
+
+
+class Migration(migrations.Migration):
+    """
+    Scope the full-text index of chat.search to each message's user.
+    """
+
+    dependencies = [
+        ("chat", "0005_message_search_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            previous.run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            previous.run({"sqlite": SQLITE_REVERSE, "postgresql": POSTGRES_REVERSE}),
+        ),
+    ]
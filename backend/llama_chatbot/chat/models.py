@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
 from django.utils import timezone
 
+# Length of the last message snippet stored on ChatThread for the sidebar
+PREVIEW_LENGTH = 100
+
 
 class ChatThread(models.Model):
     user = models.ForeignKey(
@@ -10,10 +14,40 @@ class ChatThread(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=50, default="New Chat")
+    # Denormalized from ChatMessage so thread lists never touch that table
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(
+        max_length=PREVIEW_LENGTH, blank=True, default=""
+    )
+    # Model-written summary of the thread's first ``summarized_messages``
+    # messages, sent in their place once they no longer fit the prompt
+    history_summary = models.TextField(blank=True, default="")
+    summarized_messages = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "updated_at"], name="chat_thread_user_updated"
+            ),
+        ]
 
     def __str__(self):
         return f"Thread {self.id} for user {self.user.username}"
 
+    def refresh_summary(self):
+        """
+        Recompute the denormalized message summary from ChatMessage rows,
+        e.g. after messages were deleted.
+        """
+        last = self.messages.order_by("-created_at", "-id").first()
+        self.message_count = self.messages.count()
+        self.last_message_at = last.created_at if last else None
+        self.last_message_preview = last.content[:PREVIEW_LENGTH] if last else ""
+        self.save(
+            update_fields=["message_count", "last_message_at", "last_message_preview"]
+        )
+
 
 class ChatMessage(models.Model):
     thread = models.ForeignKey(
@@ -23,5 +57,61 @@ class ChatMessage(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["thread", "created_at", "id"],
+                name="chat_message_thread_created",
+            ),
+        ]
+
     def __str__(self):
         return f"Message {self.id} in thread {self.thread.id} by {self.sender}"
+
+    def save(self, *args, **kwargs):
+        # New messages update their thread's summary in the same transaction
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            update_fields = kwargs.get("update_fields")
+            if update_fields is None or "content" in update_fields:
+                # An edited last message, e.g. a streamed reply being written
+                ChatThread.objects.filter(
+                    pk=self.thread_id, last_message_at=self.created_at
+                ).update(last_message_preview=self.content[:PREVIEW_LENGTH])
+            return
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+            ChatThread.objects.filter(pk=self.thread_id).update(
+                message_count=F("message_count") + 1,
+                last_message_at=self.created_at,
+                last_message_preview=self.content[:PREVIEW_LENGTH],
+                updated_at=timezone.now(),
+            )
+
+
+class MessageEmbedding(models.Model):
+    """
+    A ChatMessage's embedding for retrieval memory, stored as the bytes of a
+    unit-length float16 array.
+    """
+
+    message = models.ForeignKey(
+        ChatMessage, on_delete=models.CASCADE, related_name="embeddings"
+    )
+    # Denormalized so a thread's embeddings load without a join
+    thread = models.ForeignKey(ChatThread, on_delete=models.CASCADE, related_name="+")
+    model = models.CharField(max_length=100)
+    vector = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["message", "model"], name="chat_embedding_message_model"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["thread", "model"], name="chat_embedding_thread"),
+        ]
+
+    def __str__(self):
+        return f"Embedding of message {self.message_id} by {self.model}"
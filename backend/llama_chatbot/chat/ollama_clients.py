@@ -0,0 +1,101 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+from ollama import AsyncClient, Client
+
+from . import metrics
+
+# Connection pool and timeout tuning for the Ollama HTTP clients. The read
+# timeout bounds the gap between streamed chunks, not the whole generation.
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "300"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "100"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "60"))
+
+_lock = threading.Lock()
+_clients = {}
+# httpx.AsyncClient is bound to the event loop it first ran on, so async
+# clients are kept per loop and dropped together with it.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _client_options():
+    return {
+        "timeout": httpx.Timeout(
+            OLLAMA_READ_TIMEOUT,
+            connect=OLLAMA_CONNECT_TIMEOUT,
+        ),
+        "limits": httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def get_client(host):
+    """
+    Return the process-wide Ollama Client for a host, creating it on first use.
+
+    The client keeps a keep-alive connection pool, so consecutive messages
+    reuse TCP connections. It is safe to share between threads.
+
+    Args:
+        host (str): The Ollama host URL, or None for the ollama default.
+
+    Returns:
+        Client: The shared client for the host.
+    """
+    client = _clients.get(host)
+    if client is None:
+        with _lock:
+            client = _clients.get(host)
+            if client is None:
+                client = Client(
+                    host=host,
+                    event_hooks={"response": [metrics.on_response]},
+                    **_client_options(),
+                )
+                _clients[host] = client
+    return client
+
+
+def get_async_client(host):
+    """
+    Return the Ollama AsyncClient for a host on the running event loop.
+
+    Args:
+        host (str): The Ollama host URL, or None for the ollama default.
+
+    Returns:
+        AsyncClient: The client shared by every coroutine on this loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(host)
+        if client is None:
+            client = AsyncClient(
+                host=host,
+                event_hooks={"response": [metrics.aon_response]},
+                **_client_options(),
+            )
+            clients[host] = client
+    return client
+
+
+def close_clients():
+    """
+    Close every pooled sync client. Async clients are released with their loop.
+    """
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
@@ -1,18 +1,65 @@
-from ollama import Client
 from .models import ChatMessage, ChatThread
-from django.shortcuts import get_object_or_404
+from . import (
+    admission,
+    backends,
+    conversations,
+    events,
+    generations,
+    memory,
+    metrics,
+    ollama_clients,
+    response_cache,
+    singleflight,
+    summaries,
+    write_behind,
+)
+from .context_window import count_message_tokens, truncate_messages
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from django.http import Http404
 from pathlib import Path
 from dotenv import load_dotenv
+import asyncio
 import os
+import time
 
 # Load the .env file
 env_path = Path(__file__).resolve().parent.parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
-# Use the environment variable
+# Use the environment variable. With OLLAMA_HOSTS set, requests are spread
+# over several hosts by backends.pool instead.
 OLLAMA_HOST = os.getenv("OLLAMA_HOST")
 
+# A streamed reply is written to the database every this many tokens or
+# seconds while it is generated, so a crashed worker loses little of it.
+# 0 turns that trigger off.
+CHECKPOINT_TOKENS = int(os.getenv("CHAT_CHECKPOINT_TOKENS", "64"))
+CHECKPOINT_INTERVAL = float(os.getenv("CHAT_CHECKPOINT_INTERVAL", "2"))
+
+# How long Ollama keeps the model loaded after a call, and with it the
+# prompt prefix it last processed, which the next turn of a thread reuses
+# instead of evaluating the whole conversation again. A duration such as
+# "30m", seconds, or -1 to keep it loaded. Empty leaves it to the server.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Context length the model runs with. It must not change between calls,
+# since that reloads the model, and must fit CONTEXT_TOKEN_BUDGET, or
+# Ollama cuts the prompt's start itself. 0 uses the model's default.
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "0"))
+
+# System message prompt to provide context to the LLM. It is the start of
+# every prompt, so it must stay byte-identical between calls for Ollama to
+# reuse its cached prefix: nothing per-request, like the date, goes in it.
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "You are an AI assistant named Llama Chat, designed to help users with various questions, "
+        "provide explanations, and engage in interactive conversations. You are friendly, informative, "
+        "and concise in your responses. When answering, aim to provide clear, accurate, and helpful information. "
+        "If you don't know the answer or if a question is unclear, ask for clarification or suggest a way to find more information. "
+        "Avoid making up facts, and ensure that your responses align with the user's context and needs."
+    ),
+}
+
 
 def truncate_context(context_str):
     """
@@ -25,6 +72,10 @@ def truncate_context(context_str):
 
     Returns:
         str: The truncated string within the 125000 character limit.
+
+    Note:
+        Kept for reference and benchmarks. The chat views use build_messages,
+        which truncates in one pass by model tokens.
     """
     max_length = 125000
 
@@ -39,69 +90,636 @@ def truncate_context(context_str):
     return context_str
 
 
-def initialize_client():
+def build_messages(context_str, model_name):
+    """
+    Build the message list sent to the model from a context string.
+
+    Parses the conversation once, prepends the system prompt and drops the
+    oldest turns that do not fit the model's token budget. The system prompt
+    and the latest user turn are always kept.
+
+    Args:
+        context_str (str): The newline-joined conversation context.
+        model_name (str): The Ollama model the messages are for.
+
+    Returns:
+        list: Message dictionaries with 'role' and 'content'.
+    """
+    messages = [SYSTEM_PROMPT] + break_context_into_messages(context_str)
+    return truncate_messages(messages, model_name)
+
+
+def build_thread_messages(thread, model_name):
+    """
+    Build the message list sent to the model from a thread's stored messages.
+
+    Used when the client only sends its new turn: the conversation comes from
+    the thread's cached window of ChatMessage rows with their token counts,
+    so nothing is parsed or re-tokenized and multi-line messages stay intact.
+
+    Args:
+        thread (ChatThread): The thread, with the new user turn already saved.
+        model_name (str): The Ollama model the messages are for.
+
+    Returns:
+        list: Message dictionaries with 'role' and 'content'.
+    """
+    history, token_counts = conversations.get_window(thread.id, model_name)
+    messages = summarized_messages(thread, history, token_counts, model_name)
+    return memory.recall(
+        thread.id,
+        messages,
+        model_name,
+        lambda text: embed(text, thread.id, memory.MEMORY_MODEL),
+    )
+
+
+async def abuild_thread_messages(thread, model_name):
+    """
+    Async counterpart of build_thread_messages.
+    """
+    history, token_counts = await conversations.aget_window(thread.id, model_name)
+    messages = summarized_messages(thread, history, token_counts, model_name)
+    return await memory.arecall(
+        thread.id,
+        messages,
+        model_name,
+        lambda text: aembed(text, thread.id, memory.MEMORY_MODEL),
+    )
+
+
+def summarized_messages(thread, history, token_counts, model_name):
+    """
+    Truncate a thread's history, with its stored summary in place of the
+    messages it covers.
+
+    Messages the truncation drops that the summary does not cover yet are
+    queued for summarizing in the background, so a later turn has them.
+    All messages before the kept history are queued for retrieval memory.
+    """
+    system = SYSTEM_PROMPT
+    start = 0
+    if thread.history_summary and thread.summarized_messages <= len(history):
+        system = summaries.system_message(SYSTEM_PROMPT, thread.history_summary)
+        start = thread.summarized_messages
+    history = history[start:]
+    messages = truncate_messages(
+        [system] + history,
+        model_name,
+        max_tokens=memory.prompt_budget(),
+        token_counts=[count_message_tokens(system, model_name)] + token_counts[start:],
+    )
+    dropped = len(history) - (len(messages) - 1)
+    if dropped > 0:
+        summaries.schedule(thread.id, start + dropped)
+    if start + dropped > 0:
+        memory.schedule(thread.id, start + dropped)
+    return messages
+
+
+def chat_options():
+    """
+    Keyword arguments for every Ollama chat call. They are the same for all
+    calls, so the model stays loaded with the prefix of the last prompt.
+    """
+    options = {}
+    if OLLAMA_KEEP_ALIVE:
+        try:
+            options["keep_alive"] = float(OLLAMA_KEEP_ALIVE)
+        except ValueError:
+            options["keep_alive"] = OLLAMA_KEEP_ALIVE
+    if OLLAMA_NUM_CTX:
+        options["options"] = {"num_ctx": OLLAMA_NUM_CTX}
+    return options
+
+
+def initialize_client(host=None):
     try:
-        client = Client(host=OLLAMA_HOST)
+        client = ollama_clients.get_client(host or OLLAMA_HOST)
         return client
     except Exception as e:
         print("Error initializing the Client:", str(e))
         return None
 
 
-def stream_response(request, model_name, context, thread, cancellation_event):
-    client = initialize_client()
-    if client is None:
-        return
+def initialize_async_client(host=None):
+    try:
+        client = ollama_clients.get_async_client(host or OLLAMA_HOST)
+        return client
+    except Exception as e:
+        print("Error initializing the AsyncClient:", str(e))
+        return None
+
+
+def embed(text, thread_id=None, model=None):
+    """
+    Embed a string, by default with the semantic response cache's model.
+    """
+    with backends.pool.lease(thread_id) as backend:
+        client = initialize_client(backend.host)
+        if client is None:
+            raise ConnectionError("Could not initialize the Ollama client")
+        response = client.embed(
+            model=model or response_cache.SEMANTIC_CACHE_MODEL, input=text
+        )
+    return response["embeddings"][0]
+
+
+async def aembed(text, thread_id=None, model=None):
+    """
+    Async counterpart of embed.
+    """
+    with backends.pool.lease(thread_id) as backend:
+        client = initialize_async_client(backend.host)
+        if client is None:
+            raise ConnectionError("Could not initialize the Ollama client")
+        response = await client.embed(
+            model=model or response_cache.SEMANTIC_CACHE_MODEL, input=text
+        )
+    return response["embeddings"][0]
+
+
+def record_usage(backend, part):
+    """
+    Feed the generation speed reported in Ollama's final chunk to the pool.
+    """
+    if part.get("done"):
+        backends.pool.record_throughput(
+            backend,
+            part.get("eval_count") or 0,
+            (part.get("eval_duration") or 0) / 1e9,
+        )
+
+
+class ReplyWriter:
+    """
+    Collects a streamed bot reply and saves it as it grows.
+
+    Fragments go to a list joined only when written, so a long reply costs
+    linear work. The ChatMessage row is created at the first checkpoint and
+    updated at later ones and once more when the stream ends.
+    """
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.parts = []
+        self.message = None
+        self._unsaved = 0
+        self._next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+
+    def __bool__(self):
+        return bool(self.parts)
+
+    def text(self):
+        return "".join(self.parts)
+
+    def append(self, fragment):
+        """
+        Add a fragment.
+
+        Returns:
+            bool: True if a checkpoint is due.
+        """
+        if not fragment:
+            return False
+        self.parts.append(fragment)
+        self._unsaved += 1
+        if CHECKPOINT_TOKENS and self._unsaved >= CHECKPOINT_TOKENS:
+            return True
+        return bool(CHECKPOINT_INTERVAL) and time.monotonic() >= self._next_checkpoint
+
+    def checkpoint(self):
+        self._checkpointed()
+        if self.message is None:
+            self.message = ChatMessage.objects.create(
+                thread=self.thread, sender="bot", content=self.text()
+            )
+        else:
+            self.message.content = self.text()
+            self.message.save(update_fields=["content"])
+
+    async def acheckpoint(self):
+        self._checkpointed()
+        if self.message is None:
+            self.message = await ChatMessage.objects.acreate(
+                thread=self.thread, sender="bot", content=self.text()
+            )
+        else:
+            self.message.content = self.text()
+            await self.message.asave(update_fields=["content"])
+
+    def finish(self):
+        """
+        Save the whole reply, if any.
+        """
+        if not self.parts:
+            return None
+        if self.message is None:
+            return save_message(self.thread, "bot", self.text())
+        if self._unsaved:
+            self.checkpoint()
+        return self._finished()
+
+    async def afinish(self):
+        """
+        Async counterpart of finish.
+        """
+        if not self.parts:
+            return None
+        if self.message is None:
+            return await asave_message(self.thread, "bot", self.text())
+        if self._unsaved:
+            await self.acheckpoint()
+        message = self.message
+        await conversations.aappend_message(
+            self.thread.id, message.id, "bot", message.content
+        )
+        return message
+
+    def _checkpointed(self):
+        self._unsaved = 0
+        self._next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+
+    def _finished(self):
+        message = self.message
+        conversations.append_message(self.thread.id, message.id, "bot", message.content)
+        return message
+
+
+def replay_cached(parts, thread, generation, typed=False):
+    """
+    Stream a cached reply at the configured pace, like a generated one, and
+    save it to the thread. It needs no model call slot.
+    """
+    reply = ReplyWriter(thread)
+    outcome = "completed"
+    message = None
+    try:
+        if typed:
+            yield events.queue(0)
+        for content in response_cache.paced(parts):
+            if generation.is_set():
+                outcome = "cancelled"
+                break
+            if reply.append(content):
+                reply.checkpoint()
+            yield events.token(content) if typed else content
+    finally:
+        generations.finish(generation)
+        if reply:
+            message = reply.finish()
+    if typed:
+        yield events.done(outcome, None, message, len(reply.parts), cached=True)
+
+
+async def areplay_cached(parts, thread, generation, typed=False):
+    """
+    Async counterpart of replay_cached.
+    """
+    reply = ReplyWriter(thread)
+    outcome = "completed"
+    message = None
+    try:
+        if typed:
+            yield events.queue(0)
+        async for content in response_cache.apaced(parts):
+            if await generation.ais_set():
+                outcome = "cancelled"
+                break
+            if reply.append(content):
+                await reply.acheckpoint()
+            yield events.token(content) if typed else content
+    finally:
+        generations.finish(generation)
+        if reply:
+            message = await reply.afinish()
+    if typed:
+        yield events.done(outcome, None, message, len(reply.parts), cached=True)
+
+
+def finished_event(outcome, usage, tokens, message):
+    """
+    The event ending a typed stream: done with usage stats, or an error.
+    """
+    if outcome == "error":
+        return events.error("The model could not generate a reply")
+    return events.done(outcome, usage, message, tokens)
+
+
+def model_stream(model_name, messages, thread, flight):
+    """
+    Call the model once a model call slot is free and yield its chunks.
+
+    Yields singleflight.ADMITTED first, once admitted. The Ollama host is
+    picked from backends.pool and the call's timings are recorded. Closing
+    the generator closes the upstream stream, which makes Ollama stop
+    generating.
+
+    Args:
+        model_name (str): The Ollama model to chat with.
+        messages (list): The messages to send.
+        thread (ChatThread): The thread of the request that started the call.
+        flight (singleflight.Flight): The subscribers sharing the call.
+
+    Returns:
+        Iterator[ChatResponse]: The Ollama chunks.
+    """
+    upstream = None
+    admitted = False
+    backend = None
+    error = None
+    timer = metrics.StreamTimer(model_name)
+    outcome = "completed"
+    try:
+        # Wait for a model call slot before talking to Ollama
+        waited = admission.gate.acquire(thread.user_id)
+        admitted = True
+        yield singleflight.ADMITTED
+        backend = backends.pool.acquire(thread.id)
+        timer.admitted(waited, backend.label)
+        flight.host = backend.label
+        client = initialize_client(backend.host)
+        if client is None:
+            raise RuntimeError("Could not initialize the Ollama client")
+        timer.request()
+        upstream = client.chat(
+            model=model_name, messages=messages, stream=True, **chat_options()
+        )
+        for part in upstream:
+            timer.token(part)
+            record_usage(backend, part)
+            yield part
+    except GeneratorExit:
+        outcome = flight.stop_reason or "disconnected"
+        raise
+    except Exception as e:
+        error = e
+        outcome = "error"
+        raise
+    finally:
+        if upstream is not None:
+            upstream.close()
+        if backend is not None:
+            backends.pool.release(backend, error)
+        if admitted:
+            admission.gate.release(thread.user_id)
+        timer.finish(outcome)
+
+
+async def amodel_stream(model_name, messages, thread, flight):
+    """
+    Async counterpart of model_stream.
+    """
+    upstream = None
+    admitted = False
+    backend = None
+    error = None
+    timer = metrics.StreamTimer(model_name)
+    outcome = "completed"
+    try:
+        # Wait for a model call slot before talking to Ollama
+        waited = await admission.gate.aacquire(thread.user_id)
+        admitted = True
+        yield singleflight.ADMITTED
+        backend = backends.pool.acquire(thread.id)
+        timer.admitted(waited, backend.label)
+        flight.host = backend.label
+        client = initialize_async_client(backend.host)
+        if client is None:
+            raise RuntimeError("Could not initialize the Ollama client")
+        timer.request()
+        upstream = await client.chat(
+            model=model_name, messages=messages, stream=True, **chat_options()
+        )
+        async for part in upstream:
+            timer.token(part)
+            record_usage(backend, part)
+            yield part
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = flight.stop_reason or "disconnected"
+        raise
+    except Exception as e:
+        error = e
+        outcome = "error"
+        raise
+    finally:
+        if upstream is not None:
+            await upstream.aclose()
+        if backend is not None:
+            backends.pool.release(backend, error)
+        if admitted:
+            admission.gate.release(thread.user_id)
+        timer.finish(outcome)
+
+
+def stream_response(
+    request, model_name, messages, thread, generation, typed=False, queue_position=0
+):
+    """
+    Stream the model's reply and save it to the thread.
+
+    The reply is checkpointed to the database while it is generated and
+    saved in full when the stream ends, errors, is cancelled through the
+    generation, or is closed because the client disconnected (the WSGI server
+    closes the generator when a write fails).
 
-    # Define the system message prompt to provide context to the LLM
-    system_prompt = {
-        "role": "system",
-        "content": (
-            "You are an AI assistant named Llama Chat, designed to help users with various questions, "
-            "provide explanations, and engage in interactive conversations. You are friendly, informative, "
-            "and concise in your responses. When answering, aim to provide clear, accurate, and helpful information. "
-            "If you don't know the answer or if a question is unclear, ask for clarification or suggest a way to find more information. "
-            "Avoid making up facts, and ensure that your responses align with the user's context and needs."
-        ),
-    }
+    Prompts seen before are answered from response_cache, if enabled.
+    Requests for the same prompt that run at once share one model call
+    through singleflight, and each saves its own reply; the call stops once
+    none of them is reading it.
 
-    # Break context into messages and prepend the system message
-    messages = [system_prompt] + break_context_into_messages(context)
+    Args:
+        request (HttpRequest): The request being served.
+        model_name (str): The Ollama model to chat with.
+        messages (list): The messages to send, from build_messages or
+            build_thread_messages.
+        thread (ChatThread): The thread the bot reply is saved to.
+        generation (generations.Generation): Stops the stream once set.
+        typed (bool): Yield events instead of text: the queue position,
+            tokens, and a final done event with usage stats or an error
+            event. Errors are then reported rather than raised.
+        queue_position (int): From admission.gate.check, for typed streams.
 
-    response = ""  # Store the partial response here
+    Returns:
+        Iterator[str]: The streamed response fragments, or Iterator[dict] of
+        events if typed.
+    """
 
     def stream():
-        nonlocal response
+        # Answer prompts seen before from the response cache, if enabled
+        cached = response_cache.lookup(
+            model_name, messages, lambda text: embed(text, thread.id)
+        )
+        if cached is not None and cached.parts is not None:
+            yield from replay_cached(cached.parts, thread, generation, typed)
+            return
+
+        reply = ReplyWriter(thread)
+        follower = None
+        host = "none"
+        usage = None
+        outcome = "completed"
+        message = None
         try:
-            for part in client.chat(model=model_name, messages=messages, stream=True):
-                if cancellation_event.is_set():
-                    print("Streaming cancelled.")
-                    break
-                response += part["message"]["content"]
-                yield part["message"]["content"]
+            if typed:
+                yield events.queue(queue_position)
+            # Share the model call with identical prompts running now
+            flight = singleflight.join(
+                response_cache.prompt_key(model_name, messages),
+                lambda flight: model_stream(model_name, messages, thread, flight),
+            )
+            follower = flight.follow(generation)
+            for part in follower:
+                if part.get("admitted"):
+                    if typed and queue_position:
+                        yield events.queue(0)
+                    continue
+                host = flight.host
+                if part.get("done"):
+                    usage = part
+                content = part["message"]["content"]
+                if reply.append(content):
+                    reply.checkpoint()
+                if not typed:
+                    yield content
+                elif content:
+                    yield events.token(content)
+            if generation.is_set():
+                print("Streaming cancelled.")
+                outcome = "cancelled"
+        except GeneratorExit:
+            print("Client disconnected, streaming stopped.")
+            outcome = "disconnected"
+            raise
         except Exception as e:
             print(f"Streaming error: {e}")
-            if response:
-                ChatMessage.objects.create(
-                    thread=thread, sender="bot", content=response
-                )
+            outcome = "error"
+            if not typed:
+                raise
+        finally:
+            if follower is not None:
+                follower.close()
+            generations.finish(generation)
+            if reply:
+                with metrics.saving(model_name, host):
+                    message = reply.finish()
+        # Only once Ollama sent its final chunk, so the reply is not cut short
+        if outcome == "completed" and usage is not None:
+            response_cache.store(cached, reply.parts)
+        if typed:
+            yield finished_event(outcome, usage, len(reply.parts), message)
+
+    return stream()
+
+
+def astream_response(
+    model_name, messages, thread, generation, typed=False, queue_position=0
+):
+    """
+    Async counterpart of stream_response for the ASGI application.
+
+    Tokens are pulled from the Ollama AsyncClient and the bot reply is saved
+    with the async ORM, so an in-flight generation does not hold a worker
+    thread while waiting on the model. When the client disconnects, the ASGI
+    handler cancels the stream; the partial reply is saved and the model
+    call stops unless other requests still read it. Checkpoints, the
+    response cache and shared model calls work as in stream_response.
+
+    Args:
+        model_name (str): The Ollama model to chat with.
+        messages (list): The messages to send, from build_messages or
+            build_thread_messages.
+        thread (ChatThread): The thread the bot reply is saved to.
+        generation (generations.Generation): Stops the stream once set.
+        typed (bool): Yield events instead of text, as in stream_response.
+        queue_position (int): From admission.gate.check, for typed streams.
+
+    Returns:
+        AsyncIterator[str]: The streamed response fragments, or
+        AsyncIterator[dict] of events if typed.
+    """
+
+    async def stream():
+        # Answer prompts seen before from the response cache, if enabled
+        cached = await response_cache.alookup(
+            model_name, messages, lambda text: aembed(text, thread.id)
+        )
+        if cached is not None and cached.parts is not None:
+            replay = areplay_cached(cached.parts, thread, generation, typed)
+            try:
+                async for item in replay:
+                    yield item
+            finally:
+                await replay.aclose()
+            return
+
+        reply = ReplyWriter(thread)
+        follower = None
+        host = "none"
+        usage = None
+        outcome = "completed"
+        message = None
+        try:
+            if typed:
+                yield events.queue(queue_position)
+            # Share the model call with identical prompts running now
+            flight = singleflight.ajoin(
+                response_cache.prompt_key(model_name, messages),
+                lambda flight: amodel_stream(model_name, messages, thread, flight),
+            )
+            follower = flight.afollow(generation)
+            async for part in follower:
+                if part.get("admitted"):
+                    if typed and queue_position:
+                        yield events.queue(0)
+                    continue
+                host = flight.host
+                if part.get("done"):
+                    usage = part
+                content = part["message"]["content"]
+                if reply.append(content):
+                    await reply.acheckpoint()
+                if not typed:
+                    yield content
+                elif content:
+                    yield events.token(content)
+            if await generation.ais_set():
+                print("Streaming cancelled.")
+                outcome = "cancelled"
+        except (GeneratorExit, asyncio.CancelledError):
+            print("Client disconnected, streaming stopped.")
+            outcome = "disconnected"
             raise
-        else:
-            if response:
-                ChatMessage.objects.create(
-                    thread=thread, sender="bot", content=response
-                )
+        except Exception as e:
+            print(f"Streaming error: {e}")
+            outcome = "error"
+            if not typed:
+                raise
+        finally:
+            if follower is not None:
+                await follower.aclose()
+            generations.finish(generation)
+            if reply:
+                with metrics.saving(model_name, host):
+                    message = await reply.afinish()
+        # Only once Ollama sent its final chunk, so the reply is not cut short
+        if outcome == "completed" and usage is not None:
+            response_cache.store(cached, reply.parts)
+        if typed:
+            yield finished_event(outcome, usage, len(reply.parts), message)
 
     return stream()
 
 
-def save_user_message(thread, user_message):
+def get_last_user_message(user_message):
     """
-    Saves the user message to the ChatMessage model.
+    Extract the latest user turn from a newline-joined context string.
 
-    Parameters:
-    thread (ChatThread): The chat thread where the messages should be saved.
-    user_message (str): The user's input message containing both user and bot content.
+    Args:
+        user_message (str): The user's input message containing both user and bot content.
+
+    Returns:
+        str: The content of the last "user:" line, or an empty string.
     """
 
     # Safely handle user_message
@@ -118,7 +736,102 @@ def save_user_message(thread, user_message):
             last_user_message = msg[len("user:") :].strip()
             break
 
-    ChatMessage.objects.create(thread=thread, sender="user", content=last_user_message)
+    return last_user_message
+
+
+def save_user_message(thread, user_message):
+    """
+    Saves the user message to the ChatMessage model.
+
+    Parameters:
+    thread (ChatThread): The chat thread where the messages should be saved.
+    user_message (str): The user's input message containing both user and bot content.
+    """
+
+    last_user_message = get_last_user_message(user_message)
+
+    save_message(thread, "user", last_user_message)
+
+
+async def asave_user_message(thread, user_message):
+    """
+    Async counterpart of save_user_message.
+    """
+    last_user_message = get_last_user_message(user_message)
+
+    await asave_message(thread, "user", last_user_message)
+
+
+def save_message(thread, sender, content):
+    """
+    Saves a message to the ChatMessage model and the thread's cached history.
+
+    Parameters:
+    thread (ChatThread): The chat thread the message belongs to.
+    sender (str): "user" or "bot".
+    content (str): The message text, stored as-is.
+
+    With write_behind on, the message is queued instead and returned
+    unsaved, without an id.
+    """
+    if write_behind.WRITE_BEHIND:
+        message = write_behind.add(thread, sender, content)
+    else:
+        message = ChatMessage.objects.create(
+            thread=thread, sender=sender, content=content
+        )
+    conversations.append_message(thread.id, message.id, sender, content)
+    return message
+
+
+async def asave_message(thread, sender, content):
+    """
+    Async counterpart of save_message.
+    """
+    if write_behind.WRITE_BEHIND:
+        # Appending to the spool does not wait on the database
+        message = write_behind.add(thread, sender, content)
+    else:
+        message = await ChatMessage.objects.acreate(
+            thread=thread, sender=sender, content=content
+        )
+    await conversations.aappend_message(thread.id, message.id, sender, content)
+    return message
+
+
+def prepare_turn(thread, user_message, model_name, server_history=False):
+    """
+    Save the new user turn and build the messages to send to the model.
+
+    Args:
+        thread (ChatThread): The chat thread of the request.
+        user_message (str): The request's "message" value.
+        model_name (str): The Ollama model the messages are for.
+        server_history (bool): If True, user_message is only the new turn and
+            the conversation is assembled from the thread's stored messages.
+            Otherwise it is the newline-joined transcript sent by the client.
+
+    Returns:
+        list: Message dictionaries with 'role' and 'content'.
+    """
+    if server_history:
+        save_message(thread, "user", user_message)
+        return build_thread_messages(thread, model_name)
+
+    save_user_message(thread, user_message)
+    return build_messages(user_message, model_name)
+
+
+async def aprepare_turn(thread, user_message, model_name, server_history=False):
+    """
+    Async counterpart of prepare_turn.
+    """
+    if server_history:
+        await asave_message(thread, "user", user_message)
+        return await abuild_thread_messages(thread, model_name)
+
+    await asave_user_message(thread, user_message)
+    return build_messages(user_message, model_name)
 
 
 def get_thread(thread_id, user):
@@ -128,6 +841,13 @@ def get_thread(thread_id, user):
         raise Http404("ChatThread does not exist.")
 
 
+async def aget_thread(thread_id, user):
+    try:
+        return await aget_object_or_404(ChatThread, id=int(thread_id), user=user)
+    except Http404:
+        raise Http404("ChatThread does not exist.")
+
+
 def break_context_into_messages(context_str):
     """
     Convert a context string into a list of messages.
@@ -0,0 +1,63 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(value, pk):
+    """
+    Encode a (datetime, id) keyset position as an opaque URL-safe cursor.
+    """
+    raw = f"{value.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, pk = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(value), int(pk)
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """
+    Parse a ``limit`` query parameter, clamped to 1..MAX_PAGE_SIZE.
+
+    Raises:
+        ValueError: If the value is not an integer.
+    """
+    if value in (None, ""):
+        return default
+    return max(1, min(int(value), MAX_PAGE_SIZE))
+
+
+def after(queryset, field, cursor):
+    """
+    Rows strictly after the cursor position in (field, id) order.
+    """
+    value, pk = decode_cursor(cursor)
+    return queryset.filter(
+        Q(**{f"{field}__gt": value}) | Q(**{field: value, "id__gt": pk})
+    )
+
+
+def before(queryset, field, cursor):
+    """
+    Rows strictly before the cursor position in (field, id) order.
+    """
+    value, pk = decode_cursor(cursor)
+    return queryset.filter(
+        Q(**{f"{field}__lt": value}) | Q(**{field: value, "id__lt": pk})
+    )
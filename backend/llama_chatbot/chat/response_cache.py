@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+
+try:
+    import numpy as np
+except ImportError:  # Only the semantic tier needs it
+    np = None
+
+logger = logging.getLogger("chat")
+
+# Replies kept for prompts seen before, least recently used out first.
+# 0 turns the response cache off.
+RESPONSE_CACHE_SIZE = int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = float(os.getenv("CHAT_RESPONSE_CACHE_TTL", "3600"))
+# Tokens per second a cached reply is streamed at, so it reads like a
+# generated one. 0 sends it at once.
+RESPONSE_CACHE_PACE = float(os.getenv("CHAT_RESPONSE_CACHE_PACE", "50"))
+
+# Optional semantic tier: the Ollama embedding model used to match short
+# single-turn prompts worded differently from a cached one. Off when unset.
+SEMANTIC_CACHE_MODEL = os.getenv("CHAT_SEMANTIC_CACHE_MODEL") or None
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("CHAT_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("CHAT_SEMANTIC_CACHE_SIZE", "1000"))
+SEMANTIC_CACHE_MAX_CHARS = int(os.getenv("CHAT_SEMANTIC_CACHE_MAX_CHARS", "300"))
+
+LOOKUPS = metrics.Counter(
+    "chat_response_cache_lookups_total",
+    "Response cache lookups by result: exact, semantic or miss.",
+    ("model", "result"),
+)
+
+
+def normalize(text):
+    return " ".join(text.split()).casefold()
+
+
+def prompt_key(model_name, messages):
+    """
+    Hash a prompt, ignoring case and whitespace differences.
+    """
+    payload = json.dumps(
+        [model_name, [[m["role"], normalize(m["content"])] for m in messages]],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    In-process LRU of reply fragments by prompt key, with a TTL.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, parts = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return parts
+
+    def set(self, key, parts):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, tuple(parts))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SemanticIndex:
+    """
+    Unit-length prompt embeddings in one preallocated matrix, searched by
+    cosine similarity. Once full, the oldest row is overwritten.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.vectors = None  # Allocated once the dimension is known
+        self.keys = [None] * capacity
+        self.count = 0
+        self._next = 0
+
+    def add(self, vector, key):
+        if self.vectors is None:
+            self.vectors = np.zeros((self.capacity, len(vector)), dtype=np.float32)
+        elif len(vector) != self.vectors.shape[1]:
+            return  # The embedding model changed
+        self.vectors[self._next] = vector
+        self.keys[self._next] = key
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def search(self, vector):
+        """
+        Returns:
+            tuple: (key, similarity) of the closest prompt, or (None, 0.0).
+        """
+        if not self.count or len(vector) != self.vectors.shape[1]:
+            return None, 0.0
+        scores = self.vectors[: self.count] @ vector
+        best = int(np.argmax(scores))
+        return self.keys[best], float(scores[best])
+
+
+_exact = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+_lock = threading.Lock()
+_indexes = {}  # Hash of the model and system prompt -> SemanticIndex
+
+
+class Lookup:
+    """
+    The result of looking a prompt up. ``parts`` holds the cached reply's
+    fragments on a hit; on a miss, pass the lookup to store() with the reply.
+    """
+
+    __slots__ = ("model_name", "key", "namespace", "embedding", "parts")
+
+    def __init__(self, model_name, key):
+        self.model_name = model_name
+        self.key = key
+        self.namespace = None
+        self.embedding = None
+        self.parts = None
+
+
+def semantic_prompt(messages):
+    """
+    Return the user turn of a short single-turn prompt, else None.
+    """
+    if SEMANTIC_CACHE_MODEL is None or np is None:
+        return None
+    turns = [m for m in messages if m["role"] != "system"]
+    if len(turns) != 1 or turns[0]["role"] != "user":
+        return None
+    content = turns[0]["content"]
+    return content if len(content) <= SEMANTIC_CACHE_MAX_CHARS else None
+
+
+def _begin(model_name, messages):
+    if not RESPONSE_CACHE_SIZE:
+        return None
+    result = Lookup(model_name, prompt_key(model_name, messages))
+    result.parts = _exact.get(result.key)
+    if result.parts is not None:
+        LOOKUPS.inc(model_name, "exact")
+    return result
+
+
+def _match(result, messages, embedding):
+    system = [m for m in messages if m["role"] == "system"]
+    result.namespace = prompt_key(result.model_name, system)
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm:
+        result.embedding = vector = vector / norm
+        with _lock:
+            index = _indexes.get(result.namespace)
+            key, score = index.search(vector) if index is not None else (None, 0.0)
+        if key is not None and score >= SEMANTIC_CACHE_THRESHOLD:
+            result.parts = _exact.get(key)
+    LOOKUPS.inc(result.model_name, "miss" if result.parts is None else "semantic")
+    return result
+
+
+def lookup(model_name, messages, embed):
+    """
+    Look a prompt up, by exact match and then, for short single-turn
+    prompts, by meaning.
+
+    Args:
+        model_name (str): The model the prompt is for.
+        messages (list): The messages that would be sent to the model.
+        embed (callable): Returns the embedding of a string.
+
+    Returns:
+        Lookup: Or None if the response cache is off.
+    """
+    result = _begin(model_name, messages)
+    if result is None or result.parts is not None:
+        return result
+    prompt = semantic_prompt(messages)
+    if prompt is None:
+        LOOKUPS.inc(model_name, "miss")
+        return result
+    try:
+        embedding = embed(prompt)
+    except Exception as e:
+        logger.warning(f"Could not embed prompt for the response cache: {e}")
+        LOOKUPS.inc(model_name, "miss")
+        return result
+    return _match(result, messages, embedding)
+
+
+async def alookup(model_name, messages, aembed):
+    """
+    Async counterpart of lookup, with an async ``aembed``.
+    """
+    result = _begin(model_name, messages)
+    if result is None or result.parts is not None:
+        return result
+    prompt = semantic_prompt(messages)
+    if prompt is None:
+        LOOKUPS.inc(model_name, "miss")
+        return result
+    try:
+        embedding = await aembed(prompt)
+    except Exception as e:
+        logger.warning(f"Could not embed prompt for the response cache: {e}")
+        LOOKUPS.inc(model_name, "miss")
+        return result
+    return _match(result, messages, embedding)
+
+
+def store(result, parts):
+    """
+    Cache a complete reply under a missed lookup.
+    """
+    if result is None or result.parts is not None or not "".join(parts).strip():
+        return
+    _exact.set(result.key, parts)
+    if result.embedding is not None:
+        with _lock:
+            index = _indexes.get(result.namespace)
+            if index is None:
+                index = _indexes[result.namespace] = SemanticIndex(SEMANTIC_CACHE_SIZE)
+            index.add(result.embedding, result.key)
+
+
+def paced(parts):
+    """
+    Yield cached fragments at RESPONSE_CACHE_PACE per second.
+    """
+    delay = 1 / RESPONSE_CACHE_PACE if RESPONSE_CACHE_PACE > 0 else 0
+    for i, part in enumerate(parts):
+        if i and delay:
+            time.sleep(delay)
+        yield part
+
+
+async def apaced(parts):
+    """
+    Async counterpart of paced.
+    """
+    delay = 1 / RESPONSE_CACHE_PACE if RESPONSE_CACHE_PACE > 0 else 0
+    for i, part in enumerate(parts):
+        if i and delay:
+            await asyncio.sleep(delay)
+        yield part
+
+
+def clear():
+    _exact.clear()
+    with _lock:
+        _indexes.clear()
@@ -0,0 +1,321 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import close_old_connections
+
+# Bytes of each generation kept for replay; older output is dropped first
+RESUME_BUFFER_BYTES = int(os.getenv("CHAT_RESUME_BUFFER_BYTES", str(256 * 1024)))
+# Seconds a generation nobody is reading keeps its model stream open for a
+# reconnect before it is stopped and saved, like a disconnect used to
+RESUME_GRACE = float(os.getenv("CHAT_RESUME_GRACE", "15"))
+# Seconds a finished generation stays available for replay
+RESUME_TTL = float(os.getenv("CHAT_RESUME_TTL", "60"))
+
+_lock = threading.Lock()
+_streams = {}
+
+
+class OffsetGone(Exception):
+    """
+    Raised when a replay starts before the oldest buffered byte.
+    """
+
+
+def _encode(chunk):
+    return chunk.encode() if isinstance(chunk, str) else chunk
+
+
+class ReplayStream:
+    """
+    A generation's output kept in a bounded buffer that readers can join at
+    any byte offset.
+
+    Readers pull the model stream themselves, one at a time, so a generation
+    advances as fast as its fastest reader and no extra thread is needed.
+    When the last reader leaves, e.g. because the connection dropped, the
+    model stream is kept open for ``grace`` seconds so a reconnect can pick
+    up where it left off, then closed.
+    """
+
+    def __init__(
+        self,
+        generation_id,
+        thread_id,
+        upstream,
+        max_bytes,
+        grace,
+        content_type="text/plain",
+    ):
+        self.id = generation_id
+        self.thread_id = thread_id
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.start = 0  # Offset of the oldest buffered byte
+        self.end = 0  # Offset after the newest buffered byte
+        self.done = False
+        self.finished_at = None
+        self.readers = 0
+        self._upstream = upstream
+        self._chunks = deque()  # (offset, bytes)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def check(self, offset):
+        """
+        Raises:
+            OffsetGone: If the bytes at offset are no longer buffered.
+            ValueError: If offset is past what was generated so far.
+        """
+        with self._lock:
+            if offset < self.start:
+                raise OffsetGone(f"Output before byte {self.start} was dropped")
+            if offset > self.end:
+                raise ValueError("Offset past the end of the output")
+
+    def _append(self, chunk):
+        if not chunk:
+            return
+        with self._lock:
+            self._chunks.append((self.end, chunk))
+            self.end += len(chunk)
+            self._size += len(chunk)
+            while self._size > self.max_bytes and len(self._chunks) > 1:
+                _, dropped = self._chunks.popleft()
+                self._size -= len(dropped)
+                self.start = self._chunks[0][0]
+
+    def _read(self, offset):
+        with self._lock:
+            if offset < self.start:
+                raise OffsetGone(f"Output before byte {self.start} was dropped")
+            if offset >= self.end:
+                return b""
+            parts = []
+            for start, chunk in self._chunks:
+                if start + len(chunk) <= offset:
+                    continue
+                parts.append(chunk[max(offset - start, 0) :])
+            return b"".join(parts)
+
+    def _attach(self):
+        with self._lock:
+            self.readers += 1
+
+    def _detach(self):
+        with self._lock:
+            self.readers -= 1
+            return self.readers == 0 and not self.done
+
+    def _finish(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._upstream = None
+
+
+class SyncReplayStream(ReplayStream):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pump = threading.Lock()
+
+    def follow(self, offset=0):
+        """
+        Yield the output from a byte offset on, then the live tail.
+        """
+        self._attach()
+        try:
+            while True:
+                data = self._read(offset)
+                if data:
+                    offset += len(data)
+                    yield data
+                    continue
+                if self.done:
+                    return
+                with self._pump:
+                    # Another reader may have pulled while this one waited
+                    if self.done or self.end > offset:
+                        continue
+                    try:
+                        chunk = next(self._upstream)
+                    except StopIteration:
+                        self._finish()
+                        continue
+                    except BaseException:
+                        self._finish()
+                        raise
+                    self._append(_encode(chunk))
+        finally:
+            if self._detach():
+                if self.grace > 0:
+                    timer = threading.Timer(self.grace, self._reap)
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self.close()
+
+    def close(self):
+        """
+        Stop the generation; its stream saves what it produced so far.
+        """
+        with self._pump:
+            if not self.done:
+                self._upstream.close()
+                self._finish()
+
+    def _reap(self):
+        if self.readers == 0 and not self.done:
+            try:
+                self.close()
+            finally:
+                close_old_connections()
+
+
+class AsyncReplayStream(ReplayStream):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pump = asyncio.Lock()
+        self._pending = None
+
+    async def afollow(self, offset=0):
+        """
+        Async counterpart of SyncReplayStream.follow.
+        """
+        self._attach()
+        try:
+            while True:
+                data = self._read(offset)
+                if data:
+                    offset += len(data)
+                    yield data
+                    continue
+                if self.done:
+                    return
+                async with self._pump:
+                    if self.done or self.end > offset:
+                        continue
+                    if self._pending is None:
+                        self._pending = asyncio.ensure_future(
+                            self._upstream.__anext__()
+                        )
+                    # A reader cancelled on disconnect must not cancel the
+                    # model stream, so the pull runs in its own task
+                    try:
+                        chunk = await asyncio.shield(self._pending)
+                    except StopAsyncIteration:
+                        self._pending = None
+                        self._finish()
+                        continue
+                    except asyncio.CancelledError:
+                        # Unless the pull itself was cancelled, leave it to
+                        # the next reader
+                        if self._pending.cancelled():
+                            self._pending = None
+                            self._finish()
+                        raise
+                    except BaseException:
+                        self._pending = None
+                        self._finish()
+                        raise
+                    self._pending = None
+                    self._append(_encode(chunk))
+        finally:
+            if self._detach():
+                if self.grace > 0:
+                    loop = asyncio.get_running_loop()
+                    loop.call_later(self.grace, lambda: loop.create_task(self._areap()))
+                else:
+                    await self.aclose()
+
+    async def aclose(self):
+        """
+        Stop the generation; its stream saves what it produced so far.
+        """
+        async with self._pump:
+            if self.done:
+                return
+            upstream = self._upstream
+            if self._pending is not None:
+                self._pending.cancel()
+                try:
+                    await self._pending
+                except BaseException:
+                    pass
+                self._pending = None
+            self._finish()
+            await upstream.aclose()
+
+    async def _areap(self):
+        if self.readers == 0 and not self.done:
+            await self.aclose()
+
+
+def _register(stream):
+    now = time.monotonic()
+    with _lock:
+        for generation_id, old in list(_streams.items()):
+            if old.done and now - old.finished_at > RESUME_TTL:
+                del _streams[generation_id]
+        _streams[stream.id] = stream
+    return stream
+
+
+def start(generation, upstream, content_type="text/plain"):
+    """
+    Make a generation's stream resumable.
+
+    Args:
+        generation (generations.Generation): The generation being streamed.
+        upstream (Iterator[str]): From ollama_utils.stream_response, or
+            encoded events.
+        content_type (str): Served again when the stream is resumed.
+
+    Returns:
+        SyncReplayStream: Read it with follow().
+    """
+    return _register(
+        SyncReplayStream(
+            generation.id,
+            generation.thread_id,
+            upstream,
+            RESUME_BUFFER_BYTES,
+            RESUME_GRACE,
+            content_type,
+        )
+    )
+
+
+def astart(generation, upstream, content_type="text/plain"):
+    """
+    Async counterpart of start, for ollama_utils.astream_response.
+
+    Returns:
+        AsyncReplayStream: Read it with afollow().
+    """
+    return _register(
+        AsyncReplayStream(
+            generation.id,
+            generation.thread_id,
+            upstream,
+            RESUME_BUFFER_BYTES,
+            RESUME_GRACE,
+            content_type,
+        )
+    )
+
+
+def get(generation_id):
+    """
+    Return a generation's stream if it is running or finished recently in
+    this process, else None.
+    """
+    with _lock:
+        stream = _streams.get(generation_id)
+    if stream is None:
+        return None
+    if stream.done and time.monotonic() - stream.finished_at > RESUME_TTL:
+        return None
+    return stream
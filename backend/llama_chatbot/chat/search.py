@@ -0,0 +1,176 @@
+import re
+
+from django.db import connection
+
+from .models import ChatMessage
+
+# Full-text index of ChatMessage.content, created by migrations 0005 and
+# 0006: an FTS5 table on SQLite, a trigger-maintained tsvector column with
+# a GIN index on PostgreSQL. Both are kept in sync by the database on every
+# insert, update and delete, including bulk and cascading ones.
+FTS_TABLE = "chat_message_fts"
+TSVECTOR_COLUMN = "search_vector"
+TEXT_SEARCH_CONFIG = "english"
+# Every message is also indexed with this token for its user. Searches
+# match it with their terms, so their cost follows the user's matches,
+# not everyone's.
+OWNER_TOKEN = "owner{user_id}"
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+# Deeper pages cost more with every row skipped
+MAX_OFFSET = 1000
+
+# Words of context in a snippet
+SNIPPET_WORDS = 16
+# Private-use characters marking matched terms in snippets. segments()
+# splits on them, so message text never reaches clients as markup.
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+# Ranked by the content column only. ORDER BY rank lets FTS5 sort, so
+# snippets are only made for the rows returned.
+_SQLITE_SQL = f"""
+    SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', {SNIPPET_WORDS})
+    FROM {FTS_TABLE}
+    WHERE {FTS_TABLE} MATCH %s AND rank MATCH 'bm25(1.0, 0.0)'
+    ORDER BY rank
+    LIMIT %s OFFSET %s
+"""
+
+# The owner token is weight D, message text weight A
+_POSTGRES_SQL = f"""
+    SELECT m.id, ts_headline(
+               '{TEXT_SEARCH_CONFIG}', m.content, q,
+               'StartSel=' || %s || ', StopSel=' || %s || ', '
+               || 'MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}'
+           )
+    FROM chat_chatmessage m,
+         websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', %s) q,
+         to_tsquery('simple', %s || ':D') owner
+    WHERE numnode(q) > 0 AND m.{TSVECTOR_COLUMN} @@ (q && owner)
+    ORDER BY ts_rank_cd(m.{TSVECTOR_COLUMN}, q) DESC, m.id DESC
+    LIMIT %s OFFSET %s
+"""
+
+
+def fts_query(text, user_id=None):
+    """
+    Turn free text into an FTS5 query matching all of its words, the last
+    one also as a prefix, so any input is valid query syntax.
+
+    Args:
+        text (str): The search text.
+        user_id (int): If given, only this user's messages match.
+
+    Returns:
+        str: The query, or "" if the text has no words.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    query = " ".join(terms)
+    if user_id is None:
+        return query
+    owner = OWNER_TOKEN.format(user_id=user_id)
+    return f'owner : "{owner}" AND content : ({query})'
+
+
+def segments(snippet):
+    """
+    Split a marked snippet into [{"text": ..., "match": bool}, ...].
+    """
+    parts = []
+    for i, piece in enumerate(re.split(f"[{MATCH_START}{MATCH_END}]", snippet)):
+        if piece:
+            parts.append({"text": piece, "match": i % 2 == 1})
+    return parts
+
+
+def _fallback_snippet(content, words):
+    # Around the first match, as the index would cut it
+    lowered = content.lower()
+    at = min((lowered.find(w) for w in words if w in lowered), default=0)
+    tokens = content[at:].split()
+    snippet = " ".join(tokens[:SNIPPET_WORDS])
+    for word in words:
+        snippet = re.sub(
+            f"({re.escape(word)})",
+            f"{MATCH_START}\\1{MATCH_END}",
+            snippet,
+            flags=re.IGNORECASE,
+        )
+    return ("…" if at else "") + snippet
+
+
+def _fallback(user_id, text, offset, limit):
+    # Other databases have no index set up: scan, newest first
+    words = [w.lower() for w in re.findall(r"\w+", text)]
+    if not words:
+        return []
+    messages = ChatMessage.objects.filter(thread__user_id=user_id)
+    for word in words:
+        messages = messages.filter(content__icontains=word)
+    rows = messages.order_by("-created_at", "-id").values_list("id", "content")
+    return [
+        (message_id, _fallback_snippet(content, words))
+        for message_id, content in rows[offset : offset + limit]
+    ]
+
+
+def search(user_id, text, offset=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Find a user's messages matching free text, best match first.
+
+    Args:
+        user_id (int): Only this user's threads are searched.
+        text (str): The search text.
+        offset (int): Matches to skip.
+        limit (int): Most matches returned.
+
+    Returns:
+        list: Dicts with message_id, thread_id, thread_title, sender,
+        created_at and snippet, as segments().
+    """
+    owner = OWNER_TOKEN.format(user_id=user_id)
+    if connection.vendor == "sqlite":
+        query = fts_query(text, user_id)
+        params = [MATCH_START, MATCH_END, query, limit, offset]
+        sql = _SQLITE_SQL
+    elif connection.vendor == "postgresql":
+        query = text
+        params = [MATCH_START, MATCH_END, query, owner, limit, offset]
+        sql = _POSTGRES_SQL
+    else:
+        query = None
+
+    if query is None:
+        rows = _fallback(user_id, text, offset, limit)
+    elif not query.strip():
+        rows = []
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+    # The page's other fields by primary key, typed by the ORM
+    found = {
+        row["id"]: row
+        for row in ChatMessage.objects.filter(
+            id__in=[r[0] for r in rows], thread__user_id=user_id
+        ).values("id", "thread_id", "thread__title", "sender", "created_at")
+    }
+    return [
+        {
+            "message_id": message_id,
+            "thread_id": found[message_id]["thread_id"],
+            "thread_title": found[message_id]["thread__title"],
+            "sender": found[message_id]["sender"],
+            "created_at": found[message_id]["created_at"],
+            "snippet": segments(snippet),
+        }
+        for message_id, snippet in rows
+        if message_id in found
+    ]
@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import thread_cache
+from .models import ChatMessage, ChatThread
+
+
+def _deleted_directly(origin):
+    # Not with their thread or its user, which take the summary with them
+    if isinstance(origin, QuerySet):
+        return origin.model is ChatMessage
+    return isinstance(origin, ChatMessage)
+
+
+def _invalidate_thread_list(user_id):
+    # After the commit, so a concurrent list request cannot cache the old
+    # rows under the new version
+    transaction.on_commit(lambda: thread_cache.invalidate(user_id))
+
+
+@receiver(post_save, sender=ChatThread)
+@receiver(post_delete, sender=ChatThread)
+def thread_changed(sender, instance, **kwargs):
+    """
+    Replace the user's thread list version whenever a thread is written,
+    from the views, the admin or anywhere else.
+    """
+    _invalidate_thread_list(instance.user_id)
+
+
+@receiver(post_save, sender=ChatMessage)
+def message_saved(sender, instance, **kwargs):
+    """
+    A new or edited message changes its thread's summary in the list.
+    """
+    if ChatMessage.thread.is_cached(instance):
+        user_id = instance.thread.user_id
+    else:
+        user_id = (
+            ChatThread.objects.filter(pk=instance.thread_id)
+            .values_list("user_id", flat=True)
+            .first()
+        )
+    if user_id is not None:
+        _invalidate_thread_list(user_id)
+
+
+@receiver(post_delete, sender=ChatMessage)
+def refresh_thread_summary(sender, instance, origin=None, **kwargs):
+    """
+    Recompute a thread's message summary after messages were deleted on
+    their own, e.g. from the admin. Saving the thread also replaces the
+    user's thread list version.
+    """
+    if not _deleted_directly(origin):
+        return
+    thread = ChatThread.objects.filter(pk=instance.thread_id).first()
+    if thread is None:
+        return
+    thread.refresh_summary()
@@ -0,0 +1,452 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+
+logger = logging.getLogger("chat")
+
+# Requests for the same prompt that run at once share one model call.
+# 0 gives every request its own.
+SINGLE_FLIGHT = os.getenv("CHAT_SINGLE_FLIGHT", "1") != "0"
+
+# Optional cross-process mode: the Django cache alias through which worker
+# processes share model calls. Off when unset.
+SINGLE_FLIGHT_ALIAS = os.getenv("CHAT_SINGLE_FLIGHT_ALIAS") or None
+# How often a subscriber in another process polls for new output, which is
+# also how often the leading process publishes it
+SINGLE_FLIGHT_POLL_INTERVAL = float(
+    os.getenv("CHAT_SINGLE_FLIGHT_POLL_INTERVAL", "0.05")
+)
+# Seconds without new output after which such a subscriber gives up
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("CHAT_SINGLE_FLIGHT_TIMEOUT", "60"))
+# Lifetime of the shared keys, longer than any generation
+SHARED_KEY_TIMEOUT = 600
+# Lifetime of a prompt's election key, which its leader refreshes while
+# publishing, so a leader that died holds the prompt only this long
+ELECTION_TIMEOUT = 30
+# Seconds a subscriber in another process waits for the leader's first
+# state, which is published just after its election
+SHARED_START_TIMEOUT = 5
+
+# Yielded by a model call once it got a model call slot
+ADMITTED = {"admitted": True}
+
+_lock = threading.Lock()
+_flights = {}
+
+
+class FlightError(Exception):
+    """
+    Raised to subscribers in other processes when the shared model call
+    stopped early or stopped publishing.
+    """
+
+
+def _shared_cache():
+    return caches[SINGLE_FLIGHT_ALIAS] if SINGLE_FLIGHT_ALIAS else None
+
+
+def _election_key(key):
+    return f"chat:flight:{key}"
+
+
+def _state_key(flight_id):
+    return f"chat:flight-state:{flight_id}"
+
+
+def _batch_key(flight_id, batch):
+    return f"chat:flight-batch:{flight_id}:{batch}"
+
+
+def _portable(part):
+    # Model chunks as plain dicts, so they can go through the cache
+    return part if isinstance(part, dict) else part.model_dump(exclude_none=True)
+
+
+class Publisher:
+    """
+    Copies a flight's chunks to the shared cache in batches, for subscribers
+    in other processes.
+    """
+
+    def __init__(self, cache, key, flight_id):
+        self.cache = cache
+        self.key = key
+        self.flight_id = flight_id
+        self.batches = 0
+        self._pending = []
+        self._next_publish = 0
+        self._next_refresh = 0
+
+    def add(self, part):
+        self._pending.append(_portable(part))
+        if time.monotonic() >= self._next_publish:
+            self.publish()
+
+    def publish(self, done=False, error=None):
+        try:
+            if self._pending:
+                self.cache.set(
+                    _batch_key(self.flight_id, self.batches),
+                    self._pending,
+                    SHARED_KEY_TIMEOUT,
+                )
+                self.batches += 1
+                self._pending = []
+            self.cache.set(
+                _state_key(self.flight_id),
+                {"batches": self.batches, "done": done, "error": error},
+                SHARED_KEY_TIMEOUT,
+            )
+            if done:
+                # Later requests for the prompt start a new model call
+                if self.cache.get(_election_key(self.key)) == self.flight_id:
+                    self.cache.delete(_election_key(self.key))
+            elif time.monotonic() >= self._next_refresh:
+                self.cache.touch(_election_key(self.key), ELECTION_TIMEOUT)
+                self._next_refresh = time.monotonic() + ELECTION_TIMEOUT / 3
+        except Exception as e:
+            logger.warning(f"Could not publish shared generation {self.flight_id}: {e}")
+        self._next_publish = time.monotonic() + SINGLE_FLIGHT_POLL_INTERVAL
+
+
+class Flight:
+    """
+    One model call shared by every request for the same prompt.
+
+    Like resumable.ReplayStream, subscribers pull the model stream
+    themselves, one at a time. Every chunk is kept, so a late subscriber
+    still gets the whole reply. The model call stops when its last
+    subscriber leaves; ``stop_reason`` then says why.
+    """
+
+    def __init__(self, key, publisher=None):
+        self.key = key
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.stop_reason = None
+        self.host = "none"
+        self.upstream = None
+        self._publisher = publisher
+
+    def _append(self, part):
+        self.parts.append(part)
+        if self._publisher is not None:
+            self._publisher.add(part)
+
+    def _finish(self, error=None):
+        self.done = True
+        self.error = error
+        self.upstream = None
+        with _lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        if self._publisher is not None:
+            if error is None and self.stop_reason is not None:
+                error = FlightError("The shared generation was stopped")
+            self._publisher.publish(done=True, error=str(error) if error else None)
+
+    def _leave(self, reason):
+        with _lock:
+            self.subscribers -= 1
+            if self.subscribers or self.done:
+                return False
+            # Nobody can join a flight that is being stopped
+            self.stop_reason = reason
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+            return True
+
+
+class SyncFlight(Flight):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pump = threading.Lock()
+
+    def follow(self, generation):
+        """
+        Yield the model chunks from the start until the call ends or the
+        generation is cancelled.
+        """
+        index = 0
+        reason = "disconnected"
+        try:
+            while True:
+                if generation.is_set():
+                    reason = "cancelled"
+                    return
+                if index < len(self.parts):
+                    index += 1
+                    yield self.parts[index - 1]
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                with self._pump:
+                    # Another subscriber may have pulled while this one waited
+                    if self.done or index < len(self.parts):
+                        continue
+                    try:
+                        part = next(self.upstream)
+                    except StopIteration:
+                        self._finish()
+                    except Exception as e:
+                        self._finish(e)
+                    else:
+                        self._append(part)
+        finally:
+            if self._leave(reason):
+                self.close()
+
+    def close(self):
+        with self._pump:
+            if not self.done:
+                self.upstream.close()
+                self._finish()
+
+
+class AsyncFlight(Flight):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pump = asyncio.Lock()
+        self._pending = None
+
+    async def afollow(self, generation):
+        """
+        Async counterpart of SyncFlight.follow.
+        """
+        index = 0
+        reason = "disconnected"
+        try:
+            while True:
+                if await generation.ais_set():
+                    reason = "cancelled"
+                    return
+                if index < len(self.parts):
+                    index += 1
+                    yield self.parts[index - 1]
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                async with self._pump:
+                    if self.done or index < len(self.parts):
+                        continue
+                    if self._pending is None:
+                        self._pending = asyncio.ensure_future(self.upstream.__anext__())
+                    # A subscriber cancelled on disconnect must not cancel
+                    # the model call the others are reading
+                    try:
+                        part = await asyncio.shield(self._pending)
+                    except StopAsyncIteration:
+                        self._pending = None
+                        self._finish()
+                    except asyncio.CancelledError:
+                        if self._pending.cancelled():
+                            self._pending = None
+                            self._finish()
+                        raise
+                    except Exception as e:
+                        self._pending = None
+                        self._finish(e)
+                    else:
+                        self._pending = None
+                        self._append(part)
+        finally:
+            if self._leave(reason):
+                await self.aclose()
+
+    async def aclose(self):
+        async with self._pump:
+            if self.done:
+                return
+            upstream = self.upstream
+            if self._pending is not None:
+                self._pending.cancel()
+                try:
+                    await self._pending
+                except BaseException:
+                    pass
+                self._pending = None
+            await upstream.aclose()
+            self._finish()
+
+
+class RemoteFlight:
+    """
+    A model call running in another process, read from the shared cache.
+    """
+
+    host = "none"
+
+    def __init__(self, cache, flight_id):
+        self.cache = cache
+        self.flight_id = flight_id
+
+    def _state(self, state, joined):
+        if state is None and time.monotonic() - joined < SHARED_START_TIMEOUT:
+            # Elected, but its first state is not published yet
+            return {"batches": 0, "done": False, "error": None}
+        return state
+
+    def _check(self, state, last_progress):
+        if state is None:
+            raise FlightError("The shared generation was lost")
+        if time.monotonic() - last_progress > SINGLE_FLIGHT_TIMEOUT:
+            raise FlightError("The shared generation stalled")
+
+    def follow(self, generation):
+        """
+        Yield the model chunks published so far, then poll for more.
+        """
+        batch = 0
+        joined = last_progress = time.monotonic()
+        while True:
+            state = self._state(self.cache.get(_state_key(self.flight_id)), joined)
+            self._check(state, last_progress)
+            while batch < state["batches"]:
+                parts = self.cache.get(_batch_key(self.flight_id, batch))
+                self._check(parts, last_progress)
+                batch += 1
+                last_progress = time.monotonic()
+                for part in parts:
+                    if generation.is_set():
+                        return
+                    yield part
+            if state["done"]:
+                if state["error"]:
+                    raise FlightError(state["error"])
+                return
+            if generation.is_set():
+                return
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+
+    async def afollow(self, generation):
+        """
+        Async counterpart of follow.
+        """
+        batch = 0
+        joined = last_progress = time.monotonic()
+        while True:
+            state = self._state(
+                await self.cache.aget(_state_key(self.flight_id)), joined
+            )
+            self._check(state, last_progress)
+            while batch < state["batches"]:
+                parts = await self.cache.aget(_batch_key(self.flight_id, batch))
+                self._check(parts, last_progress)
+                batch += 1
+                last_progress = time.monotonic()
+                for part in parts:
+                    if await generation.ais_set():
+                        return
+                    yield part
+            if state["done"]:
+                if state["error"]:
+                    raise FlightError(state["error"])
+                return
+            if await generation.ais_set():
+                return
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+
+
+def _subscribe(registry_key):
+    # Called with _lock held
+    flight = _flights.get(registry_key)
+    if flight is not None:
+        flight.subscribers += 1
+    return flight
+
+
+def _elect(shared, key):
+    """
+    Try to become the process that runs a prompt's model call.
+
+    Returns:
+        tuple: (Publisher, None) if elected, else (None, the leading flight
+        id or None if there is none or the cache is unreachable).
+    """
+    flight_id = str(uuid.uuid4())
+    try:
+        if shared.add(_election_key(key), flight_id, ELECTION_TIMEOUT):
+            publisher = Publisher(shared, key, flight_id)
+            # Subscribers in other processes can follow it from now on
+            publisher.publish()
+            return publisher, None
+        return None, shared.get(_election_key(key))
+    except Exception as e:
+        logger.warning(f"Could not reach the shared generation cache: {e}")
+        return None, None
+
+
+def _join(flight_class, key, start):
+    if not SINGLE_FLIGHT:
+        flight = flight_class(None)
+        flight.subscribers = 1
+        flight.upstream = start(flight)
+        return flight
+
+    registry_key = (flight_class, key)
+    with _lock:
+        flight = _subscribe(registry_key)
+    if flight is not None:
+        return flight
+
+    publisher = leader = None
+    shared = _shared_cache()
+    if shared is not None:
+        # Network calls, so not under _lock
+        publisher, leader = _elect(shared, key)
+
+    with _lock:
+        # Another request of this process may have started one meanwhile
+        flight = _subscribe(registry_key)
+        if flight is None and leader is None:
+            flight = flight_class(registry_key, publisher)
+            flight.subscribers = 1
+            flight.upstream = start(flight)
+            _flights[registry_key] = flight
+            return flight
+    if flight is None:
+        return RemoteFlight(shared, leader)
+    if publisher is not None:
+        publisher.publish(done=True, error="The shared generation was superseded")
+    return flight
+
+
+def join(key, start):
+    """
+    Subscribe to the running model call for a prompt, or start one.
+
+    Args:
+        key (str): The prompt's fingerprint, from response_cache.prompt_key.
+        start (callable): Takes the new flight and returns the model call's
+            chunk iterator, yielding ADMITTED once it has a model call slot.
+
+    Returns:
+        SyncFlight | RemoteFlight: Read it with follow(generation).
+    """
+    return _join(SyncFlight, key, start)
+
+
+def ajoin(key, start):
+    """
+    Async counterpart of join, for async chunk iterators.
+
+    Returns:
+        AsyncFlight | RemoteFlight: Read it with afollow(generation).
+    """
+    return _join(AsyncFlight, key, start)
+
+
+def clear():
+    with _lock:
+        _flights.clear()
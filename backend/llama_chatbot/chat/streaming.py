@@ -0,0 +1,132 @@
+import asyncio
+import os
+import time
+
+# Streamed tokens are written to the client in batches of up to this many
+# bytes, or after this many seconds, whichever comes first. 0 bytes writes
+# every token as its own chunk.
+FLUSH_BYTES = int(os.getenv("CHAT_STREAM_FLUSH_BYTES", "512"))
+FLUSH_INTERVAL = float(os.getenv("CHAT_STREAM_FLUSH_INTERVAL", "0.02"))
+
+
+def _encode(chunk):
+    return chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def coalesce(chunks, max_bytes=None, max_delay=None):
+    """
+    Batch a token stream into fewer, larger HTTP chunks.
+
+    The first token is sent right away so the time to first byte does not
+    change. Later tokens are buffered until ``max_bytes`` are pending or the
+    oldest has waited ``max_delay`` seconds. A sync stream only notices the
+    deadline when the next token arrives, so a stalled model delays the
+    buffered tokens until it resumes or finishes.
+
+    Closing the returned generator closes ``chunks``, so a client disconnect
+    still reaches the model stream.
+
+    Args:
+        chunks (Iterator[str]): The stream, as from ollama_utils.stream_response.
+        max_bytes (int): Defaults to CHAT_STREAM_FLUSH_BYTES.
+        max_delay (float): Defaults to CHAT_STREAM_FLUSH_INTERVAL.
+
+    Returns:
+        Iterator[bytes]: The batched stream.
+    """
+    max_bytes = FLUSH_BYTES if max_bytes is None else max_bytes
+    max_delay = FLUSH_INTERVAL if max_delay is None else max_delay
+    if max_bytes <= 0:
+        yield from (_encode(chunk) for chunk in chunks)
+        return
+
+    buffer = []
+    size = 0
+    deadline = None
+    first = True
+    try:
+        for chunk in chunks:
+            chunk = _encode(chunk)
+            if first:
+                first = False
+                yield chunk
+                continue
+            buffer.append(chunk)
+            size += len(chunk)
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + max_delay
+            if size >= max_bytes or now >= deadline:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+                deadline = None
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+async def acoalesce(chunks, max_bytes=None, max_delay=None):
+    """
+    Async counterpart of coalesce.
+
+    Waits for the next token only until the flush deadline, so buffered
+    tokens go out on time even while the model is slow.
+    """
+    max_bytes = FLUSH_BYTES if max_bytes is None else max_bytes
+    max_delay = FLUSH_INTERVAL if max_delay is None else max_delay
+
+    iterator = chunks.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending = None
+    buffer = []
+    size = 0
+    deadline = None
+    first = True
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if not buffer else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+                deadline = None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = _encode(task.result())
+            except StopAsyncIteration:
+                break
+            if first or max_bytes <= 0:
+                first = False
+                yield chunk
+                continue
+            buffer.append(chunk)
+            size += len(chunk)
+            if deadline is None:
+                deadline = loop.time() + max_delay
+            if size >= max_bytes:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+                deadline = None
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        if pending is not None:
+            # Lets the model stream see the cancellation and clean up
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
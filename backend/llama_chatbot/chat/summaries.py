@@ -0,0 +1,94 @@
+import logging
+import os
+
+from . import background, backends, conversations, ollama_clients
+from .models import ChatThread
+
+logger = logging.getLogger("chat")
+
+# Small Ollama model that summarizes turns dropped from a thread's prompt,
+# e.g. "llama3.2:1b". Off when unset: dropped turns are simply forgotten.
+SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL") or None
+# Longest summary the model may write, in tokens
+SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))
+
+SUMMARY_PROMPT = (
+    "You maintain the memory of a conversation between a user and an AI "
+    "assistant. Given the current summary and the turns that follow it, "
+    "write an updated summary in at most a few short paragraphs. Keep facts, "
+    "names, numbers, decisions, open questions and the user's preferences; "
+    "leave out greetings and filler. Reply with the summary only."
+)
+
+# Put after the system prompt, which stays the prompt's byte-identical start
+SUMMARY_HEADING = "\n\nSummary of the earlier conversation:\n"
+
+
+def system_message(system, summary):
+    """
+    Return the system message with a thread's summary appended.
+    """
+    return {"role": "system", "content": system["content"] + SUMMARY_HEADING + summary}
+
+
+def transcript(messages):
+    return "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+def schedule(thread_id, upto):
+    """
+    Queue a thread for summarizing its first ``upto`` messages.
+
+    Returns at once; background.worker calls the summary model. Does
+    nothing if summaries are off or the thread is already queued.
+    """
+    if SUMMARY_MODEL is not None:
+        background.submit(("summary", thread_id), summarize, thread_id, upto)
+
+
+def summarize(thread_id, upto):
+    """
+    Fold a thread's messages up to index ``upto`` into its stored summary.
+
+    Only the messages after those already summarized are sent, with the
+    current summary, so each message is summarized once. The summary is
+    saved only if no other summary was saved in the meantime.
+
+    Returns:
+        bool: Whether a new summary was saved.
+    """
+    state = (
+        ChatThread.objects.filter(id=thread_id)
+        .values("history_summary", "summarized_messages")
+        .first()
+    )
+    if state is None or state["summarized_messages"] >= upto:
+        return False
+    history = conversations.get_history(thread_id)
+    turns = history[state["summarized_messages"] : upto]
+    if not turns:
+        return False
+
+    prompt = transcript(turns)
+    if state["history_summary"]:
+        prompt = f"Current summary:\n{state['history_summary']}\n\nTurns:\n{prompt}"
+    with backends.pool.lease(thread_id) as backend:
+        client = ollama_clients.get_client(backend.host)
+        response = client.chat(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            options={"num_predict": SUMMARY_MAX_TOKENS},
+        )
+    summary = (response["message"]["content"] or "").strip()
+    if not summary:
+        return False
+
+    # A plain update: the summary must not bump the thread in the list
+    return bool(
+        ChatThread.objects.filter(
+            id=thread_id, summarized_messages=state["summarized_messages"]
+        ).update(history_summary=summary, summarized_messages=upto)
+    )
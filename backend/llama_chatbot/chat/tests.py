@@ -1,9 +1,43 @@
 from django.test import TestCase, Client
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.utils import timezone
-from .models import ChatThread, ChatMessage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .models import ChatThread, ChatMessage, MessageEmbedding
+from . import (
+    admission,
+    background,
+    backends,
+    conversations,
+    events,
+    fake_ollama,
+    metrics,
+    generations,
+    memory,
+    ollama_clients,
+    ollama_utils,
+    response_cache,
+    resumable,
+    search,
+    singleflight,
+    streaming,
+    summaries,
+    thread_cache,
+    websocket,
+    write_behind,
+)
+from .context_window import count_message_tokens, count_tokens, truncate_messages
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
 import json
+import ollama
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock, patch
 
 User = get_user_model()
 
@@ -91,3 +125,2181 @@ class ChatViewsTestCase(TestCase):
         )
         self.assertEqual(response.status_code, 400)
         self.assertEqual(json.loads(response.content)["error"], "Invalid JSON")
+
+
+class FakeAsyncOllamaClient:
+    def __init__(self, parts):
+        self.parts = parts
+
+    async def chat(self, model, messages, stream=False, **options):
+        async def generate():
+            # Ollama marks its final chunk done
+            for i, part in enumerate(self.parts, 1):
+                yield {"message": {"content": part}, "done": i == len(self.parts)}
+
+        return generate()
+
+
+class AsyncStreamingTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+
+    async def test_chat_with_model_stream_async(self):
+        await self.async_client.aforce_login(self.user)
+        fake_client = FakeAsyncOllamaClient(["Hi", " there", "!"])
+
+        with patch(
+            "chat.ollama_utils.initialize_async_client", return_value=fake_client
+        ):
+            response = await self.async_client.post(
+                reverse("chat_with_model_stream_async", args=[self.thread.id]),
+                data=json.dumps({"message": "user: Hello"}),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+            content = b"".join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(content, b"Hi there!")
+        senders = [
+            (message.sender, message.content)
+            async for message in ChatMessage.objects.filter(
+                thread=self.thread
+            ).order_by("id")
+        ]
+        self.assertEqual(senders, [("user", "Hello"), ("bot", "Hi there!")])
+
+    async def test_async_disconnect_saves_partial_once(self):
+        fake_client = FakeAsyncOllamaClient(["Hi", " there", "!"])
+        with patch(
+            "chat.ollama_utils.initialize_async_client", return_value=fake_client
+        ):
+            stream = ollama_utils.astream_response(
+                "llama3.1",
+                [{"role": "user", "content": "Hello"}],
+                self.thread,
+                generations.start(self.thread.id),
+            )
+            self.assertEqual(await stream.__anext__(), "Hi")
+            await stream.aclose()  # What the ASGI handler does on disconnect
+
+        contents = [
+            message.content
+            async for message in ChatMessage.objects.filter(thread=self.thread)
+        ]
+        self.assertEqual(contents, ["Hi"])
+
+    async def test_chat_with_model_stream_async_missing_thread(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(
+            reverse("chat_with_model_stream_async", args=[self.thread.id + 100]),
+            data=json.dumps({"message": "user: Hello"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class OllamaClientsTestCase(TestCase):
+    def tearDown(self):
+        ollama_clients.close_clients()
+
+    def test_get_client_is_shared_per_host(self):
+        client = ollama_clients.get_client("http://ollama-a:11434")
+        self.assertIs(client, ollama_clients.get_client("http://ollama-a:11434"))
+        self.assertIsNot(client, ollama_clients.get_client("http://ollama-b:11434"))
+
+    def test_get_client_is_shared_across_threads(self):
+        seen = []
+        workers = [
+            threading.Thread(
+                target=lambda: seen.append(
+                    ollama_clients.get_client("http://ollama-a:11434")
+                )
+            )
+            for _ in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len({id(client) for client in seen}), 1)
+
+    async def test_get_async_client_is_shared_per_loop(self):
+        client = ollama_clients.get_async_client("http://ollama-a:11434")
+        self.assertIs(client, ollama_clients.get_async_client("http://ollama-a:11434"))
+
+
+class TruncateMessagesTestCase(TestCase):
+    def setUp(self):
+        self.system = {"role": "system", "content": "You are helpful."}
+
+    def test_keeps_everything_within_budget(self):
+        messages = [
+            self.system,
+            {"role": "user", "content": "Hi"},
+            {"role": "bot", "content": "Hello!"},
+            {"role": "user", "content": "How are you?"},
+        ]
+        self.assertEqual(truncate_messages(messages, max_tokens=1000), messages)
+
+    def test_drops_oldest_turns_first(self):
+        history = []
+        for i in range(100):
+            history.append({"role": "user", "content": f"question {i} " * 10})
+            history.append({"role": "bot", "content": f"answer {i} " * 10})
+        messages = [self.system] + history + [{"role": "user", "content": "last"}]
+
+        kept = truncate_messages(messages, max_tokens=500)
+
+        self.assertEqual(kept[0], self.system)
+        self.assertEqual(kept[-1]["content"], "last")
+        self.assertLess(len(kept), len(messages))
+        self.assertEqual(kept[1:], messages[len(messages) - len(kept) + 1 :])
+        self.assertLessEqual(sum(count_message_tokens(m) for m in kept), 500)
+
+    def test_always_keeps_system_prompt_and_latest_user_turn(self):
+        messages = [
+            self.system,
+            {"role": "user", "content": "old"},
+            {"role": "user", "content": "x" * 10000},
+        ]
+        self.assertEqual(
+            truncate_messages(messages, max_tokens=10), [self.system, messages[2]]
+        )
+
+    def test_drops_in_steps_so_the_prefix_stays_the_same(self):
+        messages = [self.system]
+        starts = []
+        for i in range(60):
+            messages.append({"role": "user", "content": f"question {i} " * 10})
+            kept = truncate_messages(messages, max_tokens=500, drop_fraction=0.5)
+            self.assertLessEqual(sum(count_message_tokens(m) for m in kept), 500)
+            self.assertEqual(kept[-1], messages[-1])
+            starts.append(messages.index(kept[1]))
+            messages.append({"role": "assistant", "content": f"answer {i} " * 10})
+
+        # The kept history only starts later every few turns, not every turn
+        self.assertGreater(starts[-1], 1)
+        self.assertLess(len(set(starts)), len(starts) // 3)
+
+    def test_drop_fraction_zero_drops_only_what_is_needed(self):
+        messages = [self.system] + [
+            {"role": "user", "content": f"question {i} " * 10} for i in range(20)
+        ]
+        kept = truncate_messages(messages, max_tokens=500, drop_fraction=0)
+        dropped = messages[len(messages) - len(kept)]
+        self.assertGreater(sum(count_message_tokens(m) for m in kept + [dropped]), 500)
+
+    def test_uses_registered_tokenizer(self):
+        with patch.dict(
+            "chat.context_window.TOKENIZERS", {"test-model": lambda text: 1000}
+        ):
+            self.assertEqual(count_tokens("hello", "test-model:7b"), 1000)
+        self.assertEqual(count_tokens("hello", "test-model:7b"), 2)
+
+
+class FakeOllamaClient:
+    def __init__(self, parts):
+        self.parts = parts
+        self.calls = []
+        self.options = []
+
+    def chat(self, model, messages, stream=False, **options):
+        self.calls.append(messages)
+        self.options.append(options)
+        if not stream:
+            return {"message": {"content": "".join(self.parts)}}
+        return (
+            {"message": {"content": part}, "done": i == len(self.parts)}
+            for i, part in enumerate(self.parts, 1)
+        )
+
+
+class ServerHistoryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        cache.clear()  # Rate limit counts
+
+    def send(self, message, fake_client):
+        with patch("chat.ollama_utils.initialize_client", return_value=fake_client):
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[self.thread.id]),
+                data=json.dumps({"message": message, "history": "server"}),
+                content_type="application/json",
+            )
+            return b"".join(response.streaming_content)
+
+    def test_prompt_is_built_from_stored_messages(self):
+        fake_client = FakeOllamaClient(["First", " answer"])
+        self.assertEqual(self.send("line one\nline two", fake_client), b"First answer")
+        self.send("follow up", fake_client)
+
+        self.assertEqual(
+            fake_client.calls[-1][1:],
+            [
+                {"role": "user", "content": "line one\nline two"},
+                {"role": "assistant", "content": "First answer"},
+                {"role": "user", "content": "follow up"},
+            ],
+        )
+        self.assertEqual(fake_client.calls[-1][0]["role"], "system")
+        self.assertEqual(
+            list(
+                ChatMessage.objects.filter(thread=self.thread)
+                .order_by("id")
+                .values_list("sender", "content")
+            ),
+            [
+                ("user", "line one\nline two"),
+                ("bot", "First answer"),
+                ("user", "follow up"),
+                ("bot", "First answer"),
+            ],
+        )
+
+    def test_next_turn_extends_the_previous_prompt(self):
+        fake_client = FakeOllamaClient(["An answer"])
+        with patch.object(ollama_utils, "OLLAMA_NUM_CTX", 8192):
+            self.send("one", fake_client)
+            self.send("two", fake_client)
+
+        # What Ollama evaluated for the first turn is reused for the second
+        first, second = fake_client.calls
+        self.assertEqual(json.dumps(second[: len(first)]), json.dumps(first))
+        self.assertEqual(
+            fake_client.options,
+            [{"keep_alive": "30m", "options": {"num_ctx": 8192}}] * 2,
+        )
+
+    def test_numeric_keep_alive_is_sent_as_seconds(self):
+        with patch.object(ollama_utils, "OLLAMA_KEEP_ALIVE", "-1"):
+            self.assertEqual(ollama_utils.chat_options(), {"keep_alive": -1.0})
+        with patch.object(ollama_utils, "OLLAMA_KEEP_ALIVE", ""):
+            self.assertEqual(ollama_utils.chat_options(), {})
+
+
+class ConversationWindowCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        ollama_utils.save_message(self.thread, "user", "Hello")
+        ollama_utils.save_message(self.thread, "bot", "Hi there!")
+
+    def tearDown(self):
+        conversations.clear()
+
+    def test_hot_thread_skips_database(self):
+        conversations.get_window(self.thread.id)
+        with self.assertNumQueries(1):  # The thread's message count
+            messages, token_counts = conversations.get_window(self.thread.id)
+        self.assertEqual(
+            messages,
+            [
+                {"role": "user", "content": "Hello"},
+                {"role": "assistant", "content": "Hi there!"},
+            ],
+        )
+        self.assertEqual(len(token_counts), 2)
+
+    def test_new_turns_are_appended(self):
+        conversations.get_window(self.thread.id)
+        ollama_utils.save_message(self.thread, "user", "How are you?")
+        with self.assertNumQueries(1):
+            messages, token_counts = conversations.get_window(self.thread.id)
+        self.assertEqual(messages[-1], {"role": "user", "content": "How are you?"})
+        self.assertEqual(
+            token_counts[-1], count_message_tokens(messages[-1], "llama3.1")
+        )
+
+    def test_messages_saved_by_other_workers_rebuild_window(self):
+        conversations.get_window(self.thread.id)
+        # Saved by another process, so not appended to this one's window
+        ChatMessage.objects.create(
+            thread=self.thread, sender="user", content="From elsewhere"
+        )
+        messages, _ = conversations.get_window(self.thread.id)
+        self.assertEqual(messages[-1], {"role": "user", "content": "From elsewhere"})
+
+        ChatMessage.objects.filter(content="Hello").delete()
+        messages, _ = conversations.get_window(self.thread.id)
+        self.assertEqual(len(messages), 2)
+
+    def test_evicts_least_recently_used_by_memory_budget(self):
+        other = ChatThread.objects.create(user=self.user)
+        ollama_utils.save_message(other, "user", "x" * 1000)
+        cache = conversations.WindowCache(max_bytes=1500)
+        with patch.object(conversations, "_local", cache):
+            conversations.get_window(self.thread.id)
+            conversations.get_window(other.id)
+            self.assertIsNone(cache.get(self.thread.id))
+            self.assertIsNotNone(cache.get(other.id))
+            self.assertLessEqual(cache.size, 1500)
+
+    def test_delete_thread_invalidates_window(self):
+        conversations.get_window(self.thread.id)
+        self.client.delete(reverse("delete_thread", args=[self.thread.id]))
+        self.assertIsNone(conversations._local.get(self.thread.id))
+
+    def test_shared_tier_serves_other_processes(self):
+        with patch.object(conversations, "WINDOW_CACHE_ALIAS", "default"):
+            conversations.get_window(self.thread.id)
+            conversations.clear()  # Another process starts with a cold cache
+            with self.assertNumQueries(0):
+                messages, _ = conversations.get_window(self.thread.id)
+            self.assertEqual(len(messages), 2)
+            conversations.invalidate(self.thread.id)
+
+
+class ThreadMessagesPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        created_at = timezone.now()
+        # Equal timestamps exercise the id tie-breaker of the cursor
+        ChatMessage.objects.bulk_create(
+            ChatMessage(
+                thread=self.thread,
+                sender="user" if i % 2 == 0 else "bot",
+                content=f"message {i}",
+                created_at=created_at + timezone.timedelta(seconds=i // 2),
+            )
+            for i in range(10)
+        )
+        self.url = reverse("get_thread_messages", args=[self.thread.id])
+
+    def contents(self, messages):
+        return [message["content"] for message in messages]
+
+    def test_pages_backward_from_newest(self):
+        data = self.client.get(self.url, {"limit": 4}).json()
+        self.assertEqual(
+            self.contents(data["messages"]), [f"message {i}" for i in range(6, 10)]
+        )
+        self.assertTrue(data["has_more"])
+
+        older = self.client.get(self.url, {"limit": 4, "before": data["before"]}).json()
+        self.assertEqual(
+            self.contents(older["messages"]), [f"message {i}" for i in range(2, 6)]
+        )
+
+    def test_pages_forward_after_cursor(self):
+        start = self.client.get(self.url, {"limit": 10}).json()["messages"][2]
+        data = self.client.get(self.url, {"limit": 3, "after": start["cursor"]}).json()
+        self.assertEqual(
+            self.contents(data["messages"]), ["message 3", "message 4", "message 5"]
+        )
+        self.assertTrue(data["has_more"])
+
+    def test_ndjson_streams_every_message(self):
+        response = self.client.get(self.url, {"format": "ndjson"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            self.contents(json.loads(line) for line in lines),
+            [f"message {i}" for i in range(10)],
+        )
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_other_users_thread_is_not_found(self):
+        other = User.objects.create_user(
+            username="other", email="other@example.com", password="otherpassword"
+        )
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class ThreadSummaryTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        thread_cache.invalidate(self.user.id)
+
+    def test_saving_messages_updates_summary(self):
+        ChatMessage.objects.create(thread=self.thread, sender="user", content="Hello")
+        last = ChatMessage.objects.create(
+            thread=self.thread, sender="bot", content="x" * 500
+        )
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.message_count, 2)
+        self.assertEqual(self.thread.last_message_at, last.created_at)
+        self.assertEqual(self.thread.last_message_preview, "x" * 100)
+
+    def test_deleting_messages_updates_summary(self):
+        first = ChatMessage.objects.create(
+            thread=self.thread, sender="user", content="Hello"
+        )
+        ChatMessage.objects.create(thread=self.thread, sender="bot", content="Bye")
+        ChatMessage.objects.filter(content="Bye").delete()
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.message_count, 1)
+        self.assertEqual(self.thread.last_message_preview, first.content)
+
+        first.delete()
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.message_count, 0)
+        self.assertIsNone(self.thread.last_message_at)
+
+    def test_deleting_thread_skips_summary(self):
+        ChatMessage.objects.create(thread=self.thread, sender="user", content="Hello")
+        with patch.object(ChatThread, "refresh_summary") as refresh_summary:
+            self.thread.delete()
+        refresh_summary.assert_not_called()
+
+    def test_thread_list_does_not_read_messages(self):
+        ChatMessage.objects.create(thread=self.thread, sender="user", content="Hello")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("get_user_threads"))
+        self.assertFalse(
+            any(
+                "chat_chatmessage" in query["sql"] for query in queries.captured_queries
+            )
+        )
+        thread = response.json()["threads"][0]
+        self.assertEqual(thread["message_count"], 1)
+        self.assertEqual(thread["last_message_preview"], "Hello")
+
+
+class UserThreadsListTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.threads = [ChatThread.objects.create(user=self.user) for _ in range(5)]
+        thread_cache.invalidate(self.user.id)
+        self.url = reverse("get_user_threads")
+
+    def test_pages_newest_first(self):
+        data = self.client.get(self.url, {"limit": 3}).json()
+        newest_first = [thread.id for thread in reversed(self.threads)]
+        self.assertEqual([t["id"] for t in data["threads"]], newest_first[:3])
+        self.assertTrue(data["has_more"])
+
+        data = self.client.get(self.url, {"limit": 3, "before": data["before"]}).json()
+        self.assertEqual([t["id"] for t in data["threads"]], newest_first[3:])
+        self.assertFalse(data["has_more"])
+
+    def test_not_modified_until_threads_change(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(
+            any("chat_chatthread" in query["sql"] for query in queries.captured_queries)
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                reverse("update_thread_title", args=[self.threads[0].id]),
+                data=json.dumps({"title": "Renamed"}),
+                content_type="application/json",
+            )
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["threads"][0]["title"], "Renamed")
+
+    def test_writes_outside_the_views_change_the_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        thread = self.threads[0]
+
+        # As from the admin
+        with self.captureOnCommitCallbacks(execute=True):
+            thread.title = "Renamed"
+            thread.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatMessage.objects.create(thread=thread, sender="user", content="Hi")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["threads"][0]["last_message_preview"], "Hi")
+
+    def test_cached_page_skips_database(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertFalse(
+            any("chat_chatthread" in query["sql"] for query in queries.captured_queries)
+        )
+
+
+class TrackedStream:
+    def __init__(self, parts):
+        self.parts = iter(parts)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return {"message": {"content": next(self.parts)}}
+
+    def close(self):
+        self.closed = True
+
+
+class StreamCancellationTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        self.upstream = TrackedStream(["a", "b", "c", "d"])
+        self.fake_client = FakeOllamaClient([])
+        self.fake_client.chat = lambda **kwargs: self.upstream
+
+    def start_stream(self):
+        # The client is created once the stream starts, so keep it patched
+        patcher = patch(
+            "chat.ollama_utils.initialize_client", return_value=self.fake_client
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return ollama_utils.stream_response(
+            None,
+            "llama3.1",
+            [{"role": "user", "content": "Hello"}],
+            self.thread,
+            generations.start(self.thread.id),
+        )
+
+    def bot_messages(self):
+        return list(
+            ChatMessage.objects.filter(thread=self.thread, sender="bot").values_list(
+                "content", flat=True
+            )
+        )
+
+    def test_disconnect_closes_upstream_and_saves_partial_once(self):
+        stream = self.start_stream()
+        self.assertEqual([next(stream), next(stream)], ["a", "b"])
+        stream.close()  # What the WSGI server does when the client goes away
+
+        self.assertTrue(self.upstream.closed)
+        self.assertEqual(self.bot_messages(), ["ab"])
+
+    def test_cancel_endpoint_stops_running_stream(self):
+        stream = self.start_stream()
+        self.assertEqual(next(stream), "a")
+
+        response = self.client.post(reverse("cancel_stream", args=[self.thread.id]))
+        self.assertEqual(response.status_code, 202)
+
+        self.assertEqual(list(stream), [])
+        self.assertTrue(self.upstream.closed)
+        self.assertEqual(self.bot_messages(), ["a"])
+
+    def test_cancel_from_another_process(self):
+        stream = self.start_stream()
+        self.assertEqual(next(stream), "a")
+
+        # Another worker only shares the cache flag, not the in-process handle
+        with patch.dict(generations._active, clear=True):
+            generations.cancel(self.thread.id)
+        with patch.object(generations, "CANCEL_POLL_INTERVAL", 0):
+            with patch("chat.generations.time.monotonic", return_value=1e12):
+                self.assertEqual(list(stream), [])
+        self.assertEqual(self.bot_messages(), ["a"])
+
+    def test_async_poll_sees_cancel_from_another_process(self):
+        generations.cancel(self.thread.id)  # A stale request
+        generation = asyncio.run(generations.astart(self.thread.id))
+        with patch.dict(generations._active, clear=True):
+            generations.cancel(self.thread.id)
+        with patch("chat.generations.time.monotonic", return_value=1e12):
+            self.assertTrue(asyncio.run(generation.ais_set()))
+
+        generation = asyncio.run(generations.astart(self.thread.id))
+        with patch("chat.generations.time.monotonic", return_value=1e12):
+            self.assertFalse(asyncio.run(generation.ais_set()))
+
+    def test_cancel_other_users_thread(self):
+        other = User.objects.create_user(
+            username="other", email="other@example.com", password="otherpassword"
+        )
+        self.client.force_login(other)
+        response = self.client.post(reverse("cancel_stream", args=[self.thread.id]))
+        self.assertEqual(response.status_code, 404)
+
+
+class AdmissionGateTestCase(TestCase):
+    def test_caps_concurrency_and_admits_in_fifo_order(self):
+        gate = admission.AdmissionGate(
+            max_active=1, max_per_user=1, max_queue=10, retry_after=1
+        )
+        gate.acquire(user_id=1)
+        order = []
+
+        def wait(user_id):
+            gate.acquire(user_id)
+            order.append(user_id)
+            gate.release(user_id)
+
+        waiters = []
+        for user_id in (2, 3):
+            waiter = threading.Thread(target=wait, args=(user_id,))
+            waiter.start()
+            waiters.append(waiter)
+            while gate.stats()["queued"] < len(waiters):
+                time.sleep(0.001)
+
+        self.assertEqual(gate.stats()["active"], 1)
+        gate.release(user_id=1)
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(order, [2, 3])
+        self.assertEqual(gate.stats()["active"], 0)
+
+    def test_per_user_cap_lets_other_users_pass(self):
+        gate = admission.AdmissionGate(
+            max_active=2, max_per_user=1, max_queue=10, retry_after=1
+        )
+        gate.acquire(user_id=1)
+        self.assertEqual(gate.check(user_id=1), 1)
+        self.assertEqual(gate.check(user_id=2), 0)
+        gate.acquire(user_id=2)
+        self.assertEqual(gate.stats()["active"], 2)
+
+    def test_full_queue_is_rejected(self):
+        gate = admission.AdmissionGate(
+            max_active=1, max_per_user=1, max_queue=0, retry_after=7
+        )
+        with self.assertRaises(admission.Overloaded) as raised:
+            gate.check(user_id=1)
+        self.assertEqual(raised.exception.retry_after, 7)
+        self.assertEqual(gate.stats()["rejected_total"], 1)
+
+    def test_stream_returns_503_when_queue_full(self):
+        user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(user)
+        thread = ChatThread.objects.create(user=user)
+        full_gate = admission.AdmissionGate(
+            max_active=1, max_per_user=1, max_queue=0, retry_after=7
+        )
+        with patch.object(admission, "gate", full_gate):
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[thread.id]),
+                data=json.dumps({"message": "user: Hello"}),
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
+        self.assertFalse(ChatMessage.objects.filter(thread=thread).exists())
+
+
+class StubOllamaServer:
+    """
+    Local HTTP server answering Ollama's /api/version health check.
+    """
+
+    def __init__(self):
+        self.status = 200
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"version": "0.0.0"}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BackendPoolTestCase(TestCase):
+    def setUp(self):
+        self.servers = [StubOllamaServer() for _ in range(3)]
+        self.addCleanup(lambda: [server.stop() for server in self.servers])
+        self.pool = backends.BackendPool(
+            [server.host for server in self.servers],
+            health_interval=0,
+            health_timeout=1,
+            unhealthy_after=2,
+            sticky_slack=1,
+        )
+
+    def test_routes_to_least_outstanding_backend(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        third = self.pool.acquire()
+        self.assertEqual(len({first.host, second.host, third.host}), 3)
+        self.pool.release(second)
+        self.assertIs(self.pool.choose(), second)
+
+    def test_faster_backend_takes_more_requests(self):
+        fast = self.pool.backends[0]
+        self.pool.record_throughput(fast, tokens=300, seconds=1)
+        for backend in self.pool.backends[1:]:
+            self.pool.record_throughput(backend, tokens=100, seconds=1)
+        self.pool.acquire()
+        self.assertIs(self.pool.acquire(), fast)
+
+    def test_thread_sticks_to_its_backend_until_overloaded(self):
+        preferred = self.pool.choose(thread_id=42)
+        for _ in range(5):
+            self.assertIs(self.pool.choose(thread_id=42), preferred)
+
+        self.pool.acquire(thread_id=42)
+        self.pool.acquire(thread_id=42)
+        self.assertEqual(preferred.outstanding, 2)
+        self.assertIsNot(self.pool.choose(thread_id=42), preferred)
+
+    def test_health_checks_eject_and_restore_backends(self):
+        down = self.servers[0]
+        down.status = 500
+        self.pool.check_health()
+        self.assertTrue(self.pool.backends[0].healthy)
+        self.pool.check_health()
+        self.assertFalse(self.pool.backends[0].healthy)
+        for thread_id in range(20):
+            self.assertNotEqual(self.pool.choose(thread_id).host, down.host)
+
+        down.status = 200
+        self.pool.check_health()
+        self.assertTrue(self.pool.backends[0].healthy)
+
+    def test_connection_errors_mark_backend_unhealthy(self):
+        backend = self.pool.backends[0]
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                with self.pool.lease() as leased:
+                    self.assertIs(leased, backend)
+                    raise ConnectionError("refused")
+        self.assertFalse(backend.healthy)
+        self.assertEqual(backend.outstanding, 0)
+
+    def test_stream_uses_thread_backend(self):
+        user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(user)
+        thread = ChatThread.objects.create(user=user)
+        fake_client = FakeOllamaClient(["Hi"])
+        with patch.object(backends, "pool", self.pool), patch(
+            "chat.ollama_utils.initialize_client", return_value=fake_client
+        ) as initialize_client:
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[thread.id]),
+                data=json.dumps({"message": "user: Hello"}),
+                content_type="application/json",
+            )
+            self.assertEqual(b"".join(response.streaming_content), b"Hi")
+
+        initialize_client.assert_called_once_with(self.pool.choose(thread.id).host)
+        self.assertEqual(sum(b.outstanding for b in self.pool.backends), 0)
+
+
+class FakeOllamaServerTestCase(TestCase):
+    def test_streams_configured_reply(self):
+        with fake_ollama.FakeOllamaServer(tokens=5) as server:
+            client = ollama.Client(host=server.host)
+            parts = list(
+                client.chat(
+                    model="llama3.1",
+                    messages=[{"role": "user", "content": "Hi"}],
+                    stream=True,
+                )
+            )
+        self.assertEqual(
+            "".join(part["message"]["content"] for part in parts),
+            "".join(server.reply(5)),
+        )
+        self.assertTrue(parts[-1]["done"])
+        self.assertEqual(parts[-1]["eval_count"], 5)
+        self.assertEqual(server.requests, 1)
+
+    def test_non_streaming_reply_honours_num_predict(self):
+        with fake_ollama.FakeOllamaServer(tokens=50) as server:
+            response = ollama.Client(host=server.host).chat(
+                model="llama3.1",
+                messages=[{"role": "user", "content": "Hi"}],
+                options={"num_predict": 3},
+            )
+        self.assertEqual(response["message"]["content"], "".join(server.reply(3)))
+        self.assertEqual(response["eval_count"], 3)
+
+    def test_time_to_first_token_and_speed(self):
+        with fake_ollama.FakeOllamaServer(
+            ttft=0.1, tokens_per_second=100, tokens=6
+        ) as server:
+            started = time.monotonic()
+            parts = ollama.Client(host=server.host).chat(
+                model="llama3.1", messages=[], stream=True
+            )
+            next(parts)
+            first_token = time.monotonic() - started
+            list(parts)
+            total = time.monotonic() - started
+        self.assertGreaterEqual(first_token, 0.1)
+        self.assertGreaterEqual(total - first_token, 0.05)
+
+    def test_injected_errors(self):
+        with fake_ollama.FakeOllamaServer(error_rate=1) as server:
+            with self.assertRaises(ollama.ResponseError) as raised:
+                ollama.Client(host=server.host).chat(model="llama3.1", messages=[])
+        self.assertEqual(raised.exception.status_code, 500)
+
+        with fake_ollama.FakeOllamaServer(tokens=4, stream_error_rate=1) as server:
+            parts = ollama.Client(host=server.host).chat(
+                model="llama3.1", messages=[], stream=True
+            )
+            self.assertEqual(len([next(parts), next(parts)]), 2)
+            with self.assertRaises(ollama.ResponseError):
+                next(parts)
+
+    def test_stream_view_end_to_end(self):
+        user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(user)
+        thread = ChatThread.objects.create(user=user)
+        with fake_ollama.FakeOllamaServer(tokens=8) as server:
+            with patch.object(backends, "pool", backends.BackendPool([server.host])):
+                response = self.client.post(
+                    reverse("chat_with_model_stream", args=[thread.id]),
+                    data=json.dumps({"message": "user: Hello"}),
+                    content_type="application/json",
+                )
+                content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content, "".join(server.reply(8)))
+        self.assertEqual(
+            ChatMessage.objects.get(thread=thread, sender="bot").content, content
+        )
+
+    def test_chat_view_end_to_end(self):
+        user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(user)
+        thread = ChatThread.objects.create(user=user)
+        with fake_ollama.FakeOllamaServer(tokens=8) as server:
+            with patch.object(backends, "pool", backends.BackendPool([server.host])):
+                response = self.client.post(
+                    reverse("chat_with_model", args=[thread.id]),
+                    data=json.dumps({"message": "user: Hello"}),
+                    content_type="application/json",
+                )
+        self.assertEqual(response.json()["response"], "".join(server.reply(8)))
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.clear()
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram(
+            "test_seconds", "Test histogram.", (0.1, 1), labelnames=("model",)
+        )
+        metrics._registry.remove(histogram)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, "m")
+        self.assertEqual(
+            histogram.render()[2:],
+            [
+                'test_seconds_bucket{model="m",le="0.1"} 1',
+                'test_seconds_bucket{model="m",le="1"} 2',
+                'test_seconds_bucket{model="m",le="+Inf"} 3',
+                'test_seconds_sum{model="m"} 5.55',
+                'test_seconds_count{model="m"} 3',
+            ],
+        )
+
+    def test_stream_records_timings(self):
+        self.client.force_login(self.user)
+        thread = ChatThread.objects.create(user=self.user)
+        with fake_ollama.FakeOllamaServer(tokens=8) as server:
+            with patch.object(backends, "pool", backends.BackendPool([server.host])):
+                response = self.client.post(
+                    reverse("chat_with_model_stream", args=[thread.id]),
+                    data=json.dumps({"message": "user: Hello"}),
+                    content_type="application/json",
+                )
+                b"".join(response.streaming_content)
+
+        labels = (f'model="llama3.1",host="{server.host}"',)
+        text = metrics.render()
+        for line in (
+            "chat_queue_wait_seconds_count{%s} 1",
+            "chat_upstream_connect_seconds_count{%s} 1",
+            "chat_time_to_first_token_seconds_count{%s} 1",
+            "chat_inter_token_seconds_count{%s} 7",
+            "chat_generated_tokens_sum{%s} 8",
+            "chat_tokens_per_second_count{%s} 1",
+            "chat_db_save_seconds_count{%s} 1",
+            'chat_streams_total{%s,outcome="completed"} 1',
+        ):
+            self.assertIn(line % labels, text)
+
+    def test_metrics_endpoint_access(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+        with patch.object(metrics, "METRICS_TOKEN", "secret"):
+            response = self.client.get(
+                reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE chat_admission_active gauge", response.content.decode())
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+
+class CoalescedStreamTestCase(TestCase):
+    def test_batches_tokens_up_to_byte_threshold(self):
+        chunks = ["a", "bb", "ccc", "dddddddddd", "e"]
+        self.assertEqual(
+            list(streaming.coalesce(iter(chunks), max_bytes=10, max_delay=60)),
+            [b"a", b"bbcccdddddddddd", b"e"],
+        )
+
+    def test_flushes_after_deadline(self):
+        def slow():
+            yield "a"
+            yield "b"
+            time.sleep(0.03)
+            yield "c"
+            yield "d"
+
+        self.assertEqual(
+            list(streaming.coalesce(slow(), max_bytes=100, max_delay=0.02)),
+            [b"a", b"bc", b"d"],
+        )
+
+    def test_zero_bytes_disables_coalescing(self):
+        self.assertEqual(
+            list(streaming.coalesce(iter(["a", "b"]), max_bytes=0)), [b"a", b"b"]
+        )
+
+    def test_close_reaches_model_stream(self):
+        closed = []
+
+        def tokens():
+            try:
+                yield from ["a", "b", "c"]
+            finally:
+                closed.append(True)
+
+        stream = streaming.coalesce(tokens(), max_bytes=100, max_delay=60)
+        self.assertEqual(next(stream), b"a")
+        stream.close()
+        self.assertEqual(closed, [True])
+
+    async def test_async_flushes_while_model_is_slow(self):
+        async def slow():
+            yield "a"
+            yield "b"
+            await asyncio.sleep(0.2)
+            yield "c"
+
+        received = []
+        started = time.monotonic()
+        async for chunk in streaming.acoalesce(slow(), max_bytes=100, max_delay=0.02):
+            received.append((chunk, time.monotonic() - started))
+        self.assertEqual([chunk for chunk, _ in received], [b"a", b"b", b"c"])
+        self.assertLess(received[1][1], 0.15)
+
+    async def test_async_close_reaches_model_stream(self):
+        closed = []
+
+        async def tokens():
+            try:
+                for token in ("a", "b", "c"):
+                    yield token
+                    await asyncio.sleep(0.05)
+            finally:
+                closed.append(True)
+
+        stream = streaming.acoalesce(tokens(), max_bytes=100, max_delay=0.01)
+        self.assertEqual(await stream.__anext__(), b"a")
+        await stream.aclose()
+        self.assertEqual(closed, [True])
+
+
+class ReplyCheckpointTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        patcher = patch.object(ollama_utils, "CHECKPOINT_TOKENS", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def bot_messages(self):
+        return list(
+            ChatMessage.objects.filter(thread=self.thread, sender="bot").values_list(
+                "content", flat=True
+            )
+        )
+
+    def test_partial_reply_is_checkpointed_and_completed(self):
+        conversations.get_window(self.thread.id)
+        fake_client = FakeOllamaClient(["a", "b", "c", "d", "e"])
+        with patch("chat.ollama_utils.initialize_client", return_value=fake_client):
+            stream = ollama_utils.stream_response(
+                None,
+                "llama3.1",
+                [{"role": "user", "content": "Hello"}],
+                self.thread,
+                generations.start(self.thread.id),
+            )
+            self.assertEqual([next(stream), next(stream)], ["a", "b"])
+            # A worker dying here would leave what was generated so far
+            self.assertEqual(self.bot_messages(), ["ab"])
+            self.assertEqual("".join(stream), "cde")
+
+        self.assertEqual(self.bot_messages(), ["abcde"])
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.message_count, 1)
+        self.assertEqual(self.thread.last_message_preview, "abcde")
+        self.assertEqual(
+            conversations.get_history(self.thread.id),
+            [{"role": "assistant", "content": "abcde"}],
+        )
+
+    async def test_async_partial_reply_is_checkpointed(self):
+        fake_client = FakeAsyncOllamaClient(["a", "b", "c"])
+        with patch(
+            "chat.ollama_utils.initialize_async_client", return_value=fake_client
+        ):
+            stream = ollama_utils.astream_response(
+                "llama3.1",
+                [{"role": "user", "content": "Hello"}],
+                self.thread,
+                generations.start(self.thread.id),
+            )
+            self.assertEqual([await stream.__anext__() for _ in range(2)], ["a", "b"])
+            contents = [
+                m.content async for m in ChatMessage.objects.filter(thread=self.thread)
+            ]
+            self.assertEqual(contents, ["ab"])
+            await stream.aclose()
+
+        contents = [
+            m.content async for m in ChatMessage.objects.filter(thread=self.thread)
+        ]
+        self.assertEqual(contents, ["ab"])
+
+    def test_out_of_order_append_rebuilds_window(self):
+        first = ChatMessage.objects.create(
+            thread=self.thread, sender="bot", content="partial"
+        )
+        conversations.get_window(self.thread.id)
+        second = ChatMessage.objects.create(
+            thread=self.thread, sender="user", content="next"
+        )
+        conversations.append_message(self.thread.id, second.id, "user", "next")
+        first.content = "complete"
+        first.save(update_fields=["content"])
+        conversations.append_message(self.thread.id, first.id, "bot", "complete")
+
+        self.assertEqual(
+            conversations.get_history(self.thread.id),
+            [
+                {"role": "assistant", "content": "complete"},
+                {"role": "user", "content": "next"},
+            ],
+        )
+
+
+class ResumableStreamTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        cache.clear()  # Rate limit counts
+        patcher = patch.object(resumable, "RESUME_GRACE", 60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, parts):
+        patcher = patch(
+            "chat.ollama_utils.initialize_client",
+            return_value=FakeOllamaClient(parts),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return self.client.post(
+            reverse("chat_with_model_stream", args=[self.thread.id]),
+            data=json.dumps({"message": "user: Hello"}),
+            content_type="application/json",
+        )
+
+    def resume(self, generation_id, offset):
+        return self.client.get(
+            reverse("resume_stream", args=[self.thread.id, generation_id]),
+            {"offset": offset},
+        )
+
+    def test_dropped_stream_resumes_from_offset(self):
+        response = self.start(["a", "b", "c", "d", "e"])
+        generation_id = response["X-Generation-Id"]
+        self.assertEqual(next(iter(response.streaming_content)), b"a")
+        response.close()  # The connection drops
+
+        resumed = self.resume(generation_id, 1)
+        self.assertEqual(resumed.status_code, 200)
+        self.assertEqual(b"".join(resumed.streaming_content), b"bcde")
+        self.assertEqual(
+            list(
+                ChatMessage.objects.filter(
+                    thread=self.thread, sender="bot"
+                ).values_list("content", flat=True)
+            ),
+            ["abcde"],
+        )
+
+        # Finished generations can still be replayed for a while
+        replayed = self.resume(generation_id, 0)
+        self.assertEqual(b"".join(replayed.streaming_content), b"abcde")
+
+    def test_resume_errors(self):
+        response = self.start(["a", "b"])
+        generation_id = response["X-Generation-Id"]
+        b"".join(response.streaming_content)
+
+        self.assertEqual(self.resume(generation_id, 3).status_code, 400)
+        self.assertEqual(self.resume(generation_id, "x").status_code, 400)
+        self.assertEqual(
+            self.resume("00000000-0000-0000-0000-000000000000", 0).status_code, 404
+        )
+
+        other = User.objects.create_user(
+            username="other", email="other@example.com", password="otherpassword"
+        )
+        self.client.force_login(other)
+        self.assertEqual(self.resume(generation_id, 0).status_code, 404)
+
+    def test_dropped_output_is_gone(self):
+        stream = resumable.SyncReplayStream(
+            "gen", self.thread.id, iter(["aaaa", "bbbb", "cccc"]), 8, 0
+        )
+        self.assertEqual(b"".join(stream.follow()), b"aaaabbbbcccc")
+        with self.assertRaises(resumable.OffsetGone):
+            stream.check(2)
+        self.assertEqual(b"".join(stream.follow(6)), b"bbcccc")
+
+    def test_without_grace_disconnect_stops_generation(self):
+        upstream = TrackedStream(["a", "b", "c"])
+        chunks = (part["message"]["content"] for part in upstream)
+        stream = resumable.SyncReplayStream("gen", self.thread.id, chunks, 100, 0)
+        reader = stream.follow()
+        self.assertEqual(next(reader), b"a")
+        reader.close()
+        self.assertTrue(stream.done)
+
+    async def test_async_stream_resumes(self):
+        async def tokens():
+            for token in ("a", "b", "c"):
+                await asyncio.sleep(0)
+                yield token
+
+        stream = resumable.AsyncReplayStream("gen", self.thread.id, tokens(), 100, 60)
+        reader = stream.afollow()
+        self.assertEqual(await reader.__anext__(), b"a")
+        await reader.aclose()
+        self.assertFalse(stream.done)
+
+        self.assertEqual(b"".join([c async for c in stream.afollow(1)]), b"bc")
+        self.assertTrue(stream.done)
+
+
+def parse_sse(body):
+    frames = []
+    for frame in body.decode().split("\n\n"):
+        if not frame:
+            continue
+        name, data = frame.split("\n")
+        event = json.loads(data[len("data: ") :])
+        assert name == f"event: {event['type']}"
+        frames.append(event)
+    return frames
+
+
+class FailingOllamaClient:
+    def chat(self, model, messages, stream=False, **options):
+        def generate():
+            yield {"message": {"content": "Hi"}}
+            raise ollama.ResponseError("model crashed")
+
+        return generate()
+
+
+class EventStreamTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        cache.clear()  # Rate limit counts
+
+    def send(self, fake_client):
+        with patch("chat.ollama_utils.initialize_client", return_value=fake_client):
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[self.thread.id]),
+                data=json.dumps({"message": "Hello", "history": "server"}),
+                content_type="application/json",
+                HTTP_ACCEPT="text/event-stream",
+            )
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            return parse_sse(b"".join(response.streaming_content))
+
+    def test_sse_typed_events(self):
+        frames = self.send(FakeOllamaClient(["Hi", " there"]))
+        reply = ChatMessage.objects.get(thread=self.thread, sender="bot")
+
+        self.assertEqual(
+            frames[:3],
+            [
+                {"type": "queue", "position": 0},
+                {"type": "token", "content": "Hi"},
+                {"type": "token", "content": " there"},
+            ],
+        )
+        self.assertEqual(frames[3]["type"], "done")
+        self.assertEqual(frames[3]["outcome"], "completed")
+        self.assertEqual(frames[3]["message_id"], reply.id)
+        self.assertEqual(frames[3]["usage"]["completion_tokens"], 2)
+        self.assertEqual(reply.content, "Hi there")
+
+    def test_done_event_reports_ollama_usage(self):
+        usage = {
+            "done": True,
+            "eval_count": 20,
+            "eval_duration": 2_000_000_000,
+            "prompt_eval_count": 7,
+            "total_duration": 3_000_000_000,
+        }
+        event = ollama_utils.finished_event("completed", usage, 3, None)
+        self.assertEqual(
+            event["usage"],
+            {
+                "prompt_tokens": 7,
+                "completion_tokens": 20,
+                "total_duration": 3.0,
+                "tokens_per_second": 10.0,
+            },
+        )
+
+    def test_sse_error_event(self):
+        frames = self.send(FailingOllamaClient())
+
+        self.assertEqual(frames[1], {"type": "token", "content": "Hi"})
+        self.assertEqual(frames[-1]["type"], "error")
+        self.assertEqual(
+            ChatMessage.objects.get(thread=self.thread, sender="bot").content, "Hi"
+        )
+
+    def test_sse_stream_resumes_as_sse(self):
+        with patch(
+            "chat.ollama_utils.initialize_client",
+            return_value=FakeOllamaClient(["Hi"]),
+        ):
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[self.thread.id]),
+                data=json.dumps({"message": "Hello", "history": "server"}),
+                content_type="application/json",
+                HTTP_ACCEPT="text/event-stream",
+            )
+            body = b"".join(response.streaming_content)
+        resumed = self.client.get(
+            reverse(
+                "resume_stream", args=[self.thread.id, response["X-Generation-Id"]]
+            ),
+            {"offset": 0},
+        )
+        self.assertEqual(resumed["Content-Type"], "text/event-stream")
+        self.assertEqual(b"".join(resumed.streaming_content), body)
+
+
+class FakeWebSocket:
+    """
+    Drives websocket.route like an ASGI server.
+    """
+
+    def __init__(self, headers):
+        self.scope = {
+            "type": "websocket",
+            "path": websocket.WEBSOCKET_PATH,
+            "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+            "client": ("127.0.0.1", 50000),
+        }
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.incoming.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.create_task(
+            websocket.route(None)(self.scope, self.incoming.get, self.outgoing.put)
+        )
+
+    def send(self, data):
+        self.incoming.put_nowait(
+            {"type": "websocket.receive", "text": json.dumps(data)}
+        )
+
+    async def receive(self):
+        message = await asyncio.wait_for(self.outgoing.get(), 5)
+        if message["type"] == "websocket.send":
+            return json.loads(message["text"])
+        return message
+
+    async def receive_turn(self):
+        frames = []
+        while not frames or frames[-1]["type"] not in ("done", "error"):
+            frames.append(await self.receive())
+        return frames
+
+    async def close(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self.task, 5)
+
+
+class WebSocketTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        cache.clear()
+
+    async def connect(self, **headers):
+        await self.async_client.aforce_login(self.user)
+        session = self.async_client.cookies[settings.SESSION_COOKIE_NAME].value
+        return FakeWebSocket(
+            {"cookie": f"{settings.SESSION_COOKIE_NAME}={session}", **headers}
+        )
+
+    async def test_many_turns_over_one_socket(self):
+        socket = await self.connect(origin=settings.CSRF_TRUSTED_ORIGINS[0])
+        self.assertEqual(await socket.receive(), {"type": "websocket.accept"})
+
+        fake_client = FakeAsyncOllamaClient(["Hi", " there"])
+        with patch(
+            "chat.ollama_utils.initialize_async_client", return_value=fake_client
+        ):
+            for text in ("Hello", "Again"):
+                socket.send(
+                    {
+                        "type": "message",
+                        "thread_id": self.thread.id,
+                        "message": text,
+                        "history": "server",
+                    }
+                )
+                frames = await socket.receive_turn()
+                self.assertEqual(
+                    [frame["type"] for frame in frames],
+                    ["queue", "token", "token", "done"],
+                )
+                self.assertTrue(
+                    all(frame["thread_id"] == self.thread.id for frame in frames)
+                )
+        await socket.close()
+
+        contents = [
+            (message.sender, message.content)
+            async for message in ChatMessage.objects.filter(
+                thread=self.thread
+            ).order_by("id")
+        ]
+        self.assertEqual(
+            contents,
+            [
+                ("user", "Hello"),
+                ("bot", "Hi there"),
+                ("user", "Again"),
+                ("bot", "Hi there"),
+            ],
+        )
+
+    async def test_turn_errors(self):
+        socket = await self.connect()
+        await socket.receive()  # accept
+
+        socket.send(
+            {"type": "message", "thread_id": self.thread.id + 100, "message": "x"}
+        )
+        self.assertEqual(
+            await socket.receive(),
+            {
+                "type": "error",
+                "error": "Thread not found",
+                "thread_id": self.thread.id + 100,
+            },
+        )
+        socket.send({"type": "message"})
+        self.assertEqual((await socket.receive())["error"], "Invalid message")
+        await socket.close()
+
+    async def test_rejects_unauthenticated_and_foreign_origin(self):
+        socket = FakeWebSocket({})
+        self.assertEqual(
+            await socket.receive(),
+            {"type": "websocket.close", "code": websocket.CLOSE_UNAUTHENTICATED},
+        )
+
+        socket = await self.connect(origin="https://evil.example")
+        self.assertEqual(
+            await socket.receive(),
+            {"type": "websocket.close", "code": websocket.CLOSE_FORBIDDEN_ORIGIN},
+        )
+
+
+class EmbeddingOllamaClient(FakeOllamaClient):
+    # Embeds prompts as counts of a few keywords
+    KEYWORDS = ("capital", "france", "weather", "python")
+
+    def embed(self, model, input):
+        embeddings = []
+        for text in input if isinstance(input, list) else [input]:
+            words = text.lower().replace("'s", "").replace("?", "").split()
+            embeddings.append([float(words.count(k)) for k in self.KEYWORDS])
+        return {"embeddings": embeddings}
+
+
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        conversations.clear()
+        cache.clear()  # Rate limit counts
+        for name, value in (
+            ("RESPONSE_CACHE_SIZE", 10),
+            ("RESPONSE_CACHE_PACE", 0),
+            ("_exact", response_cache.ResponseCache(10, 60)),
+            ("_indexes", {}),
+        ):
+            patcher = patch.object(response_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, message, fake_client, thread=None):
+        thread = thread or ChatThread.objects.create(user=self.user)
+        with patch("chat.ollama_utils.initialize_client", return_value=fake_client):
+            response = self.client.post(
+                reverse("chat_with_model_stream", args=[thread.id]),
+                data=json.dumps({"message": message, "history": "server"}),
+                content_type="application/json",
+            )
+            return b"".join(response.streaming_content), thread
+
+    def test_repeated_prompt_is_served_from_cache(self):
+        model = FakeOllamaClient(["Paris", "."])
+        self.ask("What is the capital of France?", model)
+
+        body, thread = self.ask("  what is the CAPITAL of france? ", model)
+        self.assertEqual(body, b"Paris.")
+        self.assertEqual(len(model.calls), 1)
+        self.assertEqual(
+            ChatMessage.objects.get(thread=thread, sender="bot").content, "Paris."
+        )
+
+    def test_different_conversation_misses(self):
+        model = FakeOllamaClient(["Paris", "."])
+        _, thread = self.ask("What is the capital of France?", model)
+        self.ask("What is the capital of France?", model, thread)
+        self.assertEqual(len(model.calls), 2)
+
+    def test_semantic_tier_matches_rephrased_prompt(self):
+        model = EmbeddingOllamaClient(["Paris", "."])
+        with patch.object(response_cache, "SEMANTIC_CACHE_MODEL", "embed"):
+            self.ask("What is the capital of France?", model)
+            body, _ = self.ask("France's capital?", model)
+            self.assertEqual(body, b"Paris.")
+            self.ask("What's the weather?", model)
+        self.assertEqual(len(model.calls), 2)
+
+    def test_non_streaming_view_uses_cache(self):
+        model = FakeOllamaClient(["Paris", "."])
+        self.ask("What is the capital of France?", model)
+        thread = ChatThread.objects.create(user=self.user)
+        with patch("chat.ollama_utils.initialize_client", return_value=model):
+            response = self.client.post(
+                reverse("chat_with_model", args=[thread.id]),
+                data=json.dumps(
+                    {"message": "What is the capital of France?", "history": "server"}
+                ),
+                content_type="application/json",
+            )
+        self.assertEqual(json.loads(response.content), {"response": "Paris."})
+        self.assertEqual(len(model.calls), 1)
+
+    def test_stream_without_final_chunk_is_not_cached(self):
+        model = TrackedOllamaClient(["Par"])  # Ends without a done chunk
+        self.ask("What is the capital of France?", model)
+        self.ask("What is the capital of France?", model)
+        self.assertEqual(len(model.streams), 2)
+
+    def test_empty_reply_is_not_cached(self):
+        model = FakeOllamaClient([""])
+        thread = ChatThread.objects.create(user=self.user)
+        with patch("chat.ollama_utils.initialize_client", return_value=model):
+            for _ in range(2):
+                self.client.post(
+                    reverse("chat_with_model", args=[thread.id]),
+                    data=json.dumps({"message": "Hi", "history": "client"}),
+                    content_type="application/json",
+                )
+        self.assertEqual(len(model.calls), 2)
+
+    def test_cancelled_reply_is_not_cached(self):
+        thread = ChatThread.objects.create(user=self.user)
+        generation = generations.start(thread.id)
+        messages = [ollama_utils.SYSTEM_PROMPT, {"role": "user", "content": "Hi"}]
+        with patch(
+            "chat.ollama_utils.initialize_client",
+            return_value=FakeOllamaClient(["a", "b"]),
+        ):
+            stream = ollama_utils.stream_response(
+                None, "llama3.1", messages, thread, generation
+            )
+            next(stream)
+            generation.set()
+            list(stream)
+        self.assertEqual(len(response_cache._exact), 0)
+
+    def test_ttl_and_lru_eviction(self):
+        cache = response_cache.ResponseCache(2, 60)
+        cache.set("a", ["1"])
+        cache.set("b", ["2"])
+        cache.get("a")
+        cache.set("c", ["3"])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), ("1",))
+
+        expired = response_cache.ResponseCache(2, 0)
+        expired.set("a", ["1"])
+        self.assertIsNone(expired.get("a"))
+
+    def test_semantic_index_is_bounded(self):
+        index = response_cache.SemanticIndex(2)
+        for key, vector in (("x", [1.0, 0.0]), ("y", [0.0, 1.0]), ("z", [0.6, 0.8])):
+            index.add(response_cache.np.asarray(vector, dtype="float32"), key)
+        self.assertEqual(index.count, 2)
+        key, score = index.search(response_cache.np.asarray([1.0, 0.0]))
+        self.assertEqual(key, "z")  # "x" was overwritten
+        self.assertAlmostEqual(score, 0.6, places=5)
+
+    def test_cached_reply_is_paced(self):
+        with patch.object(response_cache, "RESPONSE_CACHE_PACE", 20):
+            started = time.monotonic()
+            self.assertEqual(
+                list(response_cache.paced(["a", "b", "c"])), ["a", "b", "c"]
+            )
+            self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    async def test_async_stream_uses_cache(self):
+        thread = await ChatThread.objects.acreate(user=self.user)
+        messages = [ollama_utils.SYSTEM_PROMPT, {"role": "user", "content": "Hi"}]
+        for _ in range(2):
+            generation = generations.start(thread.id)
+            with patch(
+                "chat.ollama_utils.initialize_async_client",
+                return_value=FakeAsyncOllamaClient(["Hello", "!"]),
+            ) as initialize:
+                stream = ollama_utils.astream_response(
+                    "llama3.1", messages, thread, generation, typed=True
+                )
+                frames = [event async for event in stream]
+        self.assertFalse(initialize.called)
+        self.assertTrue(frames[-1]["cached"])
+        self.assertEqual(
+            [f["content"] for f in frames if f["type"] == "token"], ["Hello", "!"]
+        )
+
+
+class TrackedOllamaClient:
+    def __init__(self, parts):
+        self.parts = parts
+        self.streams = []
+
+    def chat(self, model, messages, stream=False, **options):
+        self.streams.append(TrackedStream(self.parts))
+        return self.streams[-1]
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.threads = [ChatThread.objects.create(user=self.user) for _ in range(2)]
+        self.messages = [ollama_utils.SYSTEM_PROMPT, {"role": "user", "content": "Hi"}]
+        conversations.clear()
+        singleflight.clear()
+        cache.clear()
+
+    def start(self, fake_client):
+        patcher = patch("chat.ollama_utils.initialize_client", return_value=fake_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        streams = []
+        for thread in self.threads:
+            generation = generations.start(thread.id)
+            stream = ollama_utils.stream_response(
+                None, "llama3.1", self.messages, thread, generation
+            )
+            streams.append((stream, generation))
+        return streams
+
+    def replies(self):
+        return [
+            list(
+                ChatMessage.objects.filter(thread=thread, sender="bot").values_list(
+                    "content", flat=True
+                )
+            )
+            for thread in self.threads
+        ]
+
+    def test_identical_prompts_share_one_model_call(self):
+        fake_client = TrackedOllamaClient(["a", "b", "c"])
+        (first, _), (second, _) = self.start(fake_client)
+
+        self.assertEqual(next(first), "a")
+        self.assertEqual(next(second), "a")  # Joins the running call
+        self.assertEqual("".join(first), "bc")
+        self.assertEqual("".join(second), "bc")
+
+        self.assertEqual(len(fake_client.streams), 1)
+        self.assertEqual(self.replies(), [["abc"], ["abc"]])
+
+    def test_cancelled_subscriber_leaves_the_others_running(self):
+        fake_client = TrackedOllamaClient(["a", "b", "c"])
+        (first, generation), (second, _) = self.start(fake_client)
+        next(first)
+        next(second)
+
+        generation.set()
+        self.assertEqual(list(first), [])
+        self.assertFalse(fake_client.streams[0].closed)
+        self.assertEqual("".join(second), "bc")
+        self.assertEqual(self.replies(), [["a"], ["abc"]])
+
+    def test_last_subscriber_leaving_stops_the_model(self):
+        fake_client = TrackedOllamaClient(["a", "b", "c"])
+        (first, _), (second, _) = self.start(fake_client)
+        next(first)
+        next(second)
+
+        first.close()
+        self.assertFalse(fake_client.streams[0].closed)
+        second.close()
+        self.assertTrue(fake_client.streams[0].closed)
+        self.assertEqual(self.replies(), [["a"], ["a"]])
+
+    def test_disabled(self):
+        fake_client = TrackedOllamaClient(["a"])
+        with patch.object(singleflight, "SINGLE_FLIGHT", False):
+            (first, _), (second, _) = self.start(fake_client)
+            list(first)
+            list(second)
+        self.assertEqual(len(fake_client.streams), 2)
+
+    def test_cross_process_subscriber_reads_the_cache(self):
+        fake_client = TrackedOllamaClient(["a", "b", "c"])
+        with patch.object(singleflight, "SINGLE_FLIGHT_ALIAS", "default"), patch.object(
+            singleflight, "SINGLE_FLIGHT_POLL_INTERVAL", 0
+        ):
+            (first, _), (second, _) = self.start(fake_client)
+            self.assertEqual(next(first), "a")
+            # Another worker process does not see this one's flights
+            with patch.object(singleflight, "_flights", {}):
+                self.assertEqual(next(second), "a")
+                self.assertEqual("".join(first), "bc")
+                self.assertEqual("".join(second), "bc")
+
+        self.assertEqual(len(fake_client.streams), 1)
+        self.assertEqual(self.replies(), [["abc"], ["abc"]])
+
+    def test_cross_process_subscriber_sees_stopped_call(self):
+        fake_client = TrackedOllamaClient(["a", "b", "c"])
+        with patch.object(singleflight, "SINGLE_FLIGHT_ALIAS", "default"), patch.object(
+            singleflight, "SINGLE_FLIGHT_POLL_INTERVAL", 0
+        ):
+            (first, _), (second, _) = self.start(fake_client)
+            next(first)
+            with patch.object(singleflight, "_flights", {}):
+                next(second)
+                first.close()
+                with self.assertRaises(singleflight.FlightError):
+                    list(second)
+        self.assertEqual(self.replies(), [["a"], ["a"]])
+
+    def test_cross_process_subscriber_waits_for_a_leader_not_started(self):
+        with patch.object(singleflight, "SINGLE_FLIGHT_ALIAS", "default"), patch.object(
+            singleflight, "SINGLE_FLIGHT_POLL_INTERVAL", 0.01
+        ):
+            parts = [{"response": "a"}, {"response": "b"}]
+            leader = singleflight.join("prompt", lambda flight: (p for p in parts))
+            with patch.object(singleflight, "_flights", {}):
+                remote = singleflight.join("prompt", lambda flight: None)
+            self.assertIsInstance(remote, singleflight.RemoteFlight)
+
+            # The leader pulls its first chunk only after waiting, e.g. for
+            # a model call slot
+            def run_leader():
+                time.sleep(0.1)
+                list(leader.follow(threading.Event()))
+
+            thread = threading.Thread(target=run_leader)
+            thread.start()
+            self.assertEqual(list(remote.follow(threading.Event())), parts)
+            thread.join()
+            self.assertIsNone(cache.get(singleflight._election_key("prompt")))
+
+    async def test_async_identical_prompts_share_one_model_call(self):
+        calls = []
+
+        class CountingClient(FakeAsyncOllamaClient):
+            async def chat(self, model, messages, stream=False, **options):
+                calls.append(messages)
+                await asyncio.sleep(0.01)
+                return await super().chat(model, messages, stream)
+
+        async def ask(thread):
+            stream = ollama_utils.astream_response(
+                "llama3.1", self.messages, thread, generations.start(thread.id)
+            )
+            return "".join([token async for token in stream])
+
+        with patch(
+            "chat.ollama_utils.initialize_async_client",
+            return_value=CountingClient(["Hi", "!"]),
+        ):
+            replies = await asyncio.gather(*(ask(thread) for thread in self.threads))
+
+        self.assertEqual(replies, ["Hi!", "Hi!"])
+        self.assertEqual(len(calls), 1)
+
+
+class HistorySummaryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        background.clear()
+        for i in range(6):
+            ollama_utils.save_message(self.thread, "user", f"question {i} " * 50)
+            ollama_utils.save_message(self.thread, "bot", f"answer {i} " * 50)
+        self.thread.refresh_from_db()
+
+    def build(self, max_tokens):
+        with patch(
+            "chat.context_window.CONTEXT_TOKEN_BUDGET", max_tokens
+        ), patch.object(summaries, "schedule") as schedule:
+            messages = ollama_utils.build_thread_messages(self.thread, "llama3.1")
+        return messages, schedule
+
+    def test_dropped_turns_are_queued_for_summary(self):
+        messages, schedule = self.build(max_tokens=600)
+        dropped = 12 - (len(messages) - 1)
+        self.assertGreater(dropped, 0)
+        schedule.assert_called_once_with(self.thread.id, dropped)
+        self.assertEqual(messages[0], ollama_utils.SYSTEM_PROMPT)
+
+    def test_summary_replaces_the_messages_it_covers(self):
+        self.thread.history_summary = "The user asked six questions."
+        self.thread.summarized_messages = 10
+        messages, schedule = self.build(max_tokens=10000)
+
+        self.assertTrue(
+            messages[0]["content"].startswith(ollama_utils.SYSTEM_PROMPT["content"])
+        )
+        self.assertTrue(
+            messages[0]["content"].endswith("The user asked six questions.")
+        )
+        self.assertEqual(
+            [m["content"] for m in messages[1:]],
+            ["question 5 " * 50, "answer 5 " * 50],
+        )
+        schedule.assert_not_called()
+
+    def test_summarize_folds_new_turns_into_the_summary(self):
+        ChatThread.objects.filter(id=self.thread.id).update(
+            history_summary="Earlier summary", summarized_messages=2
+        )
+        fake_client = FakeOllamaClient(["Updated summary"])
+        with patch.object(summaries, "SUMMARY_MODEL", "small"), patch(
+            "chat.ollama_clients.get_client", return_value=fake_client
+        ):
+            self.assertTrue(summaries.summarize(self.thread.id, 6))
+            self.assertFalse(summaries.summarize(self.thread.id, 4))
+
+        prompt = fake_client.calls[0][1]["content"]
+        self.assertIn("Earlier summary", prompt)
+        self.assertNotIn("question 0", prompt)
+        self.assertIn("question 1", prompt)
+        self.assertIn("answer 2", prompt)
+        self.assertNotIn("question 3", prompt)
+
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.history_summary, "Updated summary")
+        self.assertEqual(self.thread.summarized_messages, 6)
+        self.assertEqual(len(fake_client.calls), 1)
+
+    def test_off_without_a_summary_model(self):
+        with patch.object(summaries, "SUMMARY_MODEL", None):
+            summaries.schedule(self.thread.id, 4)
+        self.assertEqual(background.worker.pending(), set())
+
+
+class RetrievalMemoryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        memory.clear()
+        for sender, content in (
+            ("user", "capital of france?"),
+            ("bot", "Paris is the capital of France."),
+            ("user", "a python question"),
+            ("bot", "a python answer"),
+            ("user", "weather today?"),
+            ("bot", "sunny weather"),
+        ):
+            ollama_utils.save_message(self.thread, sender, content)
+        for _ in range(2):
+            ollama_utils.save_message(self.thread, "user", "hello " * 100)
+            ollama_utils.save_message(self.thread, "bot", "hello " * 100)
+        ollama_utils.save_message(self.thread, "user", "What about the weather?")
+        self.thread.refresh_from_db()
+        self.fake_client = EmbeddingOllamaClient(["Hi"])
+        for target, name, value in (
+            (memory, "MEMORY_MODEL", "embed"),
+            (memory, "MEMORY_TOKENS", 1000),
+            (memory, "background", MagicMock()),
+            (ollama_clients, "get_client", lambda host: self.fake_client),
+            (ollama_utils, "initialize_client", lambda host: self.fake_client),
+        ):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_index_stores_unit_float16_vectors_once(self):
+        self.assertEqual(memory.index(self.thread.id, 6), 6)
+        self.assertEqual(memory.index(self.thread.id, 6), 0)
+
+        vector = MessageEmbedding.objects.get(message__content="sunny weather").vector
+        vector = memory.np.frombuffer(bytes(vector), dtype=memory.np.float16)
+        self.assertEqual(len(vector), len(EmbeddingOllamaClient.KEYWORDS))
+        self.assertAlmostEqual(float(memory.np.linalg.norm(vector)), 1.0, places=2)
+
+    def test_relevant_older_messages_are_recalled(self):
+        memory.index(self.thread.id, 6)
+        with patch("chat.context_window.CONTEXT_TOKEN_BUDGET", 1500):
+            messages = ollama_utils.build_thread_messages(self.thread, "llama3.1")
+
+        self.assertEqual(messages[0], ollama_utils.SYSTEM_PROMPT)
+        self.assertEqual(messages[-1]["content"], "What about the weather?")
+        recalled = messages[-2]
+        self.assertEqual(recalled["role"], "system")
+        self.assertIn("user: weather today?", recalled["content"])
+        self.assertIn("assistant: sunny weather", recalled["content"])
+        self.assertNotIn("python", recalled["content"])
+        self.assertNotIn("sunny weather", [m["content"] for m in messages])
+        memory.background.submit.assert_called_once_with(
+            ("memory", self.thread.id), memory.index, self.thread.id, 9
+        )
+
+    def test_nothing_recalled_without_indexed_messages(self):
+        with patch("chat.context_window.CONTEXT_TOKEN_BUDGET", 1500):
+            messages = ollama_utils.build_thread_messages(self.thread, "llama3.1")
+        self.assertEqual([m["role"] for m in messages], ["system", "assistant", "user"])
+
+    def test_top_k_ranks_by_cosine_similarity(self):
+        matrix = memory.np.array([[1, 0], [0.6, 0.8], [0, 1]], dtype=memory.np.float16)
+        self.assertEqual(memory.top_k(matrix, [2, 0], 2, 0.5), [0, 1])
+        self.assertEqual(memory.top_k(matrix, [0, 1], 5, 0.9), [2])
+
+
+class MessageSearchTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.client.force_login(self.user)
+        self.thread = ChatThread.objects.create(user=self.user, title="Snakes")
+        cache.clear()  # Rate limit counts
+
+    def search(self, q, **params):
+        response = self.client.get(reverse("search_messages"), {"q": q, **params})
+        return response.status_code, json.loads(response.content)
+
+    def test_finds_only_the_users_messages_ranked(self):
+        ChatMessage.objects.create(
+            thread=self.thread,
+            sender="user",
+            content="A long message that mentions Python once among many other words",
+        )
+        best = ChatMessage.objects.create(
+            thread=self.thread, sender="bot", content="Python, python and python"
+        )
+        other = User.objects.create_user(
+            username="other", email="other@example.com", password="testpassword"
+        )
+        ChatMessage.objects.create(
+            thread=ChatThread.objects.create(user=other),
+            sender="user",
+            content="python",
+        )
+
+        status, data = self.search("python")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data["results"]), 2)
+        first = data["results"][0]
+        self.assertEqual(first["message_id"], best.id)
+        self.assertEqual(first["thread_title"], "Snakes")
+        self.assertIn({"text": "Python", "match": True}, first["snippet"])
+        self.assertFalse(data["has_more"])
+
+    def test_owner_tokens_in_text_match_nobody(self):
+        other = User.objects.create_user(
+            username="other", email="other@example.com", password="testpassword"
+        )
+        ChatMessage.objects.create(
+            thread=ChatThread.objects.create(user=other),
+            sender="user",
+            content=f"owner{self.user.id} python",
+        )
+        self.assertEqual(self.search("python")[1]["results"], [])
+        self.assertEqual(self.search(f"owner{other.id}")[1]["results"], [])
+
+    def test_index_follows_edits_and_deletes(self):
+        message = ChatMessage.objects.create(
+            thread=self.thread, sender="bot", content="draft"
+        )
+        message.content = "final answer"
+        message.save(update_fields=["content"])
+        self.assertEqual(self.search("draft")[1]["results"], [])
+        self.assertEqual(len(self.search("final")[1]["results"]), 1)
+
+        self.thread.delete()
+        self.assertEqual(self.search("final")[1]["results"], [])
+
+    def test_paginates_by_offset(self):
+        for i in range(5):
+            ChatMessage.objects.create(
+                thread=self.thread, sender="user", content=f"note {i}"
+            )
+
+        _, data = self.search("note", limit=2)
+        self.assertEqual(len(data["results"]), 2)
+        self.assertTrue(data["has_more"])
+        self.assertEqual(data["next_offset"], 2)
+
+        _, data = self.search("note", limit=2, offset=4)
+        self.assertEqual(len(data["results"]), 1)
+        self.assertIsNone(data["next_offset"])
+
+    def test_any_text_is_a_valid_query(self):
+        ChatMessage.objects.create(
+            thread=self.thread, sender="user", content="What does NEAR mean?"
+        )
+        self.assertEqual(search.fts_query('near "x AND (y*'), '"near" "x" "AND" "y"*')
+        self.assertEqual(
+            search.fts_query("x", user_id=3), 'owner : "owner3" AND content : ("x"*)'
+        )
+        status, data = self.search('NEAR("')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data["results"]), 1)
+        self.assertEqual(self.search("?!")[1]["results"], [])
+
+    def test_other_databases_fall_back_to_a_scan(self):
+        ChatMessage.objects.create(
+            thread=self.thread, sender="user", content="Tell me about Python"
+        )
+        with patch.object(connection, "vendor", "mysql"):
+            results = search.search(self.user.id, "python")
+        self.assertEqual(
+            results[0]["snippet"],
+            [
+                {"text": "…", "match": False},
+                {"text": "Python", "match": True},
+            ],
+        )
+
+    def test_rejects_bad_parameters(self):
+        self.assertEqual(self.search("")[0], 400)
+        self.assertEqual(self.search("x", offset=-1)[0], 400)
+        self.assertEqual(self.search("x", limit="ten")[0], 400)
+
+
+class WriteBehindTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser", email="testuser@example.com", password="testpassword"
+        )
+        self.thread = ChatThread.objects.create(user=self.user)
+        conversations.clear()
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        # No background thread: the tests flush themselves
+        self.queue = write_behind.WriteBehindQueue(self.spool_dir, 0, 500)
+        for name, value in [("WRITE_BEHIND", True), ("queue", self.queue)]:
+            patcher = patch.object(write_behind, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def spool_files(self):
+        return sorted(p.name for p in self.queue.spool.directory.iterdir())
+
+    def test_messages_are_saved_in_one_batch(self):
+        with self.assertNumQueries(0):
+            message = ollama_utils.save_message(self.thread, "user", "Hi")
+            ollama_utils.save_message(self.thread, "bot", "Hello!")
+        self.assertIsNone(message.id)
+        self.assertFalse(ChatMessage.objects.exists())
+        with open(self.queue.spool.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        self.assertEqual(write_behind.flush(), 2)
+        self.assertEqual(
+            list(
+                ChatMessage.objects.order_by("created_at").values_list(
+                    "sender", "content"
+                )
+            ),
+            [("user", "Hi"), ("bot", "Hello!")],
+        )
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.message_count, 2)
+        self.assertEqual(self.thread.last_message_preview, "Hello!")
+        self.assertEqual(self.spool_files(), [])
+        self.assertEqual(write_behind.flush(), 0)
+
+    def test_window_includes_queued_messages(self):
+        ChatMessage.objects.create(thread=self.thread, sender="user", content="Hi")
+        ollama_utils.save_message(self.thread, "bot", "Hello!")
+        expected = [
+            {"role": "user", "content": "Hi"},
+            {"role": "assistant", "content": "Hello!"},
+        ]
+        self.assertEqual(conversations.get_history(self.thread.id), expected)
+
+        conversations.clear()
+        self.assertEqual(conversations.get_history(self.thread.id), expected)
+
+        # Saved but not yet taken off the queue
+        self.queue._save(self.queue.pending(self.thread.id))
+        conversations.clear()
+        self.assertEqual(conversations.get_history(self.thread.id), expected)
+
+    def test_failed_batch_stays_queued(self):
+        ollama_utils.save_message(self.thread, "user", "Hi")
+        with patch.object(
+            ChatMessage.objects, "bulk_create", side_effect=Exception("locked")
+        ):
+            with self.assertRaises(Exception):
+                write_behind.flush()
+        self.assertEqual(len(self.queue.pending(self.thread.id)), 1)
+        self.assertEqual(len(self.spool_files()), 1)
+
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertEqual(self.spool_files(), [])
+
+    def test_bad_messages_go_to_dead_letter_file(self):
+        with patch.object(write_behind, "WRITE_BEHIND_MAX_ATTEMPTS", 2):
+            self.queue.add(self.thread, "user", None)  # Violates NOT NULL
+            ollama_utils.save_message(self.thread, "user", "Hi")
+            self.assertEqual(write_behind.flush(), 1)
+            self.assertEqual(len(self.queue.pending(self.thread.id)), 1)
+
+            ollama_utils.save_message(self.thread, "bot", "Hello!")
+            self.assertEqual(write_behind.flush(), 1)
+
+        self.assertEqual(self.queue.pending(self.thread.id), [])
+        self.assertEqual(
+            sorted(ChatMessage.objects.values_list("content", flat=True)),
+            ["Hello!", "Hi"],
+        )
+        self.assertEqual(self.spool_files(), [write_behind.DEAD_LETTER_FILE])
+        with open(self.queue.spool.directory / write_behind.DEAD_LETTER_FILE) as f:
+            dead = [json.loads(line) for line in f]
+        self.assertEqual([(r["content"], r["attempts"]) for r in dead], [(None, 2)])
+
+    def test_recovers_spool_of_exited_worker(self):
+        crashed = write_behind.WriteBehindQueue(self.spool_dir, 0, 500)
+        crashed.add(self.thread, "user", "Hi")
+        crashed.add(self.thread, "bot", "Hello!")
+        # It saved the first message, then died before deleting its spool
+        crashed._save(crashed.pending(self.thread.id)[:1])
+        crashed.spool._file.close()
+
+        self.assertEqual(self.queue.recover(), 1)
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(
+            sorted(ChatMessage.objects.values_list("content", flat=True)),
+            ["Hello!", "Hi"],
+        )
+        self.assertEqual(self.spool_files(), [])
+
+    def test_messages_of_deleted_threads_are_dropped(self):
+        ollama_utils.save_message(self.thread, "user", "Hi")
+        self.thread.delete()
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertFalse(ChatMessage.objects.exists())
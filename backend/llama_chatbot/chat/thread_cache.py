@@ -0,0 +1,48 @@
+import os
+import uuid
+
+from django.core.cache import cache
+
+# How long a user's cached thread list pages are kept, in seconds
+THREAD_LIST_CACHE_TIMEOUT = int(os.getenv("CHAT_THREAD_LIST_CACHE_TIMEOUT", "300"))
+
+
+def _version_key(user_id):
+    return f"chat:threads-version:{user_id}"
+
+
+def _page_key(user_id, version, before, limit):
+    return f"chat:threads:{user_id}:{version}:{before or ''}:{limit}"
+
+
+def version(user_id):
+    """
+    Return the user's current thread list version.
+
+    The version is a random token replaced by invalidate, so it doubles as
+    the ETag of the list. If the cache evicts it, a fresh token is issued and
+    clients simply refetch once.
+    """
+    return cache.get_or_set(_version_key(user_id), uuid.uuid4().hex, None)
+
+
+def invalidate(user_id):
+    """
+    Mark the user's thread list as changed: a thread was created, renamed,
+    deleted or received a message.
+
+    chat.signals calls it for every saved or deleted thread and every saved
+    message. Writes that bypass signals, like bulk_create or
+    QuerySet.update, must call it themselves.
+    """
+    cache.set(_version_key(user_id), uuid.uuid4().hex, None)
+
+
+def get_page(user_id, version, before, limit):
+    return cache.get(_page_key(user_id, version, before, limit))
+
+
+def set_page(user_id, version, before, limit, page):
+    cache.set(
+        _page_key(user_id, version, before, limit), page, THREAD_LIST_CACHE_TIMEOUT
+    )
@@ -7,6 +7,24 @@ urlpatterns = [
         views.chat_with_model_stream,
         name="chat_with_model_stream",
     ),
+    # Stop a running generation from another request
+    path(
+        "streaming-response/<int:thread_id>/cancel/",
+        views.cancel_stream,
+        name="cancel_stream",
+    ),
+    # Replay a generation from a byte offset and follow its live output
+    path(
+        "streaming-response/<int:thread_id>/<uuid:generation_id>/",
+        views.resume_stream,
+        name="resume_stream",
+    ),
+    # Async streaming response for the ASGI application
+    path(
+        "streaming-response-async/<int:thread_id>/",
+        views.chat_with_model_stream_async,
+        name="chat_with_model_stream_async",
+    ),
     path("response/<int:thread_id>/", views.chat_with_model, name="chat_with_model"),
     # Get all messages for a specific thread
     path(
@@ -28,4 +46,8 @@ urlpatterns = [
     path("threads/<int:thread_id>/delete/", views.delete_thread, name="delete_thread"),
     # Delete all threads for user
     path("threads/delete/", views.delete_all_threads, name="delete_all_threads"),
+    # Full-text search over the user's messages
+    path("search/", views.search_messages, name="search_messages"),
+    # Model queue depth and wait times (staff only)
+    path("admission/", views.admission_stats, name="admission_stats"),
 ]
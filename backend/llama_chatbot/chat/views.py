@@ -1,19 +1,47 @@
-from django.http import JsonResponse, StreamingHttpResponse
-from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.csrf import csrf_exempt
+import hmac
 import json
 from .models import ChatThread, ChatMessage
 from django.shortcuts import get_object_or_404
-from . import ollama_utils
-import threading
+from . import (
+    admission,
+    backends,
+    conversations,
+    events,
+    generations,
+    metrics,
+    ollama_utils,
+    pagination,
+    response_cache,
+    resumable,
+    search,
+    streaming,
+    thread_cache,
+)
 from django_ratelimit.decorators import ratelimit
+from .decorators import async_ratelimit
 from django_ratelimit.exceptions import Ratelimited
 import logging
 
 logger = logging.getLogger("chat")
 
 
+def overloaded_response(error):
+    # 503 with a Retry-After hint when the model queue is full
+    response = JsonResponse({"error": "Server busy, please retry later"}, status=503)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def is_admin(user):
+    return user.is_staff or user.is_superuser
+
+
 @login_required
 @require_POST
 @csrf_exempt
@@ -25,8 +53,6 @@ def chat_with_model_stream(request, thread_id):
                 f"Chat request received for thread_id: {thread_id} by user: {request.user.username}"
             )
 
-            cancellation_event = threading.Event()  # Per-request cancellation event
-
             try:
                 # Parse the JSON body
                 data = json.loads(request.body)
@@ -41,33 +67,53 @@ def chat_with_model_stream(request, thread_id):
                     f"User {request.user.username} sent a message: {user_message}"
                 )
 
-                # Truncate the context
-                context_str = ollama_utils.truncate_context(user_message)
+                # Fail fast if too many requests are already waiting
+                queue_position = admission.gate.check(request.user.id)
 
                 # Retrieve the chat thread
                 thread = ollama_utils.get_thread(thread_id, request.user)
                 logger.debug(f"Thread retrieved for thread_id: {thread_id}")
 
-                # Save the user message
-                ollama_utils.save_user_message(thread, user_message)
+                # Save the user message and build the model prompt
+                messages = ollama_utils.prepare_turn(
+                    thread,
+                    user_message,
+                    "llama3.1",
+                    server_history=data.get("history") == "server",
+                )
                 logger.info(
                     f"User message saved for thread_id: {thread_id} and user: {request.user.username}"
                 )
 
-                # Create a generator to stream the response
+                # Create a generator to stream the response, as typed
+                # events if the client asked for Server-Sent Events
+                sse = events.wants_sse(request)
+                generation = generations.start(thread.id)
                 response_generator = ollama_utils.stream_response(
                     request,
                     model_name="llama3.1",
-                    context=context_str,
+                    messages=messages,
                     thread=thread,
-                    cancellation_event=cancellation_event,
+                    generation=generation,
+                    typed=sse,
+                    queue_position=queue_position,
                 )
+                content_type = "text/plain"
+                if sse:
+                    response_generator = events.encode_sse(response_generator)
+                    content_type = events.SSE_CONTENT_TYPE
+
+                # Keep the output so a dropped client can resume it
+                replay = resumable.start(generation, response_generator, content_type)
 
                 # Return a StreamingHttpResponse to stream data back to the client
+                # Write tokens in batches rather than one tiny chunk each
                 response = StreamingHttpResponse(
-                    response_generator, content_type="text/plain"
+                    streaming.coalesce(replay.follow()), content_type=content_type
                 )
                 response["Cache-Control"] = "no-cache"
+                response["X-Generation-Id"] = generation.id
+                response["X-Queue-Position"] = str(queue_position)
                 logger.info(f"Streaming response initiated for thread_id: {thread_id}")
                 return response
 
@@ -75,6 +121,10 @@ def chat_with_model_stream(request, thread_id):
                 logger.error("JSON decoding error during chat request", exc_info=True)
                 return JsonResponse({"error": "Invalid JSON"}, status=400)
 
+            except admission.Overloaded as e:
+                logger.warning(f"Model queue full, rejecting chat request: {e}")
+                return overloaded_response(e)
+
             except (ConnectionError, BrokenPipeError) as e:
                 logger.error(f"Connection error occurred: {e}", exc_info=True)
                 return JsonResponse({"error": "Connection error occurred"}, status=500)
@@ -93,6 +143,192 @@ def chat_with_model_stream(request, thread_id):
         return JsonResponse({"error": "Rate limit exceeded"}, status=429)
 
 
+@login_required
+@require_POST
+@csrf_exempt
+@ratelimit(key="user_or_ip", rate="30/m", method=["POST"])
+def cancel_stream(request, thread_id):
+    try:
+        # Log the cancellation attempt
+        logger.info(
+            f"User {request.user.username} is cancelling the stream of thread {thread_id}."
+        )
+
+        # Only the thread's owner may stop its generation
+        thread = get_object_or_404(ChatThread, id=int(thread_id), user=request.user)
+
+        # Stop the generation in whichever worker process is running it
+        running_here = generations.cancel(thread.id)
+
+        logger.info(
+            f"Cancellation requested for thread {thread_id} (running in this process: {running_here})."
+        )
+
+        return JsonResponse({"status": "Cancellation requested"}, status=202)
+
+    except Http404:
+        logger.warning(
+            f"Chat thread {thread_id} not found for user {request.user.username}"
+        )
+        return JsonResponse({"error": "Thread not found"}, status=404)
+
+    except Exception as e:
+        # Log any unexpected errors
+        logger.error(
+            f"Unexpected error while cancelling the stream of thread {thread_id} for user {request.user.username}: {e}",
+            exc_info=True,
+        )
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+@login_required
+@require_GET
+@ratelimit(key="user_or_ip", rate="30/m", method=["GET"])
+def resume_stream(request, thread_id, generation_id):
+    try:
+        offset = int(request.GET.get("offset", 0))
+        if offset < 0:
+            raise ValueError("Negative offset")
+
+        # Only the thread's owner may read its generation
+        thread = get_object_or_404(ChatThread, id=int(thread_id), user=request.user)
+
+        replay = resumable.get(str(generation_id))
+        if replay is None or replay.thread_id != thread.id:
+            logger.info(
+                f"Generation {generation_id} of thread {thread_id} is not available to resume."
+            )
+            return JsonResponse({"error": "Generation not found"}, status=404)
+
+        # Replay what the client missed, then follow the live output
+        replay.check(offset)
+        if isinstance(replay, resumable.AsyncReplayStream):
+            content = streaming.acoalesce(replay.afollow(offset))
+        else:
+            content = streaming.coalesce(replay.follow(offset))
+
+        logger.info(
+            f"Resuming generation {generation_id} of thread {thread_id} at byte {offset}."
+        )
+        response = StreamingHttpResponse(content, content_type=replay.content_type)
+        response["Cache-Control"] = "no-cache"
+        response["X-Generation-Id"] = replay.id
+        return response
+
+    except resumable.OffsetGone as e:
+        return JsonResponse({"error": str(e)}, status=410)
+
+    except ValueError:
+        return JsonResponse({"error": "Invalid offset"}, status=400)
+
+    except Http404:
+        logger.warning(
+            f"Chat thread {thread_id} not found for user {request.user.username}"
+        )
+        return JsonResponse({"error": "Thread not found"}, status=404)
+
+    except Exception as e:
+        logger.error(
+            f"Unexpected error while resuming generation {generation_id} of thread {thread_id}: {e}",
+            exc_info=True,
+        )
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+@login_required
+@require_POST
+@csrf_exempt
+@async_ratelimit(
+    group="chat.views.chat_with_model_stream",
+    key="user_or_ip",
+    rate="10/m",
+    method=["POST"],
+)
+async def chat_with_model_stream_async(request, thread_id):
+    # Async variant of chat_with_model_stream for the ASGI application. The
+    # generation is awaited on the event loop instead of holding a thread.
+    user = await request.auser()
+    logger.debug(
+        f"Async chat request received for thread_id: {thread_id} by user: {user.username}"
+    )
+
+    try:
+        # Parse the JSON body
+        data = json.loads(request.body)
+        user_message = data.get("message")
+
+        if not user_message:
+            logger.warning("No message provided in the chat request")
+            return JsonResponse({"error": "No message provided"}, status=400)
+
+        # Fail fast if too many requests are already waiting
+        queue_position = admission.gate.check(user.id)
+
+        # Retrieve the chat thread
+        thread = await ollama_utils.aget_thread(thread_id, user)
+        logger.debug(f"Thread retrieved for thread_id: {thread_id}")
+
+        # Save the user message and build the model prompt
+        messages = await ollama_utils.aprepare_turn(
+            thread,
+            user_message,
+            "llama3.1",
+            server_history=data.get("history") == "server",
+        )
+        logger.info(
+            f"User message saved for thread_id: {thread_id} and user: {user.username}"
+        )
+
+        # Create an async generator to stream the response, as typed events
+        # if the client asked for Server-Sent Events
+        sse = events.wants_sse(request)
+        generation = await generations.astart(thread.id)
+        response_generator = ollama_utils.astream_response(
+            model_name="llama3.1",
+            messages=messages,
+            thread=thread,
+            generation=generation,
+            typed=sse,
+            queue_position=queue_position,
+        )
+        content_type = "text/plain"
+        if sse:
+            response_generator = events.aencode_sse(response_generator)
+            content_type = events.SSE_CONTENT_TYPE
+
+        # Keep the output so a dropped client can resume it
+        replay = resumable.astart(generation, response_generator, content_type)
+
+        # Write tokens in batches rather than one tiny chunk each
+        response = StreamingHttpResponse(
+            streaming.acoalesce(replay.afollow()), content_type=content_type
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Generation-Id"] = generation.id
+        response["X-Queue-Position"] = str(queue_position)
+        logger.info(f"Async streaming response initiated for thread_id: {thread_id}")
+        return response
+
+    except json.JSONDecodeError:
+        logger.error("JSON decoding error during chat request", exc_info=True)
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    except admission.Overloaded as e:
+        logger.warning(f"Model queue full, rejecting chat request: {e}")
+        return overloaded_response(e)
+
+    except Http404:
+        raise
+
+    except (ConnectionError, BrokenPipeError) as e:
+        logger.error(f"Connection error occurred: {e}", exc_info=True)
+        return JsonResponse({"error": "Connection error occurred"}, status=500)
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}", exc_info=True)
+        return JsonResponse({"error": "An unexpected error occurred"}, status=500)
+
+
 @login_required
 @require_POST
 @csrf_exempt
@@ -107,56 +343,88 @@ def chat_with_model(request, thread_id):
                 if not user_message:
                     return JsonResponse({"error": "No message provided"}, status=400)
 
-                context_str = ollama_utils.truncate_context(user_message)
+                # Fail fast if too many requests are already waiting
+                admission.gate.check(request.user.id)
 
                 # Retrieve the chat thread
                 thread = ollama_utils.get_thread(thread_id, request.user)
 
-                # Save the user message
-                ollama_utils.save_user_message(thread, user_message)
+                # Save the user message and build the model prompt
+                messages = ollama_utils.prepare_turn(
+                    thread,
+                    user_message,
+                    "llama3.1",
+                    server_history=data.get("history") == "server",
+                )
 
                 try:
-                    # Initialize the Client
-                    client = ollama_utils.initialize_client()
-
-                    try:
-                        # Get the response from the model
-                        response = client.chat(
-                            model="llama3.1",
-                            messages=[{"role": "user", "content": context_str}],
-                        )
-
-                        # Check if response is valid and extract the content
-                        if isinstance(response, dict) and "message" in response:
-                            message_content = response["message"].get("content", "")
-                        else:
-                            print("Unexpected response format:", response)
-                            message_content = ""
-
-                    except Exception as e:
-                        print("Error during API request:", str(e))
+                    # Answer prompts seen before from the response cache
+                    cached = response_cache.lookup(
+                        "llama3.1",
+                        messages,
+                        lambda text: ollama_utils.embed(text, thread.id),
+                    )
+                    if cached is not None and cached.parts is not None:
+                        response = {"message": {"content": "".join(cached.parts)}}
+                    else:
+                        # Get the response from the model once a slot is free,
+                        # from the Ollama host picked for this thread
+                        with admission.gate.admit(request.user.id):
+                            with backends.pool.lease(thread.id) as backend:
+                                client = ollama_utils.initialize_client(backend.host)
+                                response = client.chat(
+                                    model="llama3.1",
+                                    messages=messages,
+                                    **ollama_utils.chat_options(),
+                                )
+                                ollama_utils.record_usage(backend, response)
+
+                    # Check if response is valid and extract the content. The
+                    # client returns a ChatResponse, which reads like a dict.
+                    if response is not None and "message" in response:
+                        message_content = response["message"].get("content") or ""
+                        # Only a complete reply is worth serving again
+                        if message_content and response.get("done", True):
+                            response_cache.store(cached, [message_content])
+                    else:
+                        print("Unexpected response format:", response)
                         message_content = ""
 
                 except Exception as e:
-                    print("Error initializing the Client:", str(e))
+                    print("Error during API request:", str(e))
                     message_content = ""
 
                 # Create and save the bot response
-                ChatMessage.objects.create(
-                    thread=thread, sender="bot", content=message_content
-                )
+                ollama_utils.save_message(thread, "bot", message_content)
 
                 # Return the response as JSON
                 return JsonResponse({"response": message_content})
 
             except json.JSONDecodeError:
                 return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+            except admission.Overloaded as e:
+                return overloaded_response(e)
         else:
             return JsonResponse({"error": "Method not allowed"}, status=405)
     except Ratelimited:
         return JsonResponse({"error": "Rate limit exceeded"}, status=429)
 
 
+def serialize_message(row):
+    return {
+        "id": row["id"],
+        "sender": row["sender"],
+        "content": row["content"],
+        "created_at": row["created_at"],
+        "cursor": pagination.encode_cursor(row["created_at"], row["id"]),
+    }
+
+
+def serialize_message_line(row):
+    return json.dumps(serialize_message(row), cls=DjangoJSONEncoder) + "\n"
+
+
 @login_required
 @csrf_exempt
 @require_GET
@@ -170,25 +438,67 @@ def get_thread_messages(request, thread_id):
             )
 
             # Get the chat thread
-            thread = get_object_or_404(ChatThread, id=int(thread_id), user=request.user)
+            thread = ChatThread.objects.get(id=int(thread_id), user=request.user)
 
-            # Get all messages for this thread
-            messages = thread.messages.all().order_by("created_at")
-            messages_list = [
-                {
-                    "sender": message.sender.username,
-                    "content": message.content,
-                    "created_at": message.created_at,
-                }
-                for message in messages
-            ]
+            try:
+                limit = pagination.page_size(request.GET.get("limit"))
+                messages = thread.messages.values(
+                    "id", "sender", "content", "created_at"
+                )
+                if request.GET.get("after"):
+                    messages = pagination.after(
+                        messages, "created_at", request.GET["after"]
+                    )
+                if request.GET.get("before"):
+                    messages = pagination.before(
+                        messages, "created_at", request.GET["before"]
+                    )
+            except ValueError:
+                logger.warning(
+                    f"Invalid pagination parameters for thread {thread_id} by user {request.user.username}"
+                )
+                return JsonResponse({"error": "Invalid cursor or limit"}, status=400)
+
+            if request.GET.get("format") == "ndjson":
+                # Stream every matching message without holding them in memory
+                rows = messages.order_by("created_at", "id").iterator(chunk_size=500)
+                response = StreamingHttpResponse(
+                    (serialize_message_line(row) for row in rows),
+                    content_type="application/x-ndjson",
+                )
+                response["Cache-Control"] = "no-cache"
+                logger.info(
+                    f"Streaming messages for thread {thread_id} to user {request.user.username}"
+                )
+                return response
+
+            if request.GET.get("after"):
+                # Page forward from the cursor, oldest first
+                rows = list(messages.order_by("created_at", "id")[: limit + 1])
+                has_more = len(rows) > limit
+                rows = rows[:limit]
+            else:
+                # Page backward from the cursor (or the newest message)
+                rows = list(messages.order_by("-created_at", "-id")[: limit + 1])
+                has_more = len(rows) > limit
+                rows = rows[:limit][::-1]
+
+            messages_list = [serialize_message(row) for row in rows]
 
             # Log successful message retrieval
             logger.info(
                 f"Successfully retrieved {len(messages_list)} messages for thread {thread_id} by user {request.user.username}"
             )
 
-            return JsonResponse({"messages": messages_list}, status=200)
+            return JsonResponse(
+                {
+                    "messages": messages_list,
+                    "has_more": has_more,
+                    "before": messages_list[0]["cursor"] if messages_list else None,
+                    "after": messages_list[-1]["cursor"] if messages_list else None,
+                },
+                status=200,
+            )
         else:
             # Log an invalid request method
             logger.warning(
@@ -273,27 +583,72 @@ def get_user_threads(request):
         # Log the attempt to retrieve threads
         logger.info(f"User {request.user.username} is retrieving their chat threads.")
 
-        # Retrieve all chat threads for the logged-in user
-        threads = ChatThread.objects.filter(user=request.user)
-
-        # Serialize the threads
-        thread_data = [
-            {
-                "id": thread.id,
-                "title": thread.title,
-                "created_at": thread.created_at,
-                "updated_at": thread.updated_at,
+        try:
+            limit = pagination.page_size(request.GET.get("limit"))
+            before = request.GET.get("before") or None
+            if before:
+                pagination.decode_cursor(before)
+        except ValueError:
+            logger.warning(
+                f"Invalid pagination parameters for threads of user {request.user.username}"
+            )
+            return JsonResponse({"error": "Invalid cursor or limit"}, status=400)
+
+        # The list version changes whenever a thread is created, renamed,
+        # deleted or gets a message, so it is a cheap validator for the page.
+        version = thread_cache.version(request.user.id)
+        etag = f'W/"{version}-{limit}-{before or 0}"'
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            logger.info(f"Threads of user {request.user.username} not modified.")
+            response = HttpResponse(status=304)
+            response["ETag"] = etag
+            return response
+
+        page = thread_cache.get_page(request.user.id, version, before, limit)
+        if page is None:
+            # Newest first, straight from the (user, updated_at) index
+            threads = ChatThread.objects.filter(user=request.user)
+            if before:
+                threads = pagination.before(threads, "updated_at", before)
+            rows = list(
+                threads.order_by("-updated_at", "-id").values(
+                    "id",
+                    "title",
+                    "created_at",
+                    "updated_at",
+                    "message_count",
+                    "last_message_at",
+                    "last_message_preview",
+                )[: limit + 1]
+            )
+            thread_data = rows[:limit]
+            page = {
+                "threads": thread_data,
+                "has_more": len(rows) > limit,
+                "before": (
+                    pagination.encode_cursor(
+                        thread_data[-1]["updated_at"], thread_data[-1]["id"]
+                    )
+                    if thread_data
+                    else None
+                ),
             }
-            for thread in threads
-        ]
+            thread_cache.set_page(request.user.id, version, before, limit, page)
 
         # Log successful retrieval of threads
         logger.info(
-            f"User {request.user.username} successfully retrieved {len(thread_data)} threads."
+            f"User {request.user.username} successfully retrieved {len(page['threads'])} threads."
         )
 
         # Return the threads as JSON
-        return JsonResponse({"threads": thread_data})
+        response = JsonResponse(page)
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+        if page["threads"] and not before:
+            response["Last-Modified"] = http_date(
+                page["threads"][0]["updated_at"].timestamp()
+            )
+        return response
 
     except Ratelimited:
         # Log rate limit exceeded
@@ -340,7 +695,9 @@ def update_thread_title(request, thread_id):
 
                 # Update the thread's title
                 thread.title = new_title
-                thread.save()
+                # Leave columns written elsewhere, like the history summary
+                thread.save(update_fields=["title", "updated_at"])
+                conversations.invalidate(thread.id)
 
                 # Log successful title update
                 logger.info(
@@ -396,6 +753,7 @@ def delete_thread(request, thread_id):
 
             # Delete the chat thread
             thread.delete()
+            conversations.invalidate(int(thread_id))
 
             # Log successful deletion
             logger.info(
@@ -440,11 +798,13 @@ def delete_all_threads(request):
             # Retrieve all chat threads for the current user
             threads = ChatThread.objects.filter(user=request.user)
 
-            # Count the number of threads to be deleted
-            thread_count = threads.count()
+            # Collect the threads to be deleted
+            thread_ids = list(threads.values_list("id", flat=True))
+            thread_count = len(thread_ids)
 
             # Delete all retrieved chat threads
             threads.delete()
+            conversations.invalidate(*thread_ids)
 
             # Log the number of deleted threads
             logger.info(
@@ -475,3 +835,87 @@ def delete_all_threads(request):
             exc_info=True,
         )
         return JsonResponse({"error": str(e)}, status=500)
+
+
+@login_required
+@require_GET
+@csrf_exempt
+@ratelimit(key="user_or_ip", rate="30/m", method=["GET"])
+def search_messages(request):
+    try:
+        text = (request.GET.get("q") or "").strip()
+        if not text:
+            return JsonResponse({"error": "No query provided"}, status=400)
+
+        try:
+            limit = min(
+                pagination.page_size(
+                    request.GET.get("limit"), default=search.DEFAULT_PAGE_SIZE
+                ),
+                search.MAX_PAGE_SIZE,
+            )
+            offset = int(request.GET.get("offset") or 0)
+            if not 0 <= offset <= search.MAX_OFFSET:
+                raise ValueError("Offset out of range")
+        except ValueError:
+            logger.warning(
+                f"Invalid search pagination parameters from user {request.user.username}"
+            )
+            return JsonResponse({"error": "Invalid offset or limit"}, status=400)
+
+        # One extra row tells whether there is a next page, without counting
+        results = search.search(request.user.id, text, offset, limit + 1)
+        has_more = len(results) > limit
+        results = results[:limit]
+
+        logger.info(
+            f"User {request.user.username} searched their messages, {len(results)} results."
+        )
+        return JsonResponse(
+            {
+                "results": results,
+                "has_more": has_more,
+                "next_offset": offset + limit if has_more else None,
+            }
+        )
+
+    except Ratelimited:
+        logger.warning(
+            f"Rate limit exceeded for user {request.user.username} while searching messages."
+        )
+        return JsonResponse({"error": "Rate limit exceeded"}, status=429)
+
+    except Exception as e:
+        logger.error(
+            f"Unexpected error while searching messages for user {request.user.username}: {e}",
+            exc_info=True,
+        )
+        return JsonResponse({"error": "An unexpected error occurred"}, status=500)
+
+
+@user_passes_test(is_admin)
+@login_required
+@require_GET
+def admission_stats(request):
+    # Queue depth and wait times of the model admission gate in this process,
+    # and the load and health of each Ollama host
+    return JsonResponse({**admission.gate.stats(), "backends": backends.pool.stats()})
+
+
+def has_metrics_access(request):
+    # Prometheus authenticates with METRICS_TOKEN, people with a staff session
+    if metrics.METRICS_TOKEN:
+        expected = f"Bearer {metrics.METRICS_TOKEN}"
+        if hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            return True
+    return is_admin(request.user)
+
+
+@require_GET
+def prometheus_metrics(request):
+    # Stream timings, admission queue and Ollama host gauges of this process
+    if not has_metrics_access(request):
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
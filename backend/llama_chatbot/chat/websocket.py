@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.http import Http404, HttpRequest
+from django.http.cookie import parse_cookie
+from django_ratelimit.core import is_ratelimited
+
+from . import admission, events, generations, ollama_utils
+
+logger = logging.getLogger("chat")
+
+# Path llama_chatbot.asgi serves the chat WebSocket on
+WEBSOCKET_PATH = "/chat/ws/"
+
+# Close codes sent before the socket is accepted
+CLOSE_FORBIDDEN_ORIGIN = 4403
+CLOSE_UNAUTHENTICATED = 4401
+
+
+class ChatSocket:
+    """
+    One chat WebSocket, carrying any number of turns.
+
+    The user is authenticated from the session cookie once, when the socket
+    opens. Each turn then costs no HTTP request or session lookup and is
+    streamed back as the typed events of ollama_utils.stream_response, tagged
+    with its ``thread_id``. Turns on different threads run concurrently;
+    closing the socket stops them and saves their partial replies.
+
+    Client messages are JSON::
+
+        {"type": "message", "thread_id": 1, "message": "Hi", "history": "server"}
+        {"type": "cancel", "thread_id": 1}
+    """
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self.headers = {
+            name.decode("latin1"): value.decode("latin1")
+            for name, value in scope.get("headers", [])
+        }
+        self.user = None
+        self.turns = {}  # thread_id -> asyncio.Task
+        self.generations = {}  # thread_id -> generations.Generation
+        self._send_lock = asyncio.Lock()
+
+    async def run(self):
+        message = await self.receive()
+        if message["type"] != "websocket.connect":
+            return
+        if not self.origin_allowed():
+            logger.warning(
+                f"Rejected chat WebSocket from origin {self.headers['origin']}"
+            )
+            await self._send(
+                {"type": "websocket.close", "code": CLOSE_FORBIDDEN_ORIGIN}
+            )
+            return
+        self.user = await self.authenticate()
+        if not self.user.is_authenticated:
+            await self._send({"type": "websocket.close", "code": CLOSE_UNAUTHENTICATED})
+            return
+        await self._send({"type": "websocket.accept"})
+        logger.info(f"Chat WebSocket opened by user {self.user.username}")
+
+        try:
+            while True:
+                message = await self.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message["type"] == "websocket.receive":
+                    await self.handle(message.get("text") or message.get("bytes"))
+        finally:
+            # The socket is gone; stop its generations like a dropped stream
+            turns = list(self.turns.values())
+            for task in turns:
+                task.cancel()
+            await asyncio.gather(*turns, return_exceptions=True)
+            logger.info(f"Chat WebSocket closed by user {self.user.username}")
+
+    def origin_allowed(self):
+        # Browsers send the session cookie cross-site (SameSite=None), so
+        # only the frontend's origins may open a socket with it
+        origin = self.headers.get("origin")
+        if origin is None:
+            return True
+        if origin in settings.CSRF_TRUSTED_ORIGINS:
+            return True
+        return urlsplit(origin).netloc == self.headers.get("host")
+
+    async def authenticate(self):
+        cookies = parse_cookie(self.headers.get("cookie", ""))
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore(cookies.get(settings.SESSION_COOKIE_NAME))
+        # aget_user only reads the request's session
+        return await aget_user(SimpleNamespace(session=session))
+
+    async def ratelimited(self):
+        # Shares the streaming views' per-user limit
+        request = HttpRequest()
+        request.method = "POST"
+        request.user = self.user
+        request.META["REMOTE_ADDR"] = (self.scope.get("client") or ("",))[0]
+        return await sync_to_async(is_ratelimited)(
+            request=request,
+            group="chat.views.chat_with_model_stream",
+            key="user_or_ip",
+            rate="10/m",
+            method=["POST"],
+            increment=True,
+        )
+
+    async def send_event(self, thread_id, event):
+        async with self._send_lock:
+            await self._send(
+                {
+                    "type": "websocket.send",
+                    "text": json.dumps({**event, "thread_id": thread_id}),
+                }
+            )
+
+    async def handle(self, text):
+        try:
+            data = json.loads(text)
+            kind = data["type"]
+            thread_id = int(data["thread_id"])
+        except (TypeError, ValueError, KeyError):
+            await self.send_event(None, events.error("Invalid message"))
+            return
+
+        if kind == "cancel":
+            generation = self.generations.get(thread_id)
+            if generation is not None:
+                generation.set()
+            return
+        if kind != "message":
+            await self.send_event(thread_id, events.error("Invalid message"))
+            return
+
+        user_message = data.get("message")
+        if not user_message:
+            await self.send_event(thread_id, events.error("No message provided"))
+            return
+        if thread_id in self.turns:
+            await self.send_event(
+                thread_id, events.error("A reply is already being generated")
+            )
+            return
+        if await self.ratelimited():
+            logger.warning(f"Rate limit exceeded for user: {self.user.username}")
+            await self.send_event(thread_id, events.error("Rate limit exceeded"))
+            return
+
+        task = asyncio.create_task(
+            self.turn(thread_id, user_message, data.get("history") == "server")
+        )
+        self.turns[thread_id] = task
+        task.add_done_callback(lambda _: self.turns.pop(thread_id, None))
+
+    async def turn(self, thread_id, user_message, server_history):
+        try:
+            # Fail fast if too many requests are already waiting
+            queue_position = admission.gate.check(self.user.id)
+            thread = await ollama_utils.aget_thread(thread_id, self.user)
+            messages = await ollama_utils.aprepare_turn(
+                thread, user_message, "llama3.1", server_history=server_history
+            )
+        except admission.Overloaded as e:
+            logger.warning(f"Model queue full, rejecting chat message: {e}")
+            await self.send_event(
+                thread_id,
+                {
+                    **events.error("Server busy, please retry later"),
+                    "retry_after": e.retry_after,
+                },
+            )
+            return
+        except Http404:
+            await self.send_event(thread_id, events.error("Thread not found"))
+            return
+        except Exception as e:
+            logger.error(f"An unexpected error occurred: {e}", exc_info=True)
+            await self.send_event(
+                thread_id, events.error("An unexpected error occurred")
+            )
+            return
+
+        generation = await generations.astart(thread.id)
+        self.generations[thread_id] = generation
+        stream = ollama_utils.astream_response(
+            model_name="llama3.1",
+            messages=messages,
+            thread=thread,
+            generation=generation,
+            typed=True,
+            queue_position=queue_position,
+        )
+        try:
+            async for event in stream:
+                await self.send_event(thread_id, event)
+        finally:
+            await stream.aclose()
+            self.generations.pop(thread_id, None)
+
+
+def route(application):
+    """
+    Wrap the Django ASGI application so it also serves the chat WebSocket.
+    """
+
+    async def router(scope, receive, send):
+        if scope["type"] != "websocket":
+            return await application(scope, receive, send)
+        if scope["path"] == WEBSOCKET_PATH:
+            return await ChatSocket(scope, receive, send).run()
+        await receive()  # websocket.connect
+        await send({"type": "websocket.close"})
+
+    return router
@@ -0,0 +1,413 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import thread_cache
+from .models import PREVIEW_LENGTH, ChatMessage, ChatThread
+
+logger = logging.getLogger("chat")
+
+# Optional write-behind persistence: chat messages are queued and inserted
+# in batches by a background thread instead of one INSERT per message in
+# the request, so writers stop contending for the database lock. Messages
+# reach the database within WRITE_BEHIND_INTERVAL. Off unless set to 1.
+WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "0") == "1"
+# Seconds between batches; a batch is also written as soon as it holds
+# WRITE_BEHIND_BATCH messages
+WRITE_BEHIND_INTERVAL = float(os.getenv("CHAT_WRITE_BEHIND_INTERVAL", "0.5"))
+WRITE_BEHIND_BATCH = int(os.getenv("CHAT_WRITE_BEHIND_BATCH", "500"))
+# Local directory of the append-only spool files every queued message is
+# written to first. A worker that dies with messages queued leaves its
+# spool behind, and the next worker to queue a message saves them. The
+# default is in the project directory, which docker-compose mounts from
+# the host, so spools outlive the container; it is ignored by git.
+WRITE_BEHIND_SPOOL_DIR = Path(
+    os.getenv("CHAT_WRITE_BEHIND_SPOOL_DIR")
+    or Path(__file__).resolve().parent.parent / "spool"
+)
+# Failed batches in which a message could not be saved on its own while
+# others could, after which it is moved to the spool's dead-letter file
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("CHAT_WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+
+DEAD_LETTER_FILE = "dead-letter.jsonl"
+
+
+def _record(thread, sender, content):
+    return {
+        "thread_id": thread.id,
+        "user_id": thread.user_id,
+        "sender": sender,
+        "content": content,
+        "created_at": timezone.now().isoformat(),
+    }
+
+
+def created_at(record):
+    return datetime.fromisoformat(record["created_at"])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Spool:
+    """
+    The append-only file of one process's queued messages, one JSON record
+    per line. Each batch rotates it, and the rotated file is deleted once
+    the batch is committed.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # The token tells this process's files from those of an earlier
+        # one that had the same pid
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.path = self.directory / f"spool-{self.owner}.jsonl"
+        self._file = None
+        self._rotations = 0
+
+    def append(self, record):
+        if self._file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # Survives the process crashing; sync() also survives the machine
+        self._file.flush()
+
+    def sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def dead_letter(self, record):
+        """
+        Keep a message that cannot be saved, for an operator to look at.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rotate(self):
+        """
+        Close the current file and return its new name, or None if empty.
+        """
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        self._rotations += 1
+        rotated = self.path.with_suffix(f".{self._rotations}.jsonl")
+        os.replace(self.path, rotated)
+        return rotated
+
+    def claim(self, path):
+        """
+        Take over a spool file left by a process that is gone.
+
+        Returns:
+            Path: Its new name, or None if another process claimed it first.
+        """
+        self._rotations += 1
+        claimed = self.path.with_suffix(f".{self._rotations}.jsonl")
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def orphans(self):
+        """
+        Spool files whose process has exited.
+        """
+        if not self.directory.is_dir():
+            return []
+        found = []
+        for path in self.directory.glob("spool-*.jsonl"):
+            owner = path.name[len("spool-") :].split(".")[0]
+            pid = int(owner.split("-")[0])
+            if owner == self.owner:
+                continue
+            if pid == os.getpid() or not _alive(pid):
+                found.append(path)
+        return found
+
+
+class WriteBehindQueue:
+    """
+    Queues new chat messages and inserts them in batches.
+
+    Each batch is one transaction. It inserts the messages with bulk_create
+    and updates each thread's denormalized summary and updated_at once,
+    instead of once per message as ChatMessage.save does.
+    """
+
+    def __init__(self, spool_dir, interval, batch_size):
+        self.spool = Spool(spool_dir)
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queued = []
+        self._inflight = []
+        self._rotated = []
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, thread, sender, content):
+        """
+        Queue a message for saving.
+
+        Returns:
+            ChatMessage: Unsaved, so without an id.
+        """
+        record = _record(thread, sender, content)
+        with self._lock:
+            self.spool.append(record)
+            self._queued.append(record)
+            full = len(self._queued) >= self.batch_size
+            self._start()
+        if full:
+            self._wake.set()
+        return ChatMessage(
+            thread=thread,
+            sender=sender,
+            content=content,
+            created_at=created_at(record),
+        )
+
+    def pending(self, thread_id):
+        """
+        A thread's messages not committed yet, oldest first.
+        """
+        with self._lock:
+            records = self._inflight + self._queued
+        return [r for r in records if r["thread_id"] == thread_id]
+
+    def flush(self):
+        """
+        Save every queued message.
+
+        If the batch fails, its messages are saved one at a time. If none
+        of them can be saved the database is likely down, and the batch is
+        queued again as it is. Otherwise those that failed are queued
+        again, up to WRITE_BEHIND_MAX_ATTEMPTS times, so one bad message
+        cannot hold up the others.
+
+        Returns:
+            int: The number of messages saved.
+        """
+        with self._flushing:
+            with self._lock:
+                batch, self._queued = self._queued, []
+                if not batch:
+                    return 0
+                self._inflight = batch
+                self.spool.sync()
+                rotated = self.spool.rotate()
+                if rotated is not None:
+                    self._rotated.append(rotated)
+            try:
+                self._save(batch)
+                failed = []
+            except Exception as e:
+                failed = self._save_each(batch) if len(batch) > 1 else [(batch[0], e)]
+            if len(failed) == len(batch):
+                with self._lock:
+                    # Retried with the next batch; the spool still has them
+                    self._queued = batch + self._queued
+                    self._inflight = []
+                raise failed[0][1]
+            retry = self._retries(failed)
+            with self._lock:
+                # Spooled again, so the older spools can go
+                for record in retry:
+                    self.spool.append(record)
+                self.spool.sync()
+                self._queued = retry + self._queued
+                self._inflight = []
+                rotated, self._rotated = self._rotated, []
+            for path in rotated:
+                path.unlink(missing_ok=True)
+        for user_id in {r["user_id"] for r in batch}:
+            thread_cache.invalidate(user_id)
+        return len(batch) - len(failed)
+
+    def recover(self):
+        """
+        Queue the unsaved messages of processes that exited without saving
+        them. Messages they did save before exiting are skipped.
+
+        Returns:
+            int: The number of messages queued.
+        """
+        recovered = 0
+        for path in self.spool.orphans():
+            claimed = self.spool.claim(path)
+            if claimed is None:
+                continue
+            records = []
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass  # A line cut short by the crash
+            records = self._unsaved(records)
+            with self._lock:
+                self._queued = records + self._queued
+                self._rotated.append(claimed)
+            recovered += len(records)
+            logger.info(f"Recovered {len(records)} unsaved messages from {path.name}")
+        return recovered
+
+    def close(self):
+        """
+        Stop the background thread and save what is queued.
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        try:
+            self.flush()
+        except Exception as e:
+            # Left in the spool for the next worker
+            logger.warning(f"Could not save queued messages: {e}")
+
+    def _save(self, records):
+        by_thread = defaultdict(list)
+        for record in records:
+            by_thread[record["thread_id"]].append(record)
+        with transaction.atomic():
+            # Messages of threads deleted in the meantime go with them
+            live = set(
+                ChatThread.objects.filter(id__in=by_thread).values_list("id", flat=True)
+            )
+            ChatMessage.objects.bulk_create(
+                [
+                    ChatMessage(
+                        thread_id=r["thread_id"],
+                        sender=r["sender"],
+                        content=r["content"],
+                        created_at=created_at(r),
+                    )
+                    for r in records
+                    if r["thread_id"] in live
+                ],
+                batch_size=self.batch_size,
+            )
+            now = timezone.now()
+            for thread_id in live:
+                thread_records = by_thread[thread_id]
+                last = thread_records[-1]
+                last_at = created_at(last)
+                ChatThread.objects.filter(pk=thread_id).update(
+                    message_count=F("message_count") + len(thread_records),
+                    updated_at=now,
+                )
+                # Unless a message saved directly, e.g. a checkpointed
+                # reply, is newer
+                ChatThread.objects.filter(
+                    Q(last_message_at__isnull=True) | Q(last_message_at__lte=last_at),
+                    pk=thread_id,
+                ).update(
+                    last_message_at=last_at,
+                    last_message_preview=last["content"][:PREVIEW_LENGTH],
+                )
+
+    def _save_each(self, records):
+        failed = []
+        for record in records:
+            try:
+                self._save([record])
+            except Exception as e:
+                failed.append((record, e))
+        return failed
+
+    def _retries(self, failed):
+        retry = []
+        for record, error in failed:
+            record["attempts"] = record.get("attempts", 0) + 1
+            if record["attempts"] < WRITE_BEHIND_MAX_ATTEMPTS:
+                retry.append(record)
+                continue
+            logger.error(
+                f"Could not save a message for thread {record['thread_id']} "
+                f"after {record['attempts']} attempts, moved it to "
+                f"{DEAD_LETTER_FILE}: {error}"
+            )
+            self.spool.dead_letter({**record, "error": str(error)})
+        return retry
+
+    def _unsaved(self, records):
+        unsaved = []
+        for record in records:
+            saved = ChatMessage.objects.filter(
+                thread_id=record["thread_id"],
+                sender=record["sender"],
+                created_at=created_at(record),
+            ).exists()
+            if not saved:
+                unsaved.append(record)
+        return unsaved
+
+    def _start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="chat-write-behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        try:
+            self.recover()
+        except Exception as e:
+            logger.warning(f"Could not recover spooled messages: {e}")
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Could not save queued messages: {e}")
+            finally:
+                close_old_connections()
+
+
+queue = WriteBehindQueue(
+    WRITE_BEHIND_SPOOL_DIR, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH
+)
+
+
+def add(thread, sender, content):
+    return queue.add(thread, sender, content)
+
+
+def pending(thread_id):
+    if not WRITE_BEHIND:
+        return []
+    return queue.pending(thread_id)
+
+
+def flush():
+    return queue.flush()
@@ -2,6 +2,8 @@
 ASGI config for llama_chatbot project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides Django's HTTP handling it serves the chat WebSocket, see
+chat.websocket.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llama_chatbot.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from chat.websocket import route  # noqa: E402
+
+application = route(django_application)
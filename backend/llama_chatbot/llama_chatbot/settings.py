@@ -93,6 +93,12 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Concurrent writers, e.g. streams saving checkpoints, wait for the
+        # lock instead of failing with "database is locked"
+        "OPTIONS": {
+            "init_command": "PRAGMA journal_mode=WAL;",
+            "transaction_mode": "IMMEDIATE",
+        },
     }
 }
 
@@ -163,6 +169,12 @@ CORS_ALLOW_METHODS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Response headers the frontend reads from streaming responses
+CORS_EXPOSE_HEADERS = [
+    "X-Generation-Id",
+    "X-Queue-Position",
+]
+
 CSRF_TRUSTED_ORIGINS = [
     "https://localhost:5173",
 ]
@@ -17,9 +17,12 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
+from chat.views import prometheus_metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("auth/", include("accounts.urls")),
     path("chat/", include("chat.urls")),
+    # Prometheus scrape endpoint
+    path("metrics", prometheus_metrics, name="metrics"),
 ]
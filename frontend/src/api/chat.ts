@@ -14,17 +14,23 @@ const API_URL = import.meta.env.VITE_ENV === 'prod'
   ? import.meta.env.VITE_BACKEND_API_URL 
   : import.meta.env.VITE_BACKEND_API_LOCAL_URL;
   
-export const fetchMessages = async (
-  chatId: string,
-): Promise<{
+export interface MessagePage {
   messages: Message[];
   isThreadCreated: boolean;
   currentThreadId: string | null;
-}> => {
+  before: string | null; // Cursor of the next older page, if there is one
+}
+
+export const fetchMessages = async (
+  chatId: string,
+  before: string | null = null,
+): Promise<MessagePage> => {
   if (chatId && chatId !== "new") {
     try {
-      const response = await fetch(
-        `${API_URL}/chat/threads/${chatId}/messages/`,
+      // Messages are paginated newest first; older pages are loaded on scroll
+      const query: string = before ? `?before=${before}` : "";
+      const response: Response = await fetch(
+        `${API_URL}/chat/threads/${chatId}/messages/${query}`,
         {
           method: "GET",
           credentials: "include",
@@ -38,6 +44,7 @@ export const fetchMessages = async (
         messages: data.messages,
         isThreadCreated: true,
         currentThreadId: chatId,
+        before: data.has_more ? data.before : null,
       };
     } catch (error) {
       console.error("Failed to fetch chat messages:", error);
@@ -48,6 +55,7 @@ export const fetchMessages = async (
       messages: [],
       isThreadCreated: false,
       currentThreadId: null,
+      before: null,
     };
   }
   throw new Error("Invalid chat ID");
@@ -104,11 +112,18 @@ export const createNewThread = async (): Promise<string> => {
   }
 };
 
-export const fetchChatThreads = async (): Promise<{
+export interface ThreadPage {
   threads: ChatThread[];
-}> => {
+  before: string | null; // Cursor of the next older page, if there is one
+}
+
+export const fetchChatThreads = async (
+  before: string | null = null,
+): Promise<ThreadPage> => {
   try {
-    const response = await fetch(`${API_URL}/chat/threads/`, {
+    // Threads are paginated newest first; older pages are loaded on scroll
+    const query: string = before ? `?before=${before}` : "";
+    const response: Response = await fetch(`${API_URL}/chat/threads/${query}`, {
       method: "GET",
       credentials: "include", // Include credentials with the request
     });
@@ -118,7 +133,10 @@ export const fetchChatThreads = async (): Promise<{
     }
 
     const data = await response.json();
-    return data;
+    return {
+      threads: data.threads,
+      before: data.has_more ? data.before : null,
+    };
   } catch (error) {
     console.error("Failed to fetch chat threads:", error);
     throw error; // Re-throw the error to be handled by the caller
@@ -208,6 +226,26 @@ export async function deleteAllThreads(): Promise<void> {
   }
 }
 
+export async function cancelStream(threadId: string): Promise<void> {
+  const url = `${API_URL}/chat/streaming-response/${threadId}/cancel/`;
+
+  try {
+    const response = await fetch(url, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      credentials: "include", // Include credentials with the request
+    });
+
+    if (!response.ok) {
+      throw new Error(`Failed to cancel stream: ${response.statusText}`);
+    }
+  } catch (error) {
+    console.error("Error cancelling stream:", error);
+  }
+}
+
 export interface SendMessageParams {
   threadId: string;
   message: string;
@@ -215,6 +253,9 @@ export interface SendMessageParams {
   onMessageUpdate: (content: string) => void;
 }
 
+// How many times a dropped stream is resumed before giving up
+const MAX_RESUME_RETRIES = 3;
+
 export const sendMessageStream = async ({
   threadId,
   message,
@@ -229,7 +270,8 @@ export const sendMessageStream = async ({
         headers: {
           "Content-Type": "application/json",
         },
-        body: JSON.stringify({ message }),
+        // Only the new turn is sent; the server rebuilds the conversation
+        body: JSON.stringify({ message, history: "server" }),
         credentials: "include",
         signal, // Pass the AbortSignal to the fetch request
       },
@@ -239,22 +281,48 @@ export const sendMessageStream = async ({
       throw new Error("Network response was not ok");
     }
 
-    const reader = response.body?.getReader();
-    if (!reader) {
-      throw new Error("Failed to get reader from response body");
-    }
-
+    const generationId = response.headers.get("X-Generation-Id");
     const decoder = new TextDecoder();
     let content = "";
+    let offset = 0; // Bytes received, for resuming a dropped stream
+    let body = response.body;
+    let retries = 0;
 
     while (true) {
-      const { done, value } = await reader.read();
-      if (done) break;
-
-      const chunk = decoder.decode(value, { stream: true });
-      content += chunk;
-
-      onMessageUpdate(content); // Notify the UI about the new content
+      const reader = body?.getReader();
+      if (!reader) {
+        throw new Error("Failed to get reader from response body");
+      }
+      try {
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) return;
+
+          offset += value.length;
+          const chunk = decoder.decode(value, { stream: true });
+          content += chunk;
+
+          onMessageUpdate(content); // Notify the UI about the new content
+        }
+      } catch (error) {
+        if (
+          !generationId ||
+          retries >= MAX_RESUME_RETRIES ||
+          (error instanceof Error && error.name === "AbortError")
+        ) {
+          throw error;
+        }
+        // The connection dropped; pick the stream up where it left off
+        retries += 1;
+        const resumed = await fetch(
+          `${API_URL}/chat/streaming-response/${threadId}/${generationId}/?offset=${offset}`,
+          { credentials: "include", signal },
+        );
+        if (!resumed.ok) {
+          throw error;
+        }
+        body = resumed.body;
+      }
     }
   } catch (error) {
     if (error instanceof Error) {
@@ -2,6 +2,7 @@ import React, {
   useState,
   useRef,
   useEffect,
+  useLayoutEffect,
   KeyboardEvent,
   FormEvent,
 } from "react";
@@ -10,7 +11,9 @@ import { useParams, useNavigate, useLocation } from "react-router-dom";
 import {
   fetchMessages,
   createNewThread,
+  cancelStream,
   Message,
+  MessagePage,
   SendMessageParams,
 } from "../api/chat";
 import { useChatContext } from "../contexts/ChatContext";
@@ -31,7 +34,15 @@ const Chat: React.FC = () => {
   const [input, setInput] = useState("");
   const [loading, setLoading] = useState(false); // State to track if bot is responding
   const endOfMessagesRef = useRef<HTMLDivElement | null>(null);
+  const scrollRef = useRef<HTMLDivElement | null>(null);
+  // Distance from the bottom to keep while older messages are prepended
+  const prependOffsetRef = useRef<number | null>(null);
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const loadingOlderRef = useRef(false); // Scroll events outpace re-renders
   const { chatId } = useParams<{ chatId: string }>();
+  const chatIdRef = useRef(chatId);
+  chatIdRef.current = chatId;
   const [isThreadCreated, setIsThreadCreated] = useState<boolean>(false);
   const [currentThreadId, setCurrentThreadId] = useState<string | null>(null);
   const navigate = useNavigate();
@@ -67,6 +78,7 @@ const Chat: React.FC = () => {
       }
       setIsThreadCreated(data.isThreadCreated);
       setCurrentThreadId(data.currentThreadId);
+      setOlderCursor(data.before);
     }
   }, [data]);
 
@@ -75,16 +87,70 @@ const Chat: React.FC = () => {
       setMessages([]);
       setCurrentThreadId(null);
       setIsThreadCreated(false);
+      setOlderCursor(null);
     }
     setErrorMessage(null); // Clear any previous errors
   }, [location.pathname]);
 
-  useEffect(() => {
-    if (endOfMessagesRef.current) {
+  useLayoutEffect(() => {
+    const container = scrollRef.current;
+    if (prependOffsetRef.current !== null && container) {
+      // Older messages went in above; keep the view where it was
+      container.scrollTop = container.scrollHeight - prependOffsetRef.current;
+      prependOffsetRef.current = null;
+    } else if (endOfMessagesRef.current) {
       endOfMessagesRef.current.scrollIntoView({ behavior: "smooth" });
     }
   }, [messages]);
 
+  const loadOlderMessages = async () => {
+    const container = scrollRef.current;
+    if (!container || !chatId || !olderCursor || loadingOlderRef.current) {
+      return;
+    }
+    loadingOlderRef.current = true;
+    setLoadingOlder(true);
+    try {
+      const page = await fetchMessages(chatId, olderCursor);
+      if (chatIdRef.current !== chatId) {
+        return; // Another thread was opened meanwhile
+      }
+      prependOffsetRef.current = container.scrollHeight - container.scrollTop;
+      setMessages((prevMessages) => [...page.messages, ...prevMessages]);
+      setOlderCursor(page.before);
+      // Keep them when the thread is opened again
+      queryClient.setQueryData(
+        ["messages", chatId],
+        (old: MessagePage | undefined) =>
+          old && {
+            ...old,
+            messages: [...page.messages, ...old.messages],
+            before: page.before,
+          },
+      );
+    } catch (error) {
+      setErrorMessage("Could not load earlier messages.");
+    } finally {
+      loadingOlderRef.current = false;
+      setLoadingOlder(false);
+    }
+  };
+
+  const handleScroll = () => {
+    // Load the previous page once the top of the thread comes into view
+    if (scrollRef.current && scrollRef.current.scrollTop < 100) {
+      loadOlderMessages();
+    }
+  };
+
+  useEffect(() => {
+    // A first page too short to scroll would never load the rest
+    const container = scrollRef.current;
+    if (container && container.scrollHeight <= container.clientHeight) {
+      loadOlderMessages();
+    }
+  }, [messages, olderCursor]);
+
   useEffect(() => {
     // Abort ongoing request when location changes
     return () => {
@@ -105,8 +171,8 @@ const Chat: React.FC = () => {
     onSuccess: ({ threadId }) => {
       // Update state for new thread
       setChatThreads((prevThreads) => [
-        ...prevThreads,
         { id: Number(threadId), title: "New Chat" },
+        ...prevThreads,
       ]);
       navigate(`/chat/${threadId}`, { state: { isNewThread: true } });
     },
@@ -116,10 +182,7 @@ const Chat: React.FC = () => {
     },
   });
 
-  const handleCreateThreadAndSendMessage = async (
-    userMsg: string,
-    context: string,
-  ) => {
+  const handleCreateThreadAndSendMessage = async (userMsg: string) => {
     try {
       let threadId = currentThreadId;
       if (!isThreadCreated) {
@@ -141,7 +204,7 @@ const Chat: React.FC = () => {
 
         const params: SendMessageParams = {
           threadId: threadId,
-          message: context,
+          message: userMsg,
           signal: controller.signal,
           onMessageUpdate: (newContent: string) => {
             setMessages((prevMessages) => {
@@ -164,11 +227,15 @@ const Chat: React.FC = () => {
               }
 
               // Update messages in cache without refetching
-              queryClient.setQueryData(["messages", threadId], {
-                messages: updatedMessages, // The new messages you want to set
-                isThreadCreated: isThreadCreated, 
-                currentThreadId: threadId, // The current thread ID you're working with
-              });
+              queryClient.setQueryData(
+                ["messages", threadId],
+                (old: MessagePage | undefined) => ({
+                  messages: updatedMessages, // The new messages you want to set
+                  isThreadCreated: isThreadCreated,
+                  currentThreadId: threadId, // The current thread ID you're working with
+                  before: old ? old.before : null, // Older pages still unloaded
+                }),
+              );
 
               return updatedMessages;
             });
@@ -214,15 +281,7 @@ const Chat: React.FC = () => {
       setInput("");
       resetTextareaHeight();
 
-      // Create a single string from the conversation history including the user's message
-      const context = [
-        ...messages,
-        { content: userMsg, sender: "user" }, // Include the new user message
-      ]
-        .map((msg) => `${msg.sender}: ${msg.content}`)
-        .join("\n");
-
-      handleCreateThreadAndSendMessage(userMsg, context);
+      handleCreateThreadAndSendMessage(userMsg);
     }
   };
 
@@ -252,6 +311,10 @@ const Chat: React.FC = () => {
   const handleStop = (): void => {
     if (abortController) {
       abortController.abort();
+      // Also tell the backend, in case the disconnect is not noticed right away
+      if (currentThreadId) {
+        cancelStream(currentThreadId);
+      }
       console.log("Cancelled request");
       setLoading(false);
     }
@@ -278,7 +341,11 @@ const Chat: React.FC = () => {
         />
       </div>
       <div className="mx-auto flex h-full w-full flex-col overflow-hidden">
-        <div className="flex h-full justify-center overflow-auto p-4">
+        <div
+          ref={scrollRef}
+          onScroll={handleScroll}
+          className="flex h-full justify-center overflow-auto p-4"
+        >
           <div className="h-full w-3/5">
             {isLoading ? (
               <div className="flex h-full flex-col items-center justify-center">
@@ -317,6 +384,11 @@ const Chat: React.FC = () => {
               </div>
             ) : (
               <div className="flex flex-col space-y-4">
+                {loadingOlder && (
+                  <p className="text-center text-gray-500">
+                    Loading earlier messages...
+                  </p>
+                )}
                 {messages.map((msg, index) => (
                   <div
                     key={index}
@@ -1,4 +1,4 @@
-import React, { useEffect } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { useChatContext } from "../contexts/ChatContext";
 import {
   fetchChatThreads,
@@ -15,11 +15,14 @@ import { ClearChatsDialog } from "./ClearChatsDialog";
 const SideBar: React.FC = () => {
   const { chatThreads, setChatThreads } = useChatContext();
   const navigate = useNavigate();
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const loadingOlderRef = useRef(false); // Scroll events outpace re-renders
 
-  //Fetch chat threads
+  //Fetch the newest page of chat threads
   const { data, error, isLoading } = useQuery({
     queryKey: ["chatThreads"],
-    queryFn: fetchChatThreads,
+    queryFn: () => fetchChatThreads(),
     refetchOnWindowFocus: false, // Avoid refetching on window focus
     refetchOnReconnect: false, // Avoid refetching on reconnect
     refetchInterval: false, // Disable periodic refetching
@@ -29,9 +32,42 @@ const SideBar: React.FC = () => {
   useEffect(() => {
     if (data?.threads) {
       setChatThreads(data.threads);
+      setOlderCursor(data.before);
     }
   }, [data]); // Depend on data to update when it changes
 
+  const loadOlderThreads = async () => {
+    if (!olderCursor || loadingOlderRef.current) {
+      return;
+    }
+    loadingOlderRef.current = true;
+    setLoadingOlder(true);
+    try {
+      const page = await fetchChatThreads(olderCursor);
+      // Threads moved up since the first page may already be listed
+      setChatThreads((prevThreads) => [
+        ...prevThreads,
+        ...page.threads.filter(
+          (thread) => !prevThreads.some((t) => t.id === thread.id),
+        ),
+      ]);
+      setOlderCursor(page.before);
+    } catch (error) {
+      console.error("Error loading older threads:", error);
+    } finally {
+      loadingOlderRef.current = false;
+      setLoadingOlder(false);
+    }
+  };
+
+  const handleScroll = (e: React.UIEvent<HTMLDivElement>) => {
+    // Load the next page once the end of the list comes into view
+    const list = e.currentTarget;
+    if (list.scrollHeight - list.scrollTop - list.clientHeight < 100) {
+      loadOlderThreads();
+    }
+  };
+
   const handleRename = async (threadId: number, newTitle: string) => {
     setChatThreads((prevThreads) =>
       prevThreads.map((thread) =>
@@ -77,6 +113,7 @@ const SideBar: React.FC = () => {
   const handleDeleteAll = async () => {
     // Optionally clear the chat threads from the UI
     setChatThreads([]);
+    setOlderCursor(null);
 
     try {
       // Call the function to delete all threads on the server
@@ -115,12 +152,24 @@ const SideBar: React.FC = () => {
               <p className="mt-4 text-red-500">Error: {error.message}</p>
             </div>
           ) : (
-            <div className="max-h-[calc(100vh-120px)] min-h-[calc(100vh-120px)] flex-grow overflow-y-auto">
+            <div
+              onScroll={handleScroll}
+              className="max-h-[calc(100vh-120px)] min-h-[calc(100vh-120px)] flex-grow overflow-y-auto"
+            >
               <ChatThreadsList
                 chatThreads={chatThreads}
                 onRename={handleRename}
                 onDelete={handleDelete}
               />
+              {olderCursor && (
+                <button
+                  onClick={loadOlderThreads}
+                  disabled={loadingOlder}
+                  className="w-full rounded-lg p-2 text-gray-400 hover:bg-secondary/10"
+                >
+                  {loadingOlder ? "Loading threads..." : "Load more"}
+                </button>
+              )}
             </div>
           )}
           <ClearChatsDialog handleDeleteAll={handleDeleteAll} />